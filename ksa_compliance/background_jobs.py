@@ -1,16 +1,52 @@
+import asyncio
 import datetime
-from typing import Optional, cast
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import Iterator, Optional, cast
 
 import frappe
+import httpx
 from frappe.query_builder import DocType
+from frappe.utils import strip
+from frappe.utils.password import get_decrypted_password
 from pypika import Order
 from pypika.queries import QueryBuilder
-from result import is_ok
+from result import is_err, is_ok
+from rq import get_current_job
 
-from ksa_compliance import logger
+from ksa_compliance import circuit_breaker, logger
+from ksa_compliance import zatca_async_api as async_api
+from ksa_compliance.zatca_async_api import send_as_completed
+from ksa_compliance.zatca_api import CIRCUIT_OPEN_STATUS_CODE, get_connection_stats
 from ksa_compliance.ksa_compliance.doctype.sales_invoice_additional_fields.sales_invoice_additional_fields import (
     SalesInvoiceAdditionalFields,
+    SubmissionContext,
+    ZatcaSubmission,
 )
+from ksa_compliance.ksa_compliance.doctype.zatca_business_settings.zatca_business_settings import (
+    FATOORA_SERVER_URLS,
+    ZATCABusinessSettings,
+)
+from ksa_compliance.ksa_compliance.doctype.zatca_sync_run.zatca_sync_run import ZATCASyncRun
+
+# The number of invoices sent to ZATCA at the same time by [sync_e_invoices]. Can be overridden using the
+# 'zatca_sync_concurrency' site config key. 1 means invoices are sent one at a time (serial mode)
+DEFAULT_SYNC_CONCURRENCY = 1
+
+# The number of invoices sent at the same time using the same credentials (server + token), regardless of the overall
+# concurrency. Can be overridden using the 'zatca_sync_concurrency_per_credential' site config key
+DEFAULT_SYNC_CONCURRENCY_PER_CREDENTIAL = 4
+
+# The timeout of the sync job queued by [add_batch_to_background_queue]. 58 minutes, so that we can run it hourly
+SYNC_JOB_TIMEOUT = 3480
+
+# The integration statuses of invoices waiting to be sent by [sync_e_invoices]
+PENDING_INTEGRATION_STATUSES = ['Ready For Batch', 'Resend', 'Corrected']
+
+# How long before the job timeout [sync_e_invoices] stops sending invoices, leaving time to record the responses of
+# in-flight API calls. Invoices that weren't sent stay as they are and are picked up by the next run
+SYNC_DEADLINE_MARGIN_SECONDS = 60
 
 
 @frappe.whitelist()
@@ -21,7 +57,7 @@ def add_batch_to_background_queue(check_date=datetime.date.today()):
             'ksa_compliance.background_jobs.sync_e_invoices',
             check_date=check_date,
             queue='long',
-            timeout=3480,  # 58 minutes, so that we can run it hourly
+            timeout=SYNC_JOB_TIMEOUT,
             job_name='Sync E-Invoices',
             deduplicate=True,
             job_id=f'Sending invoices {check_date}',
@@ -30,11 +66,78 @@ def add_batch_to_background_queue(check_date=datetime.date.today()):
         logger.error('An error occurred queueing the job', exc_info=ex)
 
 
+@frappe.whitelist()
+def get_zatca_server_status() -> list[dict]:
+    """Returns the circuit breaker state of the ZATCA servers used by enabled business settings"""
+    servers = frappe.get_list(
+        'ZATCA Business Settings',
+        filters={'enable_zatca_integration': 1},
+        pluck='fatoora_server',
+        distinct=True,
+    )
+    statuses = []
+    for server in sorted(set(servers) & FATOORA_SERVER_URLS.keys()):
+        status = circuit_breaker.get_status(FATOORA_SERVER_URLS[server])
+        statuses.append(
+            {'server': server, 'state': status.state, 'failures': status.failures, 'retry_in': int(status.retry_in)}
+        )
+    return statuses
+
+
+@frappe.whitelist()
+def get_sync_runs(limit: int = 10) -> list[dict]:
+    """Returns the most recent ZATCA Sync Runs, most recent first"""
+    return frappe.get_list(
+        'ZATCA Sync Run',
+        fields=[
+            'name',
+            'status',
+            'started_at',
+            'ended_at',
+            'processed',
+            'accepted',
+            'resend',
+            'rejected',
+            'throughput',
+            'resumed_from',
+        ],
+        order_by='started_at desc',
+        limit=int(limit),
+    )
+
+
 def sync_e_invoices(
-    check_date: Optional[datetime.datetime | datetime.date] = None, batch_size: int = 100, dry_run: bool = False
-):
+    check_date: Optional[datetime.datetime | datetime.date] = None,
+    batch_size: int = 100,
+    dry_run: bool = False,
+    concurrency: Optional[int] = None,
+    time_budget: Optional[float] = None,
+) -> int:
+    """
+    Sends pending invoices to ZATCA. If [concurrency] (or the 'zatca_sync_concurrency' site config key) is more than 1,
+    up to that many API calls are made at the same time, otherwise invoices are sent one at a time. Concurrent calls
+    are made from a thread pool, or from a single thread using asyncio if the 'zatca_sync_async' site config key is set,
+    which is lighter for high concurrency (hundreds of calls in flight).
+
+    The sync stops sending invoices after [time_budget] seconds (or the 'zatca_sync_time_budget' site config key), which
+    defaults to the timeout of the current background job minus [SYNC_DEADLINE_MARGIN_SECONDS]. API calls are cut short
+    at that point too, so the job records its results instead of being killed mid-way.
+
+    Each run (except dry runs) is recorded as a ZATCA Sync Run along with a checkpoint after every batch. A run that
+    didn't complete (ran out of time or was killed) is resumed from its checkpoint by the next run from the same
+    [check_date]. Invoices left behind (e.g. to be resent) are picked up once a run completes and the next one starts
+    over.
+
+    Returns the number of invoices processed
+    """
     prefix = '[Dry run] ' if dry_run else ''
-    logger.info(f'{prefix}Syncing with ZATCA in batches of {batch_size}')
+    concurrency = concurrency or int(frappe.conf.get('zatca_sync_concurrency', DEFAULT_SYNC_CONCURRENCY))
+    logger.info(f'{prefix}Syncing with ZATCA in batches of {batch_size} with concurrency {concurrency}')
+    start = time.monotonic()
+    time_budget = time_budget or _get_sync_time_budget()
+    deadline = start + time_budget if time_budget else None
+    if deadline:
+        logger.info(f'{prefix}Sync will stop sending invoices after {time_budget:.0f}s')
     if check_date:
         logger.info(f'{prefix}Limiting sync to >= date: {check_date}')
 
@@ -47,50 +150,441 @@ def sync_e_invoices(
     # If we kept the offset at 0, the loop would never terminate in dry_run mode because we never update status.
     #
     # The solution is to use the creation date itself as an offset/filter. We sort by it ascending, so after every
-    # batch we can query for fields whose creation > the last creation in the previous batch
+    # batch we can query for fields whose creation > the last creation in the previous batch. Invoices can share a
+    # creation timestamp (e.g. bulk imports), so the name breaks ties: the cursor is the (creation, name) of the last
+    # invoice in the previous batch
+    offset_name: Optional[str] = None
     if isinstance(check_date, datetime.date):
         offset = cast(Optional[datetime.datetime], datetime.datetime.combine(check_date, datetime.time.min))
     else:
         offset = cast(Optional[datetime.datetime], check_date)
 
-    while True:
-        query = build_query(offset, batch_size)
-        additional_field_docs = query.run(as_dict=True)
-        if not additional_field_docs:
+    run = None if dry_run else ZATCASyncRun.start(offset)
+    if run and run.resumed_from:
+        offset, offset_name = run.cursor_creation, run.cursor_name
+        logger.info(f'Resuming sync run {run.resumed_from} after {offset_name} ({offset})')
+
+    per_credential_limit = int(
+        frappe.conf.get('zatca_sync_concurrency_per_credential', DEFAULT_SYNC_CONCURRENCY_PER_CREDENTIAL)
+    )
+    concurrent = concurrency > 1 and not dry_run
+    use_async = concurrent and bool(frappe.conf.get('zatca_sync_async'))
+    executor = ThreadPoolExecutor(max_workers=concurrency) if concurrent and not use_async else None
+    limiter = _CredentialLimiter(per_credential_limit)
+    if use_async:
+        # A single event loop and client for the whole run, so that connections are kept alive across batches
+        loop = asyncio.new_event_loop()
+        client = async_api.create_client(max_connections=concurrency)
+        async_limiter = _AsyncCredentialLimiter(per_credential_limit)
+
+    count = 0
+    try:
+        while not _is_past(deadline):
+            query = build_query(offset, batch_size, offset_name)
+            additional_field_docs = query.run(as_dict=True)
+            if not additional_field_docs:
+                break
+
+            logger.info(f'{prefix}Syncing {len(additional_field_docs)} after date/time {offset}')
+            offset = additional_field_docs[-1].creation
+            offset_name = additional_field_docs[-1].name
+
+            if use_async:
+                batch_count = loop.run_until_complete(
+                    _submit_asynchronously(additional_field_docs, client, async_limiter, concurrency, deadline)
+                )
+            elif executor:
+                batch_count = _submit_concurrently(additional_field_docs, executor, limiter, deadline)
+            else:
+                batch_count = _submit_serially(additional_field_docs, prefix, dry_run, deadline)
+            count += batch_count
+
+            if run:
+                cursor = None if _is_past(deadline) else additional_field_docs[-1]
+                run.record_batch([doc.name for doc in additional_field_docs], batch_count, cursor)
+    except Exception:
+        if run:
+            frappe.db.rollback()
+            run.finish('Failed')
+        raise
+    finally:
+        if executor:
+            executor.shutdown()
+        if use_async:
+            loop.run_until_complete(client.aclose())
+            loop.close()
+
+    if _is_past(deadline):
+        logger.warning(f'{prefix}Sync ran out of time. Remaining invoices will be sent by the next run')
+    if run:
+        run.finish('Timed Out' if _is_past(deadline) else 'Completed')
+
+    elapsed = time.monotonic() - start
+    throughput = count / elapsed if elapsed else 0
+    logger.info(f'{prefix}Sync Done. Processed {count} invoices in {elapsed:.1f}s ({throughput:.2f} invoices/s)')
+    for server, stats in get_connection_stats().items():
+        logger.info(f"{prefix}{server}: {stats['requests']} requests over {stats['connections']} connections")
+    return count
+
+
+def submit_invoices(names: list[str], deadline: Optional[float] = None) -> int:
+    """
+    Sends the given invoices (Sales Invoice Additional Fields names) to ZATCA, skipping those that were already sent,
+    with the same concurrency as [sync_e_invoices]. Returns the number of invoices processed
+    """
+    additional_field_docs = frappe.get_all(
+        'Sales Invoice Additional Fields',
+        filters={'name': ['in', names], 'docstatus': 0, 'integration_status': ['in', PENDING_INTEGRATION_STATUSES]},
+        fields=['name'],
+        order_by='creation asc',
+    )
+    concurrency = min(
+        int(frappe.conf.get('zatca_sync_concurrency', DEFAULT_SYNC_CONCURRENCY)), len(additional_field_docs)
+    )
+    if concurrency <= 1:
+        return _submit_serially(additional_field_docs, '', False, deadline)
+
+    per_credential_limit = int(
+        frappe.conf.get('zatca_sync_concurrency_per_credential', DEFAULT_SYNC_CONCURRENCY_PER_CREDENTIAL)
+    )
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return _submit_concurrently(additional_field_docs, executor, _CredentialLimiter(per_credential_limit), deadline)
+
+
+def prefetch_batch(names: list[str]) -> dict[str, tuple[SalesInvoiceAdditionalFields, SubmissionContext]]:
+    """
+    Loads the given invoices (Sales Invoice Additional Fields names) along with what's needed to send them to ZATCA
+    (see [SubmissionContext]). This takes a few queries for the whole batch, rather than around ten per invoice when
+    each invoice loads its own sales invoice, customer, precomputed invoice and EGS
+    """
+    if not names:
+        return {}
+
+    docs = _load_additional_fields(names)
+    parties = _get_invoice_parties(docs)
+    b2b_customers = _get_b2b_customers({customer for _company, customer in parties.values() if customer})
+    settings_credentials = {
+        company: _get_settings_credentials(company) for company in {company for company, _customer in parties.values()}
+    }
+
+    precomputed_invoices = [doc.precomputed_invoice for doc in docs if doc.precomputed_invoice]
+    device_ids = {}
+    if precomputed_invoices:
+        device_ids = dict(
+            frappe.get_all(
+                'ZATCA Precomputed Invoice',
+                filters={'name': ['in', precomputed_invoices]},
+                fields=['name', 'device_id'],
+                as_list=True,
+            )
+        )
+    egs_credentials = _get_egs_credentials(set(device_ids.values()))
+
+    batch = {}
+    for doc in docs:
+        company, customer = parties.get((doc.invoice_doctype, doc.sales_invoice), (None, None))
+        if doc.precomputed_invoice:
+            device_id = device_ids.get(doc.precomputed_invoice)
+            credentials = egs_credentials.get(device_id)
+        else:
+            device_id = None
+            credentials = settings_credentials.get(company)
+        batch[doc.name] = (
+            doc,
+            SubmissionContext(
+                company=company, is_b2b_customer=customer in b2b_customers, credentials=credentials, device_id=device_id
+            ),
+        )
+    return batch
+
+
+def _load_additional_fields(names: list[str]) -> list[SalesInvoiceAdditionalFields]:
+    """Loads the given Sales Invoice Additional Fields with their child tables, one query per table"""
+    doctype = 'Sales Invoice Additional Fields'
+    table_fields = frappe.get_meta(doctype).get_table_fields()
+    children: dict[str, dict[str, list]] = {}
+    for table_field in table_fields:
+        for row in frappe.get_all(
+            table_field.options,
+            filters={'parent': ['in', names], 'parenttype': doctype, 'parentfield': table_field.fieldname},
+            fields=['*'],
+            order_by='idx asc',
+        ):
+            children.setdefault(row.parent, {}).setdefault(table_field.fieldname, []).append(row)
+
+    docs = []
+    for row in frappe.get_all(doctype, filters={'name': ['in', names]}, fields=['*']):
+        tables = {field.fieldname: children.get(row.name, {}).get(field.fieldname, []) for field in table_fields}
+        docs.append(cast(SalesInvoiceAdditionalFields, frappe.get_doc({**row, **tables, 'doctype': doctype})))
+    return docs
+
+
+def _get_invoice_parties(docs: list[SalesInvoiceAdditionalFields]) -> dict[tuple[str, str], tuple[str, Optional[str]]]:
+    """Returns the company and customer of the invoices of [docs], by invoice doctype and name"""
+    invoices: dict[str, list[str]] = {}
+    for doc in docs:
+        invoices.setdefault(doc.invoice_doctype, []).append(doc.sales_invoice)
+
+    parties = {}
+    for doctype, invoice_names in invoices.items():
+        customer_field = 'party' if doctype == 'Payment Entry' else 'customer'
+        for invoice in frappe.get_all(
+            doctype,
+            filters={'name': ['in', invoice_names]},
+            fields=['name', 'company', f'{customer_field} as customer'],
+        ):
+            parties[(doctype, invoice.name)] = (invoice.company, invoice.customer)
+    return parties
+
+
+def _get_b2b_customers(customers: set[str]) -> set[str]:
+    """Returns which of [customers] are businesses. See [is_b2b_customer]"""
+    if not customers:
+        return set()
+
+    b2b_customers = set(
+        frappe.get_all(
+            'Customer',
+            filters={'name': ['in', list(customers)], 'custom_vat_registration_number': ['is', 'set']},
+            pluck='name',
+        )
+    )
+    for additional_id in frappe.get_all(
+        'Additional Buyer IDs',
+        filters={'parent': ['in', list(customers)], 'parenttype': 'Customer', 'parentfield': 'custom_additional_ids'},
+        fields=['parent', 'value'],
+    ):
+        if strip(additional_id.value):
+            b2b_customers.add(additional_id.parent)
+    return b2b_customers
+
+
+def _get_settings_credentials(company: Optional[str]) -> Optional[tuple[str, str]]:
+    settings = ZATCABusinessSettings.for_company(company) if company else None
+    if not settings:
+        return None
+    return settings.production_security_token, settings.get_password('production_secret', raise_exception=False)
+
+
+def _get_egs_credentials(device_ids: set[str]) -> dict[str, tuple[str, str]]:
+    """Returns the production token and secret of the EGS of each of [device_ids]"""
+    if not device_ids:
+        return {}
+
+    credentials = {}
+    for egs in frappe.get_all(
+        'ZATCA EGS',
+        filters={'unit_common_name': ['in', list(device_ids)]},
+        fields=['name', 'unit_common_name', 'production_security_token', 'production_secret'],
+    ):
+        secret = get_decrypted_password('ZATCA EGS', egs.name, 'production_secret') if egs.production_secret else ''
+        credentials.setdefault(egs.unit_common_name, (egs.production_security_token, secret))
+    return credentials
+
+
+def _get_sync_time_budget() -> Optional[float]:
+    time_budget = frappe.conf.get('zatca_sync_time_budget')
+    if time_budget:
+        return float(time_budget)
+
+    job = get_current_job()
+    if job and job.timeout and job.timeout > 0:
+        return max(job.timeout - SYNC_DEADLINE_MARGIN_SECONDS, 0)
+    return None
+
+
+def _is_past(deadline: Optional[float]) -> bool:
+    return deadline is not None and time.monotonic() >= deadline
+
+
+def _submit_serially(additional_field_docs: list[dict], prefix: str, dry_run: bool, deadline: Optional[float]) -> int:
+    """Sends a batch of invoices to ZATCA one at a time, until [deadline]. Returns the number of invoices processed"""
+    batch = {} if dry_run else prefetch_batch([doc.name for doc in additional_field_docs])
+    count = 0
+    for doc in additional_field_docs:
+        if _is_past(deadline):
+            break
+
+        count += 1
+        try:
+            logger.info(f'{prefix}Submitting {doc.name}')
+            if dry_run:
+                continue
+
+            adf_doc, context = batch[doc.name]
+            result = adf_doc.submit_to_zatca(deadline, context)
+            message = result.ok_value if is_ok(result) else result.err_value
+            logger.info(f'{prefix}{doc.name}: {message}')
+            frappe.db.commit()
+        except Exception:
+            logger.error(f'{prefix}Error submitting {doc.name}', exc_info=True)
+            frappe.db.rollback()
+    return count
+
+
+def _submit_concurrently(
+    additional_field_docs: list[dict],
+    executor: ThreadPoolExecutor,
+    limiter: '_CredentialLimiter',
+    deadline: Optional[float],
+) -> int:
+    """
+    Sends a batch of invoices to ZATCA using [executor], until [deadline]. Only the API calls run on the executor
+    threads: preparing invoices and recording the responses happen on the current thread, which owns the database
+    connection. Returns the number of invoices processed
+    """
+    batch = prefetch_batch([doc.name for doc in additional_field_docs])
+    futures: dict[Future, SalesInvoiceAdditionalFields] = {}
+    count = 0
+    for doc in additional_field_docs:
+        if _is_past(deadline):
             break
 
-        logger.info(f'{prefix}Syncing {len(additional_field_docs)} after date/time {offset}')
-        offset = additional_field_docs[-1].creation
+        count += 1
+        try:
+            logger.info(f'Submitting {doc.name}')
+            adf_doc, context = batch[doc.name]
+            submission = adf_doc.prepare_zatca_submission(context)
+            if is_err(submission):
+                logger.info(f'{doc.name}: {submission.err_value}')
+                continue
 
+            futures[executor.submit(limiter.send, submission.ok_value, deadline)] = adf_doc
+        except Exception:
+            logger.error(f'Error submitting {doc.name}', exc_info=True)
+            frappe.db.rollback()
+
+    for future in as_completed(futures):
+        adf_doc = futures[future]
+        try:
+            if not _apply_response(adf_doc, future.result()):
+                count -= 1
+        except Exception:
+            logger.error(f'Error submitting {adf_doc.name}', exc_info=True)
+            frappe.db.rollback()
+    return count
+
+
+async def _submit_asynchronously(
+    additional_field_docs: list[dict],
+    client: httpx.AsyncClient,
+    limiter: '_AsyncCredentialLimiter',
+    concurrency: int,
+    deadline: Optional[float],
+) -> int:
+    """
+    Sends a batch of invoices to ZATCA using [client], with up to [concurrency] API calls in flight, until [deadline].
+    Everything runs on the current thread: invoices are prepared as there's room for them and responses are recorded
+    as they arrive, while the API calls wait on the network. Returns the number of invoices processed
+    """
+    batch = prefetch_batch([doc.name for doc in additional_field_docs])
+    count = 0
+
+    def prepare_submissions() -> Iterator[tuple[SalesInvoiceAdditionalFields, ZatcaSubmission]]:
+        nonlocal count
         for doc in additional_field_docs:
+            if _is_past(deadline):
+                return
+
+            count += 1
             try:
-                logger.info(f'{prefix}Submitting {doc.name}')
-                if dry_run:
+                logger.info(f'Submitting {doc.name}')
+                adf_doc, context = batch[doc.name]
+                submission = adf_doc.prepare_zatca_submission(context)
+                if is_err(submission):
+                    logger.info(f'{doc.name}: {submission.err_value}')
                     continue
-
-                adf_doc = cast(
-                    SalesInvoiceAdditionalFields, frappe.get_doc('Sales Invoice Additional Fields', doc.name)
-                )
-                result = adf_doc.submit_to_zatca()
-                message = result.ok_value if is_ok(result) else result.err_value
-                logger.info(f'{prefix}{doc.name}: {message}')
-                frappe.db.commit()
             except Exception:
-                logger.error(f'{prefix}Error submitting {doc.name}', exc_info=True)
+                logger.error(f'Error submitting {doc.name}', exc_info=True)
                 frappe.db.rollback()
+                continue
+
+            yield adf_doc, submission.ok_value
+
+    async def send(payload: tuple[SalesInvoiceAdditionalFields, ZatcaSubmission]):
+        return await limiter.send(client, payload[1], deadline)
+
+    async for (adf_doc, _submission), response in send_as_completed(prepare_submissions(), send, concurrency):
+        try:
+            if not _apply_response(adf_doc, response):
+                count -= 1
+        except Exception:
+            logger.error(f'Error submitting {adf_doc.name}', exc_info=True)
+            frappe.db.rollback()
+    return count
+
+
+def _apply_response(adf_doc: SalesInvoiceAdditionalFields, response: Optional[tuple]) -> bool:
+    """
+    Records the [response] to sending [adf_doc] and commits. Returns False if the invoice wasn't sent because the sync
+    ran out of time (no response)
+    """
+    if response is None:
+        logger.info(f'{adf_doc.name}: Not sent, the sync ran out of time')
+        return False
 
-    logger.info(f'{prefix}Sync Done')
+    if response[1] == CIRCUIT_OPEN_STATUS_CODE:
+        logger.info(f'{adf_doc.name}: Not sent, ZATCA is unavailable')
+        return True
 
+    message = adf_doc.apply_zatca_response(*response)
+    logger.info(f'{adf_doc.name}: {message}')
+    frappe.db.commit()
+    return True
 
-def build_query(check_date: Optional[datetime.datetime], limit: int) -> QueryBuilder:
-    batch_status = ['Ready For Batch', 'Resend', 'Corrected']
+
+class _CredentialLimiter:
+    """Limits the number of concurrent API calls per ZATCA server and security token"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.semaphores: dict[tuple[str, str], threading.Semaphore] = {}
+
+    def send(self, submission: ZatcaSubmission, deadline: Optional[float]):
+        """Sends [submission] once a slot is free, or returns None if [deadline] passed while waiting for one"""
+        key = (submission.server_url, submission.token)
+        with self.lock:
+            semaphore = self.semaphores.setdefault(key, threading.BoundedSemaphore(self.limit))
+        with semaphore:
+            if _is_past(deadline):
+                return None
+            return submission.send(deadline)
+
+
+class _AsyncCredentialLimiter:
+    """The asyncio counterpart of [_CredentialLimiter]"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.semaphores: dict[tuple[str, str], asyncio.Semaphore] = {}
+
+    async def send(self, client: httpx.AsyncClient, submission: ZatcaSubmission, deadline: Optional[float]):
+        key = (submission.server_url, submission.token)
+        semaphore = self.semaphores.setdefault(key, asyncio.Semaphore(self.limit))
+        async with semaphore:
+            if _is_past(deadline):
+                return None
+            return await submission.send_async(client, deadline)
+
+
+def build_query(check_date: Optional[datetime.datetime], limit: int, after_name: Optional[str] = None) -> QueryBuilder:
+    """
+    Returns a query for up to [limit] pending invoices created after [check_date], or after the invoice ([check_date],
+    [after_name]) if given, in (creation, name) order. The query is covered by [SYNC_QUEUE_INDEX]
+    """
     doctype = DocType('Sales Invoice Additional Fields')
     query = (
         frappe.qb.from_(doctype)
         .select(doctype.name, doctype.creation)
-        .where((doctype.integration_status.isin(batch_status)) & (doctype.docstatus == 0))
+        .where((doctype.integration_status.isin(PENDING_INTEGRATION_STATUSES)) & (doctype.docstatus == 0))
     )
-    if check_date:
+    if check_date and after_name:
+        # Spelled out rather than as a row comparison, which MariaDB doesn't use indexes for
+        query = query.where(
+            (doctype.creation > check_date) | ((doctype.creation == check_date) & (doctype.name > after_name))
+        )
+    elif check_date:
         query = query.where(doctype.creation > check_date)
-    query = query.orderby(doctype.creation, order=Order.asc).limit(limit)
+    query = query.orderby(doctype.creation, order=Order.asc).orderby(doctype.name, order=Order.asc).limit(limit)
     return query
@@ -0,0 +1,185 @@
+import pickle
+import statistics
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+import frappe
+from frappe.utils import now_datetime, nowdate
+from requests import Response
+
+from ksa_compliance import background_jobs, live_sync, zatca_api
+from ksa_compliance.fake_fatoora import FakeFatooraServer
+
+# MariaDB session counters for the statements that write to the database
+WRITE_COUNTERS = ('Com_insert', 'Com_update', 'Com_delete', 'Com_replace')
+
+# How often [create_invoices] reports its progress, in invoices
+PROGRESS_INTERVAL = 100
+
+
+@dataclass
+class BenchmarkReport:
+    invoices: int
+    elapsed: float
+    latencies: list[float]
+    db_writes: Optional[int]
+    integration_statuses: dict[str, int] = field(default_factory=dict)
+    response_status_codes: dict[int, int] = field(default_factory=dict)
+
+    @property
+    def throughput(self) -> float:
+        return self.invoices / self.elapsed if self.elapsed else 0
+
+    def format(self) -> str:
+        lines = [
+            f'Invoices:         {self.invoices}',
+            f'Elapsed:          {self.elapsed:.2f}s',
+            f'Throughput:       {self.throughput:.2f} invoices/s',
+        ]
+        if len(self.latencies) >= 2:
+            percentiles = statistics.quantiles(self.latencies, n=100, method='inclusive')
+            lines.append(
+                f'API latency:      p50 {percentiles[49] * 1000:.0f}ms, p95 {percentiles[94] * 1000:.0f}ms, '
+                f'p99 {percentiles[98] * 1000:.0f}ms ({len(self.latencies)} calls)'
+            )
+        if self.db_writes is not None and self.invoices:
+            lines.append(f'DB writes:        {self.db_writes / self.invoices:.1f} per invoice ({self.db_writes} total)')
+        if self.integration_statuses:
+            statuses = ', '.join(f'{status}: {count}' for status, count in sorted(self.integration_statuses.items()))
+            lines.append(f'Statuses:         {statuses}')
+        if self.response_status_codes:
+            codes = ', '.join(f'{code}: {count}' for code, count in sorted(self.response_status_codes.items()))
+            lines.append(f'Server responses: {codes}')
+        return '\n'.join(lines)
+
+
+@dataclass
+class JobPayloadReport:
+    siaf: str
+    document_bytes: int
+    document_seconds: float
+    name_bytes: int
+    name_seconds: float
+
+    def format(self) -> str:
+        return '\n'.join(
+            [
+                f'Job payload of {self.siaf} (pickled, as stored in Redis by RQ):',
+                f'  Document:         {self.document_bytes} bytes, {self.document_seconds * 1e6:.0f}us to serialize',
+                f'  Name:             {self.name_bytes} bytes, {self.name_seconds * 1e6:.0f}us to serialize',
+            ]
+        )
+
+
+def measure_job_payload(siaf_name: str, iterations: int = 1000) -> JobPayloadReport:
+    """
+    Compares the size and serialization time of the live sync job arguments when passing the document itself (as it
+    used to be) versus its name (see [live_sync.get_job_kwargs])
+    """
+    doc = frappe.get_doc('Sales Invoice Additional Fields', siaf_name)
+    document_bytes, document_seconds = _measure_pickle({'doc': doc}, iterations)
+    name_bytes, name_seconds = _measure_pickle(live_sync.get_job_kwargs(doc), iterations)
+    return JobPayloadReport(siaf_name, document_bytes, document_seconds, name_bytes, name_seconds)
+
+
+def _measure_pickle(kwargs: dict, iterations: int) -> tuple[int, float]:
+    """Returns the pickled size of [kwargs] and the average time to pickle them, using RQ's protocol"""
+    start = time.perf_counter()
+    for _i in range(iterations):
+        payload = pickle.dumps(kwargs, protocol=pickle.HIGHEST_PROTOCOL)
+    return len(payload), (time.perf_counter() - start) / iterations
+
+
+def create_invoices(
+    count: int,
+    company: str,
+    customer: str,
+    item: str,
+    taxes_and_charges: Optional[str] = None,
+    on_progress: Optional[Callable[[int], None]] = None,
+) -> None:
+    """
+    Creates and submits [count] sales invoices, which queues them for the sync job (batch mode). [on_progress] is
+    called with the number of invoices created so far, every [PROGRESS_INTERVAL] invoices
+    """
+    for index in range(count):
+        invoice = frappe.get_doc(
+            {
+                'doctype': 'Sales Invoice',
+                'company': company,
+                'customer': customer,
+                'posting_date': nowdate(),
+                'due_date': nowdate(),
+                'taxes_and_charges': taxes_and_charges,
+                'items': [{'item_code': item, 'qty': 1, 'rate': 100}],
+            }
+        )
+        if taxes_and_charges:
+            invoice.set_taxes()
+        invoice.insert()
+        invoice.submit()
+        frappe.db.commit()
+        if on_progress and (index + 1) % PROGRESS_INTERVAL == 0:
+            on_progress(index + 1)
+
+
+def run_benchmark(
+    server_url: str,
+    concurrency: Optional[int] = None,
+    batch_size: int = 100,
+    since: Optional[str] = None,
+    fake_server: Optional[FakeFatooraServer] = None,
+) -> BenchmarkReport:
+    """
+    Runs [background_jobs.sync_e_invoices] against [server_url] in the current process, limited to invoices created
+    after [since] (if given), and measures it. API latency is measured by the client if possible (blocking client), or
+    by [fake_server] otherwise
+    """
+    frappe.local.conf['zatca_fatoora_server_url'] = server_url
+    latencies: list[float] = []
+
+    def record_latency(response: Response, *args, **kwargs):
+        latencies.append(response.elapsed.total_seconds())
+
+    session = zatca_api.get_session(server_url)
+    session.hooks['response'].append(record_latency)
+    writes_before = _get_db_writes()
+    start = time.monotonic()
+    try:
+        count = background_jobs.sync_e_invoices(check_date=since, batch_size=batch_size, concurrency=concurrency)
+    finally:
+        elapsed = time.monotonic() - start
+        session.hooks['response'].remove(record_latency)
+
+    writes_after = _get_db_writes()
+    filters = {'creation': ['>', since]} if since else {}
+    statuses = frappe.get_all(
+        'Sales Invoice Additional Fields',
+        filters=filters,
+        fields=['integration_status', 'count(name) as count'],
+        group_by='integration_status',
+    )
+    return BenchmarkReport(
+        invoices=count,
+        elapsed=elapsed,
+        latencies=latencies or (fake_server.latencies if fake_server else []),
+        db_writes=writes_after - writes_before if writes_before is not None and writes_after is not None else None,
+        integration_statuses={row.integration_status: row.count for row in statuses},
+        response_status_codes=dict(fake_server.status_counts) if fake_server else {},
+    )
+
+
+def get_start_marker() -> str:
+    """Returns a marker for [run_benchmark] to only sync invoices created from now on"""
+    return str(now_datetime())
+
+
+def _get_db_writes() -> Optional[int]:
+    if frappe.db.db_type != 'mariadb':
+        return None
+
+    rows = frappe.db.sql(
+        'SHOW SESSION STATUS WHERE Variable_name IN %(counters)s', {'counters': WRITE_COUNTERS}, as_list=True
+    )
+    return sum(int(value) for _name, value in rows)
@@ -0,0 +1,217 @@
+import multiprocessing
+import os
+import zipfile
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Optional, cast
+
+import frappe
+from erpnext.accounts.doctype.sales_invoice.sales_invoice import SalesInvoice
+from frappe.core.doctype.file.file import File
+from frappe.query_builder import DocType
+from frappe.utils import get_url, now_datetime
+
+from ksa_compliance import logger, zatca_pdf
+from ksa_compliance.ksa_compliance.doctype.sales_invoice_additional_fields.sales_invoice_additional_fields import (
+    SalesInvoiceAdditionalFields,
+)
+from ksa_compliance.ksa_compliance.doctype.zatca_business_settings.zatca_business_settings import ZATCABusinessSettings
+from ksa_compliance.translation import ft
+from ksa_compliance.zatca_cli import convert_to_pdf_a3_b
+
+DEFAULT_PRINT_FORMAT = 'ZATCA Phase 2 Print Format'
+
+# The number of processes rendering print formats. Can be overridden using the 'zatca_bulk_pdf_workers' site config key
+DEFAULT_WORKERS = 4
+
+# How many rendered PDFs may be waiting for conversion per worker. This bounds memory use: at any point, we only hold
+# this many PDFs (plus the one being written to the archive) in memory
+PENDING_PDFS_PER_WORKER = 2
+
+
+@frappe.whitelist()
+def generate_bulk_pdfs(
+    company: str,
+    from_date: str,
+    to_date: str,
+    customer: Optional[str] = None,
+    print_format: str = DEFAULT_PRINT_FORMAT,
+    lang: str = 'en',
+) -> None:
+    """
+    Queues a job to generate PDF/A-3b files for the sales invoices of [company] between [from_date] and [to_date]
+    (optionally for [customer] only) into a single ZIP archive. Only invoices the current user may read are included.
+    Progress is reported to the current user
+    """
+    frappe.has_permission('Sales Invoice', 'print', throw=True)
+    frappe.enqueue(
+        'ksa_compliance.bulk_pdf.build_pdf_archive',
+        company=company,
+        from_date=from_date,
+        to_date=to_date,
+        customer=customer,
+        print_format=print_format,
+        lang=lang,
+        queue='long',
+        timeout=6 * 3600,
+        job_name='Bulk PDF/A-3b',
+    )
+    frappe.msgprint(ft('PDF/A-3b generation has been queued. You will be notified when the archive is ready'))
+
+
+def build_pdf_archive(
+    company: str, from_date: str, to_date: str, customer: Optional[str], print_format: str, lang: str
+) -> Optional[str]:
+    """
+    Generates PDF/A-3b files for the matching invoices into a ZIP archive, returning the URL of the resulting private
+    file. Print formats are rendered in a process pool while this process converts rendered PDFs through a single
+    long-lived CLI process and streams them into the archive
+    """
+    invoices = _get_invoices(company, from_date, to_date, customer)
+    if not invoices:
+        _report_progress(ft('No invoices found'), 100)
+        return None
+
+    settings = ZATCABusinessSettings.for_company(company)
+    if not settings:
+        _report_progress(ft('Could not find ZATCA Business Settings for company $company', company=company), 100)
+        return None
+
+    file_name = f'zatca-pdf-a3b-{frappe.scrub(company)}-{from_date}-{to_date}-{now_datetime():%Y%m%d%H%M%S}.zip'
+    archive_path = frappe.get_site_path('private', 'files', file_name)
+    errors = []
+    workers = int(frappe.conf.get('zatca_bulk_pdf_workers', DEFAULT_WORKERS))
+    logger.info(f'Generating PDF/A-3b for {len(invoices)} invoices using {workers} workers into {archive_path}')
+
+    with (
+        zipfile.ZipFile(archive_path, 'w', compression=zipfile.ZIP_DEFLATED) as archive,
+        ProcessPoolExecutor(
+            max_workers=workers,
+            # Forking a worker that holds a database connection is not safe, so we start fresh processes
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(frappe.local.site, os.path.abspath(frappe.local.sites_path), frappe.session.user),
+        ) as executor,
+    ):
+        pending: deque[tuple[dict, Optional[bytes], Optional[Future]]] = deque()
+        done = 0
+        for invoice in invoices:
+            cache_key = zatca_pdf.get_pdf_cache_key(
+                invoice.name, invoice.invoice_hash, invoice.invoice_modified, print_format, lang
+            )
+            cached = zatca_pdf.get_cached_pdf(invoice.name, cache_key) if cache_key else None
+            future = (
+                None if cached else executor.submit(_render_pdf, invoice.sales_invoice, company, print_format, lang)
+            )
+            pending.append((invoice, cached, future))
+
+            while len(pending) >= workers * PENDING_PDFS_PER_WORKER:
+                _write_next(archive, pending, settings, errors)
+                done += 1
+                _report_archive_progress(done, len(invoices))
+
+        while pending:
+            _write_next(archive, pending, settings, errors)
+            done += 1
+            _report_archive_progress(done, len(invoices))
+
+        if errors:
+            archive.writestr('errors.txt', '\n'.join(errors) + '\n')
+
+    file = cast(
+        File,
+        frappe.get_doc(
+            {
+                'doctype': 'File',
+                'file_name': file_name,
+                'file_url': f'/private/files/{file_name}',
+                'is_private': 1,
+            }
+        ),
+    )
+    file.insert(ignore_permissions=True)
+    frappe.db.commit()
+
+    message = ft(
+        'Generated $count PDF/A-3b files. <a href="$url">Download</a>',
+        count=len(invoices) - len(errors),
+        url=get_url(file.file_url),
+    )
+    if errors:
+        message += '<br>' + ft('$count invoices failed. See errors.txt in the archive', count=len(errors))
+    _report_progress(message, 100)
+    return file.file_url
+
+
+def _get_invoices(company: str, from_date: str, to_date: str, customer: Optional[str]) -> list[dict]:
+    """
+    Returns the latest additional fields of the matching invoices. Invoices are looked up through [frappe.get_list] as
+    the user who queued the job, so that the archive only includes invoices they may read (e.g. user permissions on
+    company or customer)
+    """
+    filters = {'company': company, 'posting_date': ['between', [from_date, to_date]]}
+    if customer:
+        filters['customer'] = customer
+    names = frappe.get_list('Sales Invoice', filters=filters, pluck='name', limit_page_length=0)
+    if not names:
+        return []
+
+    siaf = DocType('Sales Invoice Additional Fields')
+    invoice = DocType('Sales Invoice')
+    query = (
+        frappe.qb.from_(siaf)
+        .inner_join(invoice)
+        .on(invoice.name == siaf.sales_invoice)
+        .select(siaf.name, siaf.sales_invoice, siaf.invoice_hash, invoice.modified.as_('invoice_modified'))
+        .where((siaf.invoice_doctype == 'Sales Invoice') & (siaf.is_latest == 1) & (invoice.name.isin(names)))
+        .orderby(invoice.posting_date)
+        .orderby(invoice.name)
+    )
+    return query.run(as_dict=True)
+
+
+def _write_next(
+    archive: zipfile.ZipFile,
+    pending: deque[tuple[dict, Optional[bytes], Optional[Future]]],
+    settings: ZATCABusinessSettings,
+    errors: list[str],
+) -> None:
+    """Converts the oldest pending PDF and writes it to [archive]. Failures are recorded in [errors]"""
+    invoice, content, future = pending.popleft()
+    try:
+        if content is None:
+            pdf = cast(Future, future).result()
+            siaf = cast(SalesInvoiceAdditionalFields, frappe.get_doc('Sales Invoice Additional Fields', invoice.name))
+            xml = siaf.get_signed_xml()
+            content = convert_to_pdf_a3_b(
+                settings.zatca_cli_path, settings.java_home, invoice.sales_invoice, pdf, xml, persistent=True
+            )
+        archive.writestr(f'{invoice.sales_invoice}_a3b.pdf', content)
+    except Exception as e:
+        logger.error(f'Could not generate PDF/A-3b for {invoice.sales_invoice}', exc_info=e)
+        errors.append(f'{invoice.sales_invoice}: {e}')
+
+
+def _init_worker(site: str, sites_path: str, user: str) -> None:
+    frappe.init(site=site, sites_path=sites_path)
+    frappe.connect()
+    frappe.set_user(user)
+
+
+def _render_pdf(sales_invoice_id: str, company: str, print_format: str, lang: str) -> bytes:
+    sales_invoice_doc = cast(SalesInvoice, frappe.get_doc('Sales Invoice', sales_invoice_id))
+    try:
+        return zatca_pdf.render_invoice_pdf(sales_invoice_doc, company, print_format, lang)
+    finally:
+        # Rendering is read-only, so we make sure nothing leaks into the next invoice
+        frappe.db.rollback()
+
+
+def _report_archive_progress(done: int, total: int) -> None:
+    # Reporting every single invoice floods the browser with realtime messages for large archives
+    if done % max(1, total // 100) == 0 or done == total:
+        _report_progress(ft('Generated $done of $total', done=done, total=total), done, total)
+
+
+def _report_progress(description: str, done: float, total: float = 100) -> None:
+    frappe.publish_progress(title=ft('Bulk PDF/A-3b'), description=description, percent=done * 100 / total)
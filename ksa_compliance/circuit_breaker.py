@@ -0,0 +1,137 @@
+import time
+from dataclasses import dataclass
+from typing import Literal
+
+import frappe
+from redis.commands.core import Script
+from redis.exceptions import RedisError
+
+from ksa_compliance import logger
+
+# The number of consecutive failed calls to a ZATCA server that opens its circuit
+FAILURE_THRESHOLD = 5
+
+# How long an open circuit short-circuits calls before letting a single probe call through
+OPEN_SECONDS = 60
+
+# How long the probe call may take before another one is allowed. This is longer than any of the API timeouts
+PROBE_SECONDS = 180
+
+# Consecutive failures are forgotten after this long without another failure
+FAILURE_WINDOW_SECONDS = 600
+
+CircuitState = Literal['Closed', 'Open', 'Half-Open']
+
+# Circuit state is shared by all sites and workers, since an outage affects everyone calling the same server. The hash
+# holds the number of consecutive failures and, while open, the time until which calls are short-circuited. The probe
+# key is held by the single call allowed through once that time passes (half-open)
+_ALLOW_SCRIPT = """
+local open_until = tonumber(redis.call('HGET', KEYS[1], 'open_until') or '0')
+if open_until == 0 then
+    return 'closed'
+end
+if tonumber(ARGV[1]) < open_until then
+    return 'open'
+end
+if redis.call('SET', KEYS[2], '1', 'NX', 'EX', ARGV[2]) then
+    return 'probe'
+end
+return 'open'
+"""
+
+_FAILURE_SCRIPT = """
+local failures = redis.call('HINCRBY', KEYS[1], 'failures', 1)
+local open_until = tonumber(redis.call('HGET', KEYS[1], 'open_until') or '0')
+if failures >= tonumber(ARGV[2]) or open_until > 0 then
+    redis.call('HSET', KEYS[1], 'open_until', tostring(tonumber(ARGV[1]) + tonumber(ARGV[3])))
+    redis.call('DEL', KEYS[2])
+    redis.call('EXPIRE', KEYS[1], 86400)
+    return open_until == 0 and 1 or 0
+end
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return 0
+"""
+
+_SUCCESS_SCRIPT = """
+local was_open = redis.call('HEXISTS', KEYS[1], 'open_until')
+redis.call('DEL', KEYS[1], KEYS[2])
+return was_open
+"""
+
+_scripts: dict[str, Script] = {}
+
+
+class CircuitOpenError(Exception):
+    """Used as the error of calls short-circuited because the server is down"""
+
+    def __init__(self, server: str):
+        super().__init__(f'{server} is unavailable. Calls are paused until it recovers')
+
+
+@dataclass
+class CircuitStatus:
+    state: CircuitState
+    failures: int
+    retry_in: float
+
+
+def allow_call(server: str) -> bool:
+    """
+    Returns whether a call to [server] may be made. Calls are always allowed while the circuit is closed. Once it's
+    open, only a single probe call is allowed after [OPEN_SECONDS]; its outcome closes the circuit or keeps it open.
+    If Redis is unavailable, calls are always allowed
+    """
+    try:
+        state = _run(_ALLOW_SCRIPT, server, [time.time(), PROBE_SECONDS])
+    except RedisError as e:
+        logger.warning(f'Could not check the ZATCA circuit breaker, continuing without it: {e}')
+        return True
+
+    if state == b'probe':
+        logger.info(f'Probing {server} to check if ZATCA is back')
+    return state != b'open'
+
+
+def record_failure(server: str) -> None:
+    try:
+        opened = _run(_FAILURE_SCRIPT, server, [time.time(), FAILURE_THRESHOLD, OPEN_SECONDS, FAILURE_WINDOW_SECONDS])
+    except RedisError as e:
+        logger.warning(f'Could not record a ZATCA failure in the circuit breaker: {e}')
+        return
+
+    if opened:
+        logger.warning(f'{server} failed {FAILURE_THRESHOLD} times in a row. Pausing calls for {OPEN_SECONDS}s')
+
+
+def record_success(server: str) -> None:
+    try:
+        if _run(_SUCCESS_SCRIPT, server, []):
+            logger.info(f'{server} is reachable again')
+    except RedisError as e:
+        logger.warning(f'Could not record a ZATCA success in the circuit breaker: {e}')
+
+
+def get_status(server: str) -> CircuitStatus:
+    """Returns the circuit state of [server] for display"""
+    failures, open_until = frappe.cache.hmget(_get_key(server), ['failures', 'open_until'])
+    failures = int(failures or 0)
+    if not open_until:
+        return CircuitStatus('Closed', failures, 0)
+
+    retry_in = float(open_until) - time.time()
+    if retry_in > 0:
+        return CircuitStatus('Open', failures, retry_in)
+    return CircuitStatus('Half-Open', failures, 0)
+
+
+def _run(source: str, server: str, args: list):
+    script = _scripts.get(source)
+    if script is None:
+        script = _scripts[source] = frappe.cache.register_script(source)
+
+    key = _get_key(server)
+    return script(keys=[key, f'{key}:probe'], args=args)
+
+
+def _get_key(server: str) -> str:
+    return f'ksa_compliance:circuit_breaker:{server}'
@@ -0,0 +1,135 @@
+import click
+import frappe
+from frappe.commands import get_site, pass_context
+
+from ksa_compliance.fake_fatoora import ERROR_STATUS_CODES, FakeFatooraConfig, FakeFatooraServer, parse_error_rates
+
+
+def fake_server_options(command):
+    """Options describing how the fake Fatoora server behaves (see [FakeFatooraConfig])"""
+    options = [
+        click.option('--latency-ms', type=float, default=100, help='Mean response time in milliseconds'),
+        click.option(
+            '--latency-distribution',
+            type=click.Choice(['fixed', 'uniform', 'exponential', 'lognormal']),
+            default='lognormal',
+        ),
+        click.option('--latency-spread', type=float, default=0.5, help='Sigma for lognormal, +/- fraction for uniform'),
+        click.option(
+            '--error-rate',
+            'error_rates',
+            multiple=True,
+            help=f'Fraction of invoice calls failing with a status code, e.g. 429=0.05. One of {ERROR_STATUS_CODES}',
+        ),
+        click.option('--duplicate-rate', type=float, default=0, help='Fraction of invoices answered with 208'),
+        click.option('--warning-rate', type=float, default=0, help='Fraction of invoices accepted with warnings'),
+        click.option(
+            '--legacy-shape-rate', type=float, default=0, help='Fraction of responses using the swagger shape'
+        ),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+def _make_config(
+    latency_ms, latency_distribution, latency_spread, error_rates, duplicate_rate, warning_rate, legacy_shape_rate
+) -> FakeFatooraConfig:
+    return FakeFatooraConfig(
+        latency_ms=latency_ms,
+        latency_distribution=latency_distribution,
+        latency_spread=latency_spread,
+        error_rates=parse_error_rates(list(error_rates)),
+        duplicate_rate=duplicate_rate,
+        warning_rate=warning_rate,
+        legacy_shape_rate=legacy_shape_rate,
+    )
+
+
+@click.command('zatca-fake-server')
+@click.option('--host', default='127.0.0.1')
+@click.option('--port', type=int, default=8765)
+@fake_server_options
+def zatca_fake_server(host, port, **kwargs):
+    """Runs a fake ZATCA (Fatoora) server for load testing. Point sites at it using 'zatca_fatoora_server_url'"""
+    server = FakeFatooraServer(_make_config(**kwargs), host, port)
+    click.echo(f'Fake Fatoora server listening on {server.url}')
+    try:
+        server.http_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.http_server.server_close()
+
+
+@click.command('zatca-benchmark')
+@click.option('--server-url', help='Use an already running (fake) server instead of starting one')
+@click.option('--invoices', type=int, default=0, help='Create and sync this many sales invoices (0 syncs pending ones)')
+@click.option('--company', help='Company of the created invoices')
+@click.option('--customer', help='Customer of the created invoices')
+@click.option('--item', help='Item of the created invoices')
+@click.option('--taxes-and-charges', help='Sales Taxes and Charges Template of the created invoices')
+@click.option('--concurrency', type=int, help="Defaults to the 'zatca_sync_concurrency' site config key")
+@click.option('--batch-size', type=int, default=100)
+@fake_server_options
+@pass_context
+def zatca_benchmark(
+    context, server_url, invoices, company, customer, item, taxes_and_charges, concurrency, batch_size, **kwargs
+):
+    """
+    Measures the sync job against a fake ZATCA server: throughput, API latency percentiles and database writes per
+    invoice. The site's ZATCA Business Settings must use batch sync and be onboarded (onboarding works against the fake
+    server too)
+    """
+    from ksa_compliance import benchmark
+
+    if invoices and not (company and customer and item):
+        raise click.UsageError('--company, --customer and --item are required to create invoices')
+
+    site = get_site(context)
+    frappe.init(site=site)
+    frappe.connect()
+    fake_server = None
+    try:
+        if not server_url:
+            fake_server = FakeFatooraServer(_make_config(**kwargs)).start()
+            server_url = fake_server.url
+            click.echo(f'Started a fake Fatoora server on {server_url}')
+
+        since = None
+        if invoices:
+            since = benchmark.get_start_marker()
+            benchmark.create_invoices(
+                invoices,
+                company,
+                customer,
+                item,
+                taxes_and_charges,
+                on_progress=lambda created: click.echo(f'Created {created} of {invoices} invoices'),
+            )
+
+        report = benchmark.run_benchmark(server_url, concurrency, batch_size, since, fake_server)
+        click.echo(report.format())
+    finally:
+        if fake_server:
+            fake_server.stop()
+        frappe.destroy()
+
+
+@click.command('zatca-benchmark-job-payload')
+@click.argument('siaf')
+@click.option('--iterations', type=int, default=1000)
+@pass_context
+def zatca_benchmark_job_payload(context, siaf, iterations):
+    """Compares the Redis payload of live sync jobs passing a Sales Invoice Additional Fields document vs. its name"""
+    from ksa_compliance import benchmark
+
+    frappe.init(site=get_site(context))
+    frappe.connect()
+    try:
+        click.echo(benchmark.measure_job_payload(siaf, iterations).format())
+    finally:
+        frappe.destroy()
+
+
+commands = [zatca_fake_server, zatca_benchmark, zatca_benchmark_job_payload]
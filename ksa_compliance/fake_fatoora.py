@@ -0,0 +1,334 @@
+import base64
+import datetime
+import json
+import math
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Literal, Optional
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+LatencyDistribution = Literal['fixed', 'uniform', 'exponential', 'lognormal']
+
+# Error responses the fake server can be configured to return, and the bodies it returns for them
+ERROR_STATUS_CODES = (400, 429, 500, 503)
+
+
+@dataclass
+class FakeFatooraConfig:
+    """
+    How the fake server behaves. Latency is drawn from [latency_distribution] with a mean of [latency_ms] and a spread
+    of [latency_spread] (the sigma of lognormal, or the +/- fraction of uniform). [error_rates] maps status codes in
+    [ERROR_STATUS_CODES] to the fraction of invoice calls that fail with them. Invoices sent twice get 208 (duplicate),
+    and [duplicate_rate] makes some first-time invoices look like duplicates too. [warning_rate] is the fraction of
+    accepted invoices that get warnings (202), and [legacy_shape_rate] the fraction of responses that use the shape from
+    ZATCA's swagger documentation rather than the one the gateway actually returns (both are handled by
+    [ReportOrClearInvoiceResult.from_json])
+    """
+
+    latency_ms: float = 100
+    latency_distribution: LatencyDistribution = 'lognormal'
+    latency_spread: float = 0.5
+    error_rates: dict[int, float] = field(default_factory=dict)
+    duplicate_rate: float = 0
+    warning_rate: float = 0
+    legacy_shape_rate: float = 0
+    retry_after_seconds: int = 1
+
+    def get_latency(self) -> float:
+        """Returns a latency in seconds"""
+        mean = self.latency_ms / 1000
+        if mean <= 0:
+            return 0
+        if self.latency_distribution == 'uniform':
+            return random.uniform(mean * (1 - self.latency_spread), mean * (1 + self.latency_spread))
+        if self.latency_distribution == 'exponential':
+            return random.expovariate(1 / mean)
+        if self.latency_distribution == 'lognormal':
+            # mu is chosen so that the mean of the distribution is [mean] regardless of the spread
+            return random.lognormvariate(math.log(mean) - self.latency_spread**2 / 2, self.latency_spread)
+        return mean
+
+
+class FakeFatooraServer:
+    """
+    A local stand-in for the ZATCA (Fatoora) API, for load testing. It serves the compliance and production CSID,
+    compliance invoice, reporting and clearance endpoints with realistic payloads. CSIDs are real certificates for the
+    public key in the CSR, issued by a throwaway CA, so invoices can be signed with them.
+
+    Point a site at it using the 'zatca_fatoora_server_url' site config key
+    """
+
+    def __init__(self, config: FakeFatooraConfig, host: str = '127.0.0.1', port: int = 0):
+        self.config = config
+        self.lock = threading.Lock()
+        self.seen_invoices: set[str] = set()
+        self.compliance_requests: dict[str, x509.CertificateSigningRequest] = {}
+        # Response status codes and times (in seconds) of the requests served so far
+        self.status_counts: dict[int, int] = {}
+        self.latencies: list[float] = []
+        self.ca_key = ec.generate_private_key(ec.SECP256K1())
+        self.ca_name = x509.Name(
+            [
+                x509.NameAttribute(NameOID.COMMON_NAME, 'Fake Fatoora CA'),
+                x509.NameAttribute(NameOID.COUNTRY_NAME, 'SA'),
+            ]
+        )
+        self.http_server = _HttpServer((host, port), _make_handler(self))
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.http_server.server_address[:2]
+        return f'http://{host}:{port}/e-invoicing/core/'
+
+    def start(self) -> 'FakeFatooraServer':
+        """Serves requests on a background thread"""
+        self.thread = threading.Thread(target=self.http_server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.http_server.shutdown()
+        self.http_server.server_close()
+
+    def handle(self, path: str, headers: dict[str, str], body: dict) -> tuple[int, dict[str, str], bytes]:
+        """Returns the (status code, headers, body) of the response to a POST to [path]"""
+        start = time.monotonic()
+        time.sleep(self.config.get_latency())
+        path = path.rstrip('/')
+        if path.endswith('/compliance'):
+            response = self._issue_compliance_csid(headers, body)
+        elif path.endswith('/production/csids'):
+            response = self._issue_production_csid(body)
+        elif path.endswith('/invoices/reporting/single'):
+            response = self._handle_invoice(body, clearance=False)
+        elif path.endswith('/invoices/clearance/single'):
+            response = self._handle_invoice(body, clearance=True)
+        elif path.endswith('/compliance/invoices'):
+            response = self._handle_invoice(body, clearance=headers.get('clearance-status') == '1', compliance=True)
+        else:
+            response = 404, {}, json.dumps({'message': f'Unknown path {path}'}).encode()
+
+        with self.lock:
+            self.status_counts[response[0]] = self.status_counts.get(response[0], 0) + 1
+            self.latencies.append(time.monotonic() - start)
+        return response
+
+    def _issue_compliance_csid(self, headers: dict[str, str], body: dict) -> tuple[int, dict[str, str], bytes]:
+        if not headers.get('otp'):
+            return _json_response(400, {'errors': [{'code': 'Missing-OTP', 'message': 'OTP is required'}]})
+
+        try:
+            csr = _load_csr(body.get('csr', ''))
+        except ValueError as e:
+            return _json_response(400, {'errors': [{'code': 'Invalid-CSR', 'message': str(e)}]})
+
+        request_id = str(random.randint(10**12, 10**13 - 1))
+        with self.lock:
+            self.compliance_requests[request_id] = csr
+        return _json_response(200, self._csid_response(csr, request_id))
+
+    def _issue_production_csid(self, body: dict) -> tuple[int, dict[str, str], bytes]:
+        request_id = str(body.get('compliance_request_id', ''))
+        with self.lock:
+            csr = self.compliance_requests.get(request_id)
+        if not csr:
+            return _json_response(400, {'errors': [{'code': 'Invalid-Request-ID', 'message': 'Unknown request ID'}]})
+        return _json_response(200, self._csid_response(csr, str(random.randint(10**12, 10**13 - 1))))
+
+    def _csid_response(self, csr: x509.CertificateSigningRequest, request_id: str) -> dict:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        certificate = (
+            x509.CertificateBuilder()
+            .subject_name(csr.subject)
+            .issuer_name(self.ca_name)
+            .public_key(csr.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + datetime.timedelta(days=365))
+            .sign(self.ca_key, hashes.SHA256())
+        )
+        # ZATCA's security token is the base64 of the base64 of the DER certificate
+        der = certificate.public_bytes(serialization.Encoding.DER)
+        return {
+            'requestID': request_id,
+            'tokenType': 'http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-x509-token-profile-1.0#X509v3',
+            'dispositionMessage': 'ISSUED',
+            'binarySecurityToken': base64.b64encode(base64.b64encode(der)).decode(),
+            'secret': base64.b64encode(random.randbytes(32)).decode(),
+            'errors': None,
+        }
+
+    def _handle_invoice(
+        self, body: dict, clearance: bool, compliance: bool = False
+    ) -> tuple[int, dict[str, str], bytes]:
+        status_key = 'clearanceStatus' if clearance else 'reportingStatus'
+        rejected_status = 'NOT_CLEARED' if clearance else 'NOT_REPORTED'
+        invoice_uuid = body.get('uuid', '')
+        if not body.get('invoice') or not body.get('invoiceHash') or not invoice_uuid:
+            return _json_response(400, _validation_response(status_key, rejected_status, errors=[_MISSING_FIELDS]))
+
+        roll = random.random()
+        for status_code, rate in self.config.error_rates.items():
+            if roll < rate:
+                return self._error_response(status_code, status_key, rejected_status)
+            roll -= rate
+
+        with self.lock:
+            duplicate = invoice_uuid in self.seen_invoices
+            if not compliance:
+                self.seen_invoices.add(invoice_uuid)
+
+        accepted_status = 'CLEARED' if clearance else 'REPORTED'
+        if duplicate or random.random() < self.config.duplicate_rate:
+            return _json_response(208, _validation_response(status_key, accepted_status, warnings=[_DUPLICATE_WARNING]))
+
+        warnings = [_ROUNDING_WARNING] if random.random() < self.config.warning_rate else []
+        status_code = 202 if warnings else 200
+        if random.random() < self.config.legacy_shape_rate:
+            data = {
+                'invoiceHash': body['invoiceHash'],
+                'status': accepted_status,
+                'warnings': warnings or None,
+                'errors': [],
+            }
+        else:
+            data = _validation_response(status_key, accepted_status, warnings=warnings)
+        if clearance:
+            # The real gateway returns the invoice with its stamp and QR code. The submitted invoice is close enough
+            data['clearedInvoice'] = body['invoice']
+        return _json_response(status_code, data)
+
+    def _error_response(
+        self, status_code: int, status_key: str, rejected_status: str
+    ) -> tuple[int, dict[str, str], bytes]:
+        if status_code == 400:
+            return _json_response(400, _validation_response(status_key, rejected_status, errors=[_BUILDING_NUMBER]))
+        if status_code == 429:
+            response = _json_response(429, {'message': 'Too Many Requests'})
+            response[1]['Retry-After'] = str(self.config.retry_after_seconds)
+            return response
+        if status_code == 500:
+            return _json_response(500, {'code': 'Internal Server Error', 'message': 'Something went wrong'})
+        return status_code, {'Content-Type': 'text/html'}, b'<html><body>Service Unavailable</body></html>'
+
+
+_PASS_MESSAGE = {
+    'type': 'INFO',
+    'code': 'XSD_ZATCA_VALID',
+    'category': 'XSD validation',
+    'message': 'Complied with UBL 2.1 standards in line with ZATCA specifications',
+    'status': 'PASS',
+}
+_ROUNDING_WARNING = {
+    'type': 'WARNING',
+    'code': 'BR-KSA-F-06',
+    'category': 'KSA',
+    'message': 'The allowed maximum number of decimals for the Invoice line net amount (BT-131) is 2.',
+    'status': 'WARNING',
+}
+_DUPLICATE_WARNING = {
+    'type': 'WARNING',
+    'code': 'Invoice-Duplicate',
+    'category': 'Duplicate',
+    'message': 'The invoice has already been submitted',
+    'status': 'WARNING',
+}
+_BUILDING_NUMBER = {
+    'type': 'ERROR',
+    'code': 'BR-KSA-37',
+    'category': 'KSA',
+    'message': 'The seller address building number must contain 4 digits.',
+    'status': 'ERROR',
+}
+_MISSING_FIELDS = {
+    'type': 'ERROR',
+    'code': 'Invalid-Request',
+    'category': 'Request',
+    'message': 'invoice, invoiceHash and uuid are required',
+    'status': 'ERROR',
+}
+
+
+def _validation_response(status_key: str, status: str, warnings=None, errors=None) -> dict:
+    if errors:
+        validation_status = 'ERROR'
+    elif warnings:
+        validation_status = 'WARNING'
+    else:
+        validation_status = 'PASS'
+    return {
+        'validationResults': {
+            'infoMessages': [_PASS_MESSAGE],
+            'warningMessages': warnings or [],
+            'errorMessages': errors or [],
+            'status': validation_status,
+        },
+        status_key: status,
+    }
+
+
+def _json_response(status_code: int, data: dict) -> tuple[int, dict[str, str], bytes]:
+    return status_code, {'Content-Type': 'application/json'}, json.dumps(data).encode()
+
+
+def _load_csr(value: str) -> x509.CertificateSigningRequest:
+    """Loads a CSR sent as PEM, or as base64 of PEM (which is what ZATCA expects)"""
+    data = value.encode()
+    if b'BEGIN CERTIFICATE REQUEST' not in data:
+        try:
+            data = base64.b64decode(data)
+        except ValueError:
+            raise ValueError('CSR is not valid base64')
+    return x509.load_pem_x509_csr(data)
+
+
+class _HttpServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 drops connections under the load this server is meant for
+    request_queue_size = 1024
+
+
+def _make_handler(server: FakeFatooraServer) -> type[BaseHTTPRequestHandler]:
+    class Handler(BaseHTTPRequestHandler):
+        # Keep-alive, like the real gateway
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            try:
+                body = json.loads(self.rfile.read(length) or b'{}')
+            except ValueError:
+                body = {}
+
+            headers = {key.lower(): value for key, value in self.headers.items()}
+            status_code, response_headers, content = server.handle(self.path, headers, body)
+            self.send_response(status_code)
+            for key, value in response_headers.items():
+                self.send_header(key, value)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def parse_error_rates(values: list[str]) -> dict[int, float]:
+    """Parses error rates given as 'status=rate' (e.g. '429=0.05')"""
+    rates = {}
+    for value in values:
+        status_code, _sep, rate = value.partition('=')
+        if int(status_code) not in ERROR_STATUS_CODES:
+            raise ValueError(f'Unsupported status code {status_code}. Use one of {ERROR_STATUS_CODES}')
+        rates[int(status_code)] = float(rate)
+    return rates
@@ -180,7 +180,12 @@ doc_events = {
 # Scheduled Tasks
 # ---------------
 
-scheduler_events = {'hourly_long': ['ksa_compliance.background_jobs.sync_e_invoices']}
+scheduler_events = {
+    'all': ['ksa_compliance.metrics.write_prometheus_textfile'],
+    'hourly': ['ksa_compliance.metrics.flush_metrics'],
+    'hourly_long': ['ksa_compliance.background_jobs.sync_e_invoices'],
+    'daily': ['ksa_compliance.zatca_pdf.evict_pdf_cache'],
+}
 # "all": [
 # "ksa_compliance.tasks.all"
 # ],
@@ -0,0 +1,14 @@
+frappe.provide('frappe.dashboards.chart_sources');
+
+frappe.dashboards.chart_sources['ZATCA Stage Latency'] = {
+    method: 'ksa_compliance.ksa_compliance.dashboard_chart_source.zatca_stage_latency.zatca_stage_latency.get',
+    filters: [
+        {
+            fieldname: 'percentile',
+            label: __('Percentile'),
+            fieldtype: 'Select',
+            options: ['50', '95', '99'],
+            default: '95',
+        },
+    ],
+};
@@ -0,0 +1,57 @@
+import bisect
+import json
+
+import frappe
+from frappe.utils import add_days, cint, getdate
+from frappe.utils.dashboard import cache_source
+from frappe.utils.dateutils import get_dates_from_timegrain, get_from_date_from_timespan, get_period
+
+from ksa_compliance.metrics import STAGES, Histogram
+
+
+@frappe.whitelist()
+@cache_source
+def get(
+    chart_name=None,
+    chart=None,
+    no_cache=None,
+    filters=None,
+    from_date=None,
+    to_date=None,
+    timespan=None,
+    time_interval=None,
+    heatmap_year=None,
+) -> dict:
+    """Returns a percentile (95 by default) of each stage's duration in milliseconds, per period, from ZATCA Metrics"""
+    filters = frappe.parse_json(filters) or {}
+    percentile = cint(filters.get('percentile')) or 95
+    time_interval = time_interval or 'Daily'
+    to_date = getdate(to_date)
+    from_date = getdate(from_date) if from_date else get_from_date_from_timespan(to_date, timespan or 'Last Month')
+    period_ends = get_dates_from_timegrain(from_date, to_date, time_interval)
+
+    rows = frappe.get_all(
+        'ZATCA Metrics',
+        filters=[['period_start', '>=', from_date], ['period_start', '<', add_days(to_date, 1)]],
+        fields=['period_start', 'stage', 'buckets', 'total_seconds'],
+    )
+    # Hourly histograms are merged per period and stage, which gives exact bucket counts for the period
+    histograms: dict[tuple[int, str], Histogram] = {}
+    for row in rows:
+        period = bisect.bisect_left(period_ends, getdate(row.period_start))
+        if period < len(period_ends):
+            histogram = histograms.setdefault((period, row.stage), Histogram.empty())
+            histogram.merge(Histogram(json.loads(row.buckets), row.total_seconds))
+
+    datasets = []
+    for stage in STAGES:
+        if not any(key[1] == stage for key in histograms):
+            continue
+
+        values = []
+        for period in range(len(period_ends)):
+            histogram = histograms.get((period, stage))
+            values.append(round(histogram.get_percentile(percentile / 100) * 1000) if histogram else 0)
+        datasets.append({'name': stage, 'values': values})
+
+    return {'labels': [get_period(date, time_interval) for date in period_ends], 'datasets': datasets}
@@ -10,6 +10,9 @@ frappe.ui.form.on('Sales Invoice Additional Fields', {
 		) {
 			frm.add_custom_button(__('Fix Rejection'), () => fix_rejection(frm), null, 'primary');
 		}
+		if (!frm.doc.precomputed && frappe.user.has_role('System Manager')) {
+			frm.add_custom_button(__('Profile XML Generation'), () => profile_xml_generation(frm), __('Debug'));
+		}
 	},
 	download_xml: function (frm) {
 		window.open(
@@ -85,3 +88,20 @@ async function fix_rejection(frm) {
 		() => {},
 	);
 }
+
+async function profile_xml_generation(frm) {
+	let { message: file_url } = await frappe.call({
+		freeze: true,
+		freeze_message: __('Profiling...'),
+		method: 'ksa_compliance.ksa_compliance.doctype.sales_invoice_additional_fields.sales_invoice_additional_fields.profile_xml_generation',
+		args: {
+			id: frm.doc.name,
+		},
+	});
+	frm.reload_doc();
+	frappe.msgprint(
+		__('The profile was attached to this document: {0}', [
+			`<a target="_blank" href="${file_url}">${file_url.split('/').pop()}</a>`,
+		]),
+	);
+}
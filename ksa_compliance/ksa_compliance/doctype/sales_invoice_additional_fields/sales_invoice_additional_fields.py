@@ -3,13 +3,19 @@
 from __future__ import annotations
 
 import base64
+import cProfile
 import html
+import io
+import pstats
+import time
 import uuid
+from contextlib import nullcontext
 from io import BytesIO
-from typing import cast, Optional, Literal
+from dataclasses import dataclass
+from typing import cast, Optional, Literal, Tuple
 from ksa_compliance import SALES_INVOICE_CODE, DEBIT_NOTE_CODE, CREDIT_NOTE_CODE, PREPAYMENT_INVOICE_CODE
 import frappe
-import frappe.utils.background_jobs
+import httpx
 import pyqrcode
 from erpnext.accounts.doctype.pos_invoice.pos_invoice import POSInvoice
 from erpnext.accounts.doctype.sales_invoice.sales_invoice import SalesInvoice
@@ -19,16 +25,15 @@ from frappe import _
 from frappe.contacts.doctype.address.address import Address
 from frappe.core.doctype.file.file import File
 from frappe.model.document import Document
-from frappe.translate import print_language
 from frappe.utils import now_datetime, get_link_to_form, strip, get_url
-from frappe.utils.pdf import get_file_data_from_writer
-from pypdf import PdfWriter
-from result import is_err, Result, Err, Ok, is_ok
+from result import is_err, Result, Err, Ok
 
-from ksa_compliance import logger
+from ksa_compliance import logger, metrics
 from ksa_compliance import zatca_api as api
-from ksa_compliance import zatca_cli as cli
+from ksa_compliance import zatca_async_api as async_api
+from ksa_compliance import zatca_pdf
 from ksa_compliance.generate_xml import generate_xml_file
+from ksa_compliance.live_sync import queue_for_live_sync, submit_additional_fields
 from ksa_compliance.invoice import InvoiceMode, InvoiceType
 from ksa_compliance.ksa_compliance.doctype.zatca_business_settings.zatca_business_settings import ZATCABusinessSettings
 from ksa_compliance.ksa_compliance.doctype.zatca_egs.zatca_egs import ZATCAEGS
@@ -37,10 +42,12 @@ from ksa_compliance.ksa_compliance.doctype.zatca_precomputed_invoice.zatca_preco
     ZATCAPrecomputedInvoice,
 )
 from ksa_compliance.output_models.e_invoice_output_model import Einvoice
+from ksa_compliance.metrics import StageMetrics
+from ksa_compliance.rate_limit import RateLimiter
 from ksa_compliance.translation import ft
 from ksa_compliance.throw import fthrow
 from ksa_compliance.zatca_api import ReportOrClearInvoiceError, ReportOrClearInvoiceResult, ZatcaSendMode
-from ksa_compliance.zatca_cli import convert_to_pdf_a3_b, check_pdfa3b_support_or_throw
+from ksa_compliance.zatca_cli import SigningResult, convert_to_pdf_a3_b, check_pdfa3b_support_or_throw
 
 # These are the possible statuses resulting from a submission to ZATCA. Note that this is a subset of
 # [SalesInvoiceAdditionalFields.integration_status]
@@ -48,6 +55,92 @@ ZatcaIntegrationStatus = Literal[
     'Resend', 'Accepted with warnings', 'Accepted', 'Rejected', 'Clearance switched off', 'Duplicate'
 ]
 
+# The number of functions listed in the reports of [SalesInvoiceAdditionalFields.profile_xml_generation]
+PROFILE_FUNCTION_LIMIT = 150
+
+# The index used by the sync job to find pending invoices (see [background_jobs.build_query]). The columns match its
+# filters, followed by its (creation, name) cursor
+SYNC_QUEUE_INDEX = 'lava_sales_invoice_additional_fields_sync_queue'
+SYNC_QUEUE_INDEX_COLUMNS = ['docstatus', 'integration_status', 'creation', 'name']
+
+
+@dataclass
+class ZatcaSubmission:
+    """An invoice ready to be sent to ZATCA (see [SalesInvoiceAdditionalFields.prepare_zatca_submission])"""
+
+    invoice_xml: str
+    invoice_hash: str
+    invoice_uuid: str
+    invoice_type: InvoiceType
+    server_url: str
+    token: str
+    secret: str
+    mode: ZatcaSendMode
+    timeout: api.Timeout
+    rate_limiter: Optional[RateLimiter]
+    metrics: Optional[StageMetrics]
+
+    def send(
+        self, deadline: Optional[float] = None
+    ) -> Tuple[Result[ReportOrClearInvoiceResult, ReportOrClearInvoiceError], int]:
+        """
+        Sends the invoice to ZATCA. This doesn't touch the database, so it's safe to call from any thread. If [deadline]
+        (a [time.monotonic] value) is given, the call (including waiting for the rate limiter and retries) is cut short
+        when it's reached
+        """
+        send_invoice = api.clear_invoice if self.invoice_type == 'Standard' else api.report_invoice
+        with self._measure_send():
+            return send_invoice(
+                server=self.server_url,
+                invoice_xml=self.invoice_xml,
+                invoice_uuid=self.invoice_uuid,
+                invoice_hash=self.invoice_hash,
+                security_token=self.token,
+                secret=self.secret,
+                mode=self.mode,
+                timeout=self.timeout,
+                deadline=deadline,
+                rate_limiter=self.rate_limiter,
+            )
+
+    async def send_async(
+        self, client: httpx.AsyncClient, deadline: Optional[float] = None
+    ) -> Tuple[Result[ReportOrClearInvoiceResult, ReportOrClearInvoiceError], int]:
+        """The async counterpart of [send], using [client] (see [zatca_async_api.create_client])"""
+        send_invoice = async_api.clear_invoice if self.invoice_type == 'Standard' else async_api.report_invoice
+        with self._measure_send():
+            return await send_invoice(
+                client,
+                server=self.server_url,
+                invoice_xml=self.invoice_xml,
+                invoice_uuid=self.invoice_uuid,
+                invoice_hash=self.invoice_hash,
+                security_token=self.token,
+                secret=self.secret,
+                mode=self.mode,
+                timeout=self.timeout,
+                deadline=deadline,
+                rate_limiter=self.rate_limiter,
+            )
+
+    def _measure_send(self):
+        return self.metrics.span('send') if self.metrics else nullcontext()
+
+
+@dataclass(frozen=True)
+class SubmissionContext:
+    """
+    What [SalesInvoiceAdditionalFields.prepare_zatca_submission] would otherwise query for each invoice, loaded for a
+    whole batch of invoices at once by [background_jobs.prefetch_batch]
+    """
+
+    company: Optional[str]
+    is_b2b_customer: bool
+    # The production token and secret of the EGS of a precomputed invoice, or of the business settings otherwise. None if
+    # the EGS of a precomputed invoice is missing
+    credentials: Optional[tuple[str, str]]
+    device_id: Optional[str] = None
+
 
 class SalesInvoiceAdditionalFields(Document):
     # begin: auto-generated types
@@ -161,14 +254,14 @@ class SalesInvoiceAdditionalFields(Document):
         self.invoice_qr = precomputed_invoice.invoice_qr
         self.invoice_xml = precomputed_invoice.invoice_xml
 
-    def _get_invoice_type(self, settings: ZATCABusinessSettings, customer: Customer) -> InvoiceType:
+    def _get_invoice_type(self, settings: ZATCABusinessSettings, is_b2b: bool) -> InvoiceType:
         if settings.invoice_mode == InvoiceMode.Standard:
             return 'Standard'
 
         if settings.invoice_mode == InvoiceMode.Simplified:
             return 'Simplified'
 
-        if is_b2b_customer(customer):
+        if is_b2b:
             return 'Standard'
 
         return 'Simplified'
@@ -191,6 +284,10 @@ class SalesInvoiceAdditionalFields(Document):
                 self.invoice_counter = pre_invoice_counter + 1
 
     def before_insert(self):
+        with metrics.span('before_insert'):
+            self._set_fields_for_zatca()
+
+    def _set_fields_for_zatca(self):
         self.integration_status = 'Ready For Batch'
         self.is_latest = True
         # Mark any pre-existing sales invoice additional fields as no longer being latest
@@ -210,7 +307,7 @@ class SalesInvoiceAdditionalFields(Document):
         self.tax_currency = 'SAR'  # Review: Set as "SAR" as a default tax currency value
 
         buyer_doc = self._get_buyer_doc(sales_invoice)
-        invoice_type = self._get_invoice_type(settings, buyer_doc)
+        invoice_type = self._get_invoice_type(settings, is_b2b_customer(buyer_doc))
         self._set_buyer_details(buyer_doc, invoice_type)
         self.sum_of_charges = self._compute_sum_of_charges(sales_invoice.taxes)
         self.invoice_type_transaction = '0100000' if invoice_type == 'Standard' else '0200000'
@@ -235,22 +332,13 @@ class SalesInvoiceAdditionalFields(Document):
             self.invoice_counter = pre_invoice_counter + 1
         self.previous_invoice_hash = pre_invoice_hash
 
-        einvoice = Einvoice(sales_invoice_additional_fields_doc=self, invoice_type=invoice_type)
-
-        cert_path = settings.compliance_cert_path if self.is_compliance_mode else settings.cert_path
-        invoice_xml = generate_xml_file(einvoice.result)
-        result = cli.sign_invoice(
-            settings.zatca_cli_path, settings.java_home, invoice_xml, cert_path, settings.private_key_path
-        )
+        invoice_xml, result = self._generate_signed_xml(settings, invoice_type)
 
         if settings.validate_generated_xml and not self.is_compliance_mode:
-            validation_result = cli.validate_invoice(
-                settings.zatca_cli_path,
-                settings.java_home,
-                result.signed_invoice_path,
-                settings.cert_path,
-                self.previous_invoice_hash,
-            )
+            with metrics.span('validate'):
+                validation_result = settings.validate_invoice(
+                    result.signed_invoice_xml, settings.cert_path, self.previous_invoice_hash
+                )
             self.validation_messages = '\n'.join(validation_result.messages)
             self.validation_errors = '\n'.join(validation_result.errors_and_warnings)
             if validation_result.details:
@@ -308,21 +396,101 @@ class SalesInvoiceAdditionalFields(Document):
             {'invoice_counter': self.invoice_counter, 'previous_invoice_hash': self.invoice_hash},
         )
 
-    def submit_to_zatca(self) -> Result[str, str]:
+    def _generate_signed_xml(
+        self, settings: ZATCABusinessSettings, invoice_type: InvoiceType
+    ) -> Tuple[str, SigningResult]:
+        """Builds the invoice XML from this document and signs it. Returns the unsigned XML and the signing result"""
+        with metrics.span('einvoice'):
+            einvoice = Einvoice(sales_invoice_additional_fields_doc=self, invoice_type=invoice_type)
+
+        cert_path = settings.compliance_cert_path if self.is_compliance_mode else settings.cert_path
+        with metrics.span('generate_xml'):
+            invoice_xml = generate_xml_file(einvoice.result)
+        with metrics.span('sign'):
+            # Invoices signed together by [ZATCABusinessSettings.sign_invoices] share a single CLI process
+            result = settings.sign_invoice(
+                invoice_xml, cert_path, persistent=True if self.flags.sign_in_batch else None
+            )
+        return invoice_xml, result
+
+    def profile_xml_generation(self) -> str:
+        """
+        Builds, signs and (if enabled in settings) validates the XML of this invoice again under cProfile, using the same
+        code as [before_insert]. Nothing is saved or sent to ZATCA. Returns the profile report, sorted by cumulative time
+        """
         settings = ZATCABusinessSettings.for_invoice(self.sales_invoice, self.invoice_doctype)
         if not settings:
-            return Err(f'Missing ZATCA business settings for sales invoice: {self.sales_invoice}')
+            fthrow(ft('Missing ZATCA business settings for sales invoice: $invoice', invoice=self.sales_invoice))
 
-        inv_doc = cast(
+        invoice = cast(
             SalesInvoice | POSInvoice | PaymentEntry, frappe.get_doc(self.invoice_doctype, self.sales_invoice)
         )
-        buyer_doc = self._get_buyer_doc(inv_doc)
-        invoice_type = self._get_invoice_type(settings, buyer_doc)
+        invoice_type = self._get_invoice_type(settings, is_b2b_customer(self._get_buyer_doc(invoice)))
+        validate = settings.validate_generated_xml and not self.is_compliance_mode
+
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        with profiler:
+            _invoice_xml, result = self._generate_signed_xml(settings, invoice_type)
+            if validate:
+                settings.validate_invoice(result.signed_invoice_xml, settings.cert_path, self.previous_invoice_hash)
+        elapsed = time.perf_counter() - start
+
+        report = io.StringIO()
+        stages = 'Build, sign and validate' if validate else 'Build and sign'
+        report.write(f'{stages} {self.name} ({len(invoice.get("items", []))} items) at {now_datetime()}\n')
+        report.write(f'Signing engine: {settings.effective_signing_engine}, total: {elapsed:.3f}s\n\n')
+        stats = pstats.Stats(profiler, stream=report)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PROFILE_FUNCTION_LIMIT)
+        return report.getvalue()
+
+    def submit_to_zatca(
+        self, deadline: Optional[float] = None, context: Optional[SubmissionContext] = None
+    ) -> Result[str, str]:
+        submission = self.prepare_zatca_submission(context)
+        if is_err(submission):
+            return submission
+
+        result, status_code = submission.ok_value.send(deadline)
+        if status_code == api.CIRCUIT_OPEN_STATUS_CODE:
+            # ZATCA is down, so there's nothing worth recording. The invoice keeps its status for the next sync
+            return Err(_('ZATCA is unavailable. The invoice will be sent once it recovers'))
+
+        return Ok(self.apply_zatca_response(result, status_code))
+
+    def prepare_zatca_submission(self, context: Optional[SubmissionContext] = None) -> Result['ZatcaSubmission', str]:
+        """
+        Gathers everything needed to send this invoice to ZATCA. Together with [ZatcaSubmission.send] and
+        [apply_zatca_response], this splits [submit_to_zatca] so that the API call (the slow part) can run on another
+        thread, while database reads and writes stay on the thread that owns the connection.
+
+        If given, [context] is used instead of loading the invoice, customer and credentials (batch sync)
+        """
+        if context:
+            settings = ZATCABusinessSettings.for_company(context.company) if context.company else None
+        else:
+            settings = ZATCABusinessSettings.for_invoice(self.sales_invoice, self.invoice_doctype)
+        if not settings:
+            return Err(f'Missing ZATCA business settings for sales invoice: {self.sales_invoice}')
+
+        if context:
+            is_b2b = context.is_b2b_customer
+        else:
+            inv_doc = cast(
+                SalesInvoice | POSInvoice | PaymentEntry, frappe.get_doc(self.invoice_doctype, self.sales_invoice)
+            )
+            is_b2b = is_b2b_customer(self._get_buyer_doc(inv_doc))
+        invoice_type = self._get_invoice_type(settings, is_b2b)
         signed_xml = self.get_signed_xml()
         if not signed_xml:
             return Err(_('Could not find signed XML'))
 
-        if self.precomputed_invoice:
+        if context and not self.is_compliance_mode:
+            if self.precomputed_invoice and not context.credentials:
+                return Err(f"Could not find a ZATCA EGS for device '{context.device_id}'")
+
+            token, secret = context.credentials or (None, None)
+        elif self.precomputed_invoice:
             device_id = frappe.db.get_value('ZATCA Precomputed Invoice', self.precomputed_invoice, 'device_id')
             egs = ZATCAEGS.for_device(device_id)
             if not egs:
@@ -337,25 +505,49 @@ class SalesInvoiceAdditionalFields(Document):
         if not token or not secret:
             return Err(f'Missing ZATCA token/secret for {self.name}')
 
-        integration_status = self._send_xml_via_api(
-            signed_xml, self.invoice_hash, invoice_type, settings.fatoora_server_url, token, secret
-        )
-
-        # Regardless of what happened, save the side effects of the API call
-        self.save()
+        if self.send_mode == ZatcaSendMode.Compliance:
+            endpoint = 'compliance'
+        else:
+            endpoint = 'clearance' if invoice_type == 'Standard' else 'reporting'
 
-        # Resend means we keep ourselves as draft to be picked up by the next run of the background job
-        if integration_status == 'Resend':
-            frappe.log_error(
-                title='ZATCA Resend Error',
-                message=f"Sending invoice {self.sales_invoice} through {self.name} failed with 'Resend' status.",
+        return Ok(
+            ZatcaSubmission(
+                invoice_xml=signed_xml,
+                invoice_hash=self.invoice_hash,
+                invoice_uuid=self.uuid,
+                invoice_type=invoice_type,
+                server_url=settings.fatoora_server_url,
+                token=token,
+                secret=secret,
+                mode=self.send_mode,
+                timeout=settings.get_api_timeout(endpoint),
+                rate_limiter=RateLimiter.for_site(),
+                metrics=StageMetrics.for_site(),
             )
-        else:
-            # Any case other than resend is submitted
-            self.allow_submit = 1
-            self.submit()
+        )
+
+    def apply_zatca_response(
+        self, result: Result[ReportOrClearInvoiceResult, ReportOrClearInvoiceError], status_code: int
+    ) -> str:
+        """Records the result of sending this invoice to ZATCA, then saves (and submits, unless it must be resent)"""
+        integration_status = self._apply_api_result(result, status_code)
+
+        with metrics.span('save'):
+            # Regardless of what happened, save the side effects of the API call
+            self.save()
+
+            # Resend means we keep ourselves as draft to be picked up by the next run of the background job
+            if integration_status == 'Resend':
+                frappe.log_error(
+                    title='ZATCA Resend Error',
+                    message=f"Sending invoice {self.sales_invoice} through {self.name} failed with 'Resend' status.",
+                )
+            else:
+                # Any case other than resend is submitted
+                self.allow_submit = 1
+                self.submit()
 
-        return Ok(f'Invoice sent to ZATCA. Integration status: {integration_status}')
+        return f'Invoice sent to ZATCA. Integration status: {integration_status}'
 
     def before_submit(self):
         if not self.allow_submit:
@@ -450,30 +642,9 @@ class SalesInvoiceAdditionalFields(Document):
         self.buyer_province_state = address.state
         self.buyer_country_code = frappe.get_value('Country', address.country, 'code')
 
-    def _send_xml_via_api(
-        self, invoice_xml: str, invoice_hash: str, invoice_type: InvoiceType, server_url: str, token: str, secret: str
+    def _apply_api_result(
+        self, result: Result[ReportOrClearInvoiceResult, ReportOrClearInvoiceError], status_code: int
     ) -> ZatcaIntegrationStatus:
-        if invoice_type == 'Standard':
-            result, status_code = api.clear_invoice(
-                server=server_url,
-                invoice_xml=invoice_xml,
-                invoice_uuid=self.uuid,
-                invoice_hash=invoice_hash,
-                security_token=token,
-                secret=secret,
-                mode=self.send_mode,
-            )
-        else:
-            result, status_code = api.report_invoice(
-                server=server_url,
-                invoice_xml=invoice_xml,
-                invoice_uuid=self.uuid,
-                invoice_hash=invoice_hash,
-                security_token=token,
-                secret=secret,
-                mode=self.send_mode,
-            )
-
         status = ''
         integration_status = _get_integration_status(status_code)
         if is_err(result):
@@ -629,6 +800,38 @@ def download_xml(id: str):
     frappe.response.display_content_as = 'attachment'
 
 
+@frappe.whitelist()
+def profile_xml_generation(id: str) -> str:
+    """
+    Profiles building and signing the XML of a SIAF (see [SalesInvoiceAdditionalFields.profile_xml_generation]) and
+    attaches the report to it as a private file. Returns the file URL. From a console:
+
+        bench --site <site> execute <this module>.profile_xml_generation --kwargs "{'id': '<SIAF name>'}"
+    """
+    frappe.only_for('System Manager')
+
+    siaf = cast(SalesInvoiceAdditionalFields, frappe.get_doc('Sales Invoice Additional Fields', id))
+    if siaf.precomputed:
+        frappe.throw(ft('Cannot profile a precomputed invoice, its XML was generated by the device'))
+
+    report = siaf.profile_xml_generation()
+    file = cast(
+        File,
+        frappe.get_doc(
+            {
+                'doctype': 'File',
+                'file_name': f'{siaf.name}-profile-{now_datetime():%Y%m%d%H%M%S}.txt',
+                'attached_to_doctype': 'Sales Invoice Additional Fields',
+                'attached_to_name': siaf.name,
+                'is_private': 1,
+                'content': report,
+            }
+        ),
+    )
+    file.insert(ignore_permissions=True)
+    return file.file_url
+
+
 @frappe.whitelist()
 def fix_rejection(id: str):
     import frappe.permissions
@@ -657,11 +860,16 @@ def fix_rejection(id: str):
     new_siaf.insert(ignore_permissions=True)
 
     if settings.is_live_sync:
-        frappe.utils.background_jobs.enqueue(_submit_additional_fields, doc=new_siaf, enqueue_after_commit=True)
+        queue_for_live_sync(new_siaf)
 
     frappe.msgprint(ft('Created $link', link=get_link_to_form('Sales Invoice Additional Fields', new_siaf.name)))
 
 
+def _submit_additional_fields(doc: SalesInvoiceAdditionalFields):
+    # Live sync jobs queued before upgrading still call this with the document. See [live_sync.submit_additional_fields]
+    submit_additional_fields(doc.name)
+
+
 def _get_integration_status(code: int) -> ZatcaIntegrationStatus:
     status_map = cast(
         dict[int, ZatcaIntegrationStatus],
@@ -687,13 +895,6 @@ def _get_integration_status(code: int) -> ZatcaIntegrationStatus:
         return 'Resend'
 
 
-def _submit_additional_fields(doc: SalesInvoiceAdditionalFields):
-    logger.info(f'Submitting {doc.name}')
-    result = doc.submit_to_zatca()
-    message = result.ok_value if is_ok(result) else result.err_value
-    logger.info(f'Submission result: {message}')
-
-
 @frappe.whitelist()
 def check_pdf_a3b_support(id: str):
     siaf = cast(SalesInvoiceAdditionalFields, frappe.get_doc('Sales Invoice Additional Fields', id))
@@ -705,33 +906,17 @@ def check_pdf_a3b_support(id: str):
 def download_zatca_pdf(id: str, print_format: str = 'ZATCA Phase 2 Print Format', lang: str = 'en'):
     siaf = cast(SalesInvoiceAdditionalFields, frappe.get_doc('Sales Invoice Additional Fields', id))
     sales_invoice_doc = cast(SalesInvoice, frappe.get_doc('Sales Invoice', siaf.sales_invoice))
-    settings = ZATCABusinessSettings.for_invoice(siaf.sales_invoice, siaf.invoice_doctype)
-    xml_content = siaf.get_signed_xml()
-    pdf_writer = PdfWriter()
-    pdf_writer.add_metadata(
-        {
-            '/Author': settings.company,
-            '/Title': siaf.sales_invoice,
-            '/Subject': siaf.sales_invoice,
-        }
-    )
-    with print_language(lang):
-        frappe.get_print(
-            'Sales Invoice',
-            siaf.sales_invoice,
-            print_format,
-            doc=sales_invoice_doc,
-            as_pdf=True,
-            output=pdf_writer,
-        )
-    pdf_file = get_file_data_from_writer(pdf_writer)
-
-    zatca_pdf_path = convert_to_pdf_a3_b(
-        settings.zatca_cli_path, settings.java_home, siaf.sales_invoice, pdf_file, xml_content
+    cache_key = zatca_pdf.get_pdf_cache_key(
+        siaf.name, siaf.invoice_hash, sales_invoice_doc.modified, print_format, lang
     )
+    pdf_content = zatca_pdf.get_cached_pdf(siaf.name, cache_key) if cache_key else None
+    if pdf_content is None:
+        pdf_content = _generate_zatca_pdf(siaf, sales_invoice_doc, print_format, lang)
+        if cache_key:
+            zatca_pdf.cache_pdf(siaf.name, cache_key, pdf_content)
 
-    with open(zatca_pdf_path, 'rb') as f:
-        pdf_content = f.read()
+    # This is a GET request, which is rolled back by default. We commit to keep the cache entry (or its last use time)
+    frappe.db.commit()
 
     frappe.response.filename = f'{siaf.sales_invoice}_a3b.pdf'
     frappe.response.filecontent = pdf_content
@@ -739,6 +924,19 @@ def download_zatca_pdf(id: str, print_format: str = 'ZATCA Phase 2 Print Format'
     frappe.response.display_content_as = 'attachment'
 
 
+def _generate_zatca_pdf(
+    siaf: SalesInvoiceAdditionalFields, sales_invoice_doc: SalesInvoice, print_format: str, lang: str
+) -> bytes:
+    settings = ZATCABusinessSettings.for_invoice(siaf.sales_invoice, siaf.invoice_doctype)
+    xml_content = siaf.get_signed_xml()
+    pdf_file = zatca_pdf.render_invoice_pdf(sales_invoice_doc, settings.company, print_format, lang)
+    return convert_to_pdf_a3_b(settings.zatca_cli_path, settings.java_home, siaf.sales_invoice, pdf_file, xml_content)
+
+
+def on_doctype_update():
+    frappe.db.add_index('Sales Invoice Additional Fields', SYNC_QUEUE_INDEX_COLUMNS, SYNC_QUEUE_INDEX)
+
+
 def is_b2b_customer(customer: Customer) -> bool:
     return bool(customer.custom_vat_registration_number) or any(
         [strip(x.value) for x in customer.custom_additional_ids]
@@ -0,0 +1,66 @@
+// Copyright (c) 2024, Lavaloon and contributors
+// For license information, please see license.txt
+
+frappe.listview_settings['Sales Invoice Additional Fields'] = {
+	onload: function (listview) {
+		listview.page.add_inner_button(__('Download PDF/A-3b (Bulk)'), () => bulk_download_pdfs());
+	},
+};
+
+function bulk_download_pdfs() {
+	let fields = [
+		{
+			label: 'Company',
+			fieldname: 'company',
+			fieldtype: 'Link',
+			options: 'Company',
+			reqd: 1,
+			default: frappe.defaults.get_user_default('Company'),
+		},
+		{
+			label: 'From Date',
+			fieldname: 'from_date',
+			fieldtype: 'Date',
+			reqd: 1,
+		},
+		{
+			label: 'To Date',
+			fieldname: 'to_date',
+			fieldtype: 'Date',
+			reqd: 1,
+		},
+		{
+			label: 'Customer',
+			fieldname: 'customer',
+			fieldtype: 'Link',
+			options: 'Customer',
+		},
+		{
+			label: 'Print Format',
+			fieldname: 'print_format',
+			fieldtype: 'Link',
+			options: 'Print Format',
+			reqd: 1,
+			default: 'ZATCA Phase 2 Print Format',
+		},
+		{
+			label: 'Language',
+			fieldname: 'lang',
+			fieldtype: 'Link',
+			options: 'Language',
+			reqd: 1,
+			default: 'en',
+		},
+	];
+	frappe.prompt(
+		fields,
+		(values) => {
+			frappe.call({
+				method: 'ksa_compliance.bulk_pdf.generate_bulk_pdfs',
+				args: values,
+			});
+		},
+		__('Download PDF/A-3b'),
+		__('Generate'),
+	);
+}
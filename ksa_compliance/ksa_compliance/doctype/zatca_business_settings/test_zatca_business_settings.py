@@ -1,9 +1,113 @@
 # Copyright (c) 2024, Lavaloon and Contributors
 # See license.txt
 
-# import frappe
+from unittest import mock
+
+import frappe
 from frappe.tests.utils import FrappeTestCase
 
+from ksa_compliance.ksa_compliance.doctype.sales_invoice_additional_fields.sales_invoice_additional_fields import (
+    SalesInvoiceAdditionalFields,
+)
+from ksa_compliance.ksa_compliance.doctype.zatca_business_settings.zatca_business_settings import (
+    COMPANY_SETTINGS_CACHE_KEY,
+    ZATCABusinessSettings,
+    _CompanySettings,
+    clear_company_settings_cache,
+    revoke_business_settings,
+)
+from ksa_compliance.zatca_cli import SigningResult
+
+SIAF_MODULE = 'ksa_compliance.ksa_compliance.doctype.sales_invoice_additional_fields.sales_invoice_additional_fields'
+
+TEST_COMPANY = '_Test ZATCA Settings Cache Company'
+TEST_SETTINGS = '_Test ZATCA Settings Cache'
+
 
 class TestZATCABusinessSettings(FrappeTestCase):
-    pass
+    def setUp(self):
+        frappe.cache.hset(COMPANY_SETTINGS_CACHE_KEY, TEST_COMPANY, _CompanySettings(TEST_SETTINGS, None, True, False))
+
+    def tearDown(self):
+        clear_company_settings_cache()
+        frappe.clear_document_cache('ZATCA Business Settings', TEST_SETTINGS)
+
+    def test_update_clears_cache(self):
+        frappe.new_doc('ZATCA Business Settings').on_update()
+        self.assert_cleared()
+
+    def test_delete_clears_cache(self):
+        frappe.new_doc('ZATCA Business Settings').after_delete()
+        self.assert_cleared()
+
+    def test_revoke_clears_cache(self):
+        revoke_business_settings(TEST_SETTINGS, TEST_COMPANY)
+        self.assert_cleared()
+
+    def test_for_company_returns_a_copy(self):
+        insert_settings()
+        settings = ZATCABusinessSettings.for_company(TEST_COMPANY)
+        settings.fatoora_server = 'Production'
+
+        self.assertNotEqual(ZATCABusinessSettings.for_company(TEST_COMPANY).fatoora_server, 'Production')
+
+    def test_sign_invoices_chains_invoices(self):
+        insert_settings()
+        frappe.get_doc(
+            {
+                'doctype': 'ZATCA Invoice Counting Settings',
+                'name': TEST_SETTINGS,
+                'business_settings_reference': TEST_SETTINGS,
+                'invoice_counter': 5,
+                'previous_invoice_hash': 'hash-5',
+            }
+        ).db_insert()
+
+        settings = ZATCABusinessSettings.for_company(TEST_COMPANY)
+        docs = []
+        for index in range(3):
+            doc = SalesInvoiceAdditionalFields.create_for_invoice(f'_Test ZATCA Chain Invoice {index}', 'Sales Invoice')
+            doc.flags.ignore_links = True
+            docs.append(doc)
+
+        # Only the chain is checked here, so building the invoice and its XML is skipped and signing is faked
+        hashes = iter(['hash-6', 'hash-7', 'hash-8'])
+        with (
+            mock.patch.object(ZATCABusinessSettings, 'for_invoice', return_value=settings),
+            mock.patch.object(
+                SalesInvoiceAdditionalFields,
+                '_set_fields_for_zatca',
+                autospec=True,
+                side_effect=lambda doc: doc._prepare_for_zatca(settings, 'Simplified'),
+            ),
+            mock.patch(f'{SIAF_MODULE}.Einvoice'),
+            mock.patch(f'{SIAF_MODULE}.generate_xml_file', return_value='<Invoice/>'),
+            mock.patch.object(
+                ZATCABusinessSettings,
+                'sign_invoice',
+                autospec=True,
+                side_effect=lambda *args, **kwargs: SigningResult('<Invoice/>', next(hashes), 'QR'),
+            ) as sign_invoice,
+        ):
+            results = settings.sign_invoices(docs)
+
+        self.assertEqual([result.invoice_hash for result in results], ['hash-6', 'hash-7', 'hash-8'])
+        self.assertEqual([doc.invoice_counter for doc in docs], [6, 7, 8])
+        self.assertEqual([doc.previous_invoice_hash for doc in docs], ['hash-5', 'hash-6', 'hash-7'])
+        self.assertTrue(all(call.kwargs['persistent'] for call in sign_invoice.call_args_list))
+        self.assertEqual(
+            frappe.db.get_value(
+                'ZATCA Invoice Counting Settings', TEST_SETTINGS, ['invoice_counter', 'previous_invoice_hash']
+            ),
+            (8, 'hash-8'),
+        )
+
+    def assert_cleared(self):
+        self.assertIsNone(frappe.cache.hget(COMPANY_SETTINGS_CACHE_KEY, TEST_COMPANY))
+
+
+def insert_settings() -> None:
+    # Inserted as is, since the hooks create accounts and templates for the company
+    frappe.get_doc(
+        {'doctype': 'ZATCA Business Settings', 'name': TEST_SETTINGS, 'company': TEST_COMPANY, 'status': 'Active'}
+    ).db_insert()
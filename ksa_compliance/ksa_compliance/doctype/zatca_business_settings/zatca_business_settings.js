@@ -48,6 +48,17 @@ frappe.ui.form.on('ZATCA Business Settings', {
 			},
 		});
 	},
+	optimize_cli_startup: function (frm) {
+		frappe.call({
+			freeze: true,
+			freeze_message: __('Please wait. This can take a minute...'),
+			method: 'ksa_compliance.zatca_cli.optimize_startup',
+			args: {
+				zatca_cli_path: frm.doc.zatca_cli_path || '',
+				java_home: frm.doc.java_home || '',
+			},
+		});
+	},
 	block_invoice_on_invalid_xml: async function (frm) {
 		if (frm.doc.block_invoice_on_invalid_xml) {
 			try {
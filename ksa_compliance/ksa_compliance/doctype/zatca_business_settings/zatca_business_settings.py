@@ -1,8 +1,10 @@
 # Copyright (c) 2024, LavaLoon and contributors
 # For license information, please see license.txt
 import base64
+import copy
 import os
-from typing import Optional, NoReturn, cast, Literal
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Optional, NoReturn, cast, Literal
 
 from pypika.functions import Count
 
@@ -21,6 +23,8 @@ from frappe.model.document import Document
 from pathvalidate import sanitize_filename
 from result import is_err
 
+import ksa_compliance.native_signer as native_signer
+import ksa_compliance.native_validator as native_validator
 import ksa_compliance.zatca_api as api
 import ksa_compliance.zatca_cli as cli
 import ksa_compliance.zatca_files
@@ -30,6 +34,30 @@ from ksa_compliance.invoice import InvoiceMode
 from ksa_compliance.throw import fthrow
 from ksa_compliance.translation import ft
 
+if TYPE_CHECKING:
+    from ksa_compliance.ksa_compliance.doctype.sales_invoice_additional_fields.sales_invoice_additional_fields import (
+        SalesInvoiceAdditionalFields,
+    )
+
+FATOORA_SERVER_URLS = {
+    'Sandbox': 'https://gw-fatoora.zatca.gov.sa/e-invoicing/developer-portal/',
+    'Simulation': 'https://gw-fatoora.zatca.gov.sa/e-invoicing/simulation/',
+    'Production': 'https://gw-fatoora.zatca.gov.sa/e-invoicing/core/',
+}
+
+# A Redis hash (per site) of company -> [_CompanySettings], cleared whenever any business settings change
+COMPANY_SETTINGS_CACHE_KEY = 'ksa_compliance:business_settings_by_company'
+
+
+@dataclass(frozen=True)
+class _CompanySettings:
+    """Which business settings apply to a company, as cached in [COMPANY_SETTINGS_CACHE_KEY]"""
+
+    active: Optional[str]
+    latest_revoked: Optional[str]
+    enable_zatca_integration: bool
+    enable_branch_configuration: bool
+
 
 class ZATCABusinessSettings(Document):
     # begin: auto-generated types
@@ -50,6 +78,7 @@ class ZATCABusinessSettings(Document):
         block_invoice_on_invalid_xml: DF.Check
         building_number: DF.Data | None
         city: DF.Data | None
+        clearance_timeout: DF.Float
         cli_setup: DF.Literal['Automatic', 'Manual']
         company: DF.Link
         company_address: DF.Link
@@ -57,8 +86,11 @@ class ZATCABusinessSettings(Document):
         company_unit: DF.Data
         company_unit_serial: DF.Data
         compliance_request_id: DF.Data | None
+        compliance_timeout: DF.Float
+        connect_timeout: DF.Float
         country: DF.Link
         country_code: DF.Data | None
+        csid_timeout: DF.Float
         csr: DF.SmallText | None
         currency: DF.Link
         district: DF.Data | None
@@ -66,6 +98,7 @@ class ZATCABusinessSettings(Document):
         enable_zatca_integration: DF.Check
         fatoora_server: DF.Literal['Sandbox', 'Simulation', 'Production']
         java_home: DF.Data | None
+        keep_cli_running: DF.Check
         linked_tax_account: DF.Link | None
         other_ids: DF.Table[AdditionalSellerIDs]
         override_cli_download_url: DF.Data | None
@@ -74,9 +107,11 @@ class ZATCABusinessSettings(Document):
         production_request_id: DF.Data | None
         production_secret: DF.Password | None
         production_security_token: DF.SmallText | None
+        reporting_timeout: DF.Float
         secret: DF.Password | None
         security_token: DF.SmallText | None
         seller_name: DF.Data
+        signing_engine: DF.Literal['CLI', 'Native']
         status: DF.Literal['Active', 'Revoked']
         street: DF.Data | None
         sync_with_zatca: DF.Literal['Live', 'Batches']
@@ -85,6 +120,7 @@ class ZATCABusinessSettings(Document):
             'Let the system decide (both)', 'Simplified Tax Invoices', 'Standard Tax Invoices'
         ]
         validate_generated_xml: DF.Check
+        validation_engine: DF.Literal['CLI', 'Native', 'Both']
         vat_registration_number: DF.Data
         zatca_cli_path: DF.Data | None
         zatca_tax_category: DF.Literal[
@@ -111,6 +147,7 @@ class ZATCABusinessSettings(Document):
     # end: auto-generated types
 
     def after_insert(self):
+        clear_company_settings_cache()
         invoice_counting_doc = frappe.new_doc('ZATCA Invoice Counting Settings')
         invoice_counting_doc.business_settings_reference = self.name
         invoice_counting_doc.invoice_counter = 0
@@ -130,6 +167,12 @@ class ZATCABusinessSettings(Document):
             # Create Item Tax Template
             self.create_item_tax_template(account_head=tax_account_id)
 
+    def on_update(self):
+        clear_company_settings_cache()
+
+    def after_delete(self):
+        clear_company_settings_cache()
+
     @property
     def is_live_sync(self) -> bool:
         return self.sync_with_zatca.lower() == 'live'
@@ -138,6 +181,11 @@ class ZATCABusinessSettings(Document):
     def invoice_mode(self) -> InvoiceMode:
         return InvoiceMode.from_literal(self.type_of_business_transactions)
 
+    @property
+    def effective_signing_engine(self) -> Literal['CLI', 'Native']:
+        """The engine actually used to sign invoices. 'Native' falls back to the CLI unless the site opts in"""
+        return 'Native' if self.signing_engine == 'Native' and _is_native_signing_enabled() else 'CLI'
+
     @property
     def has_production_csid(self) -> bool:
         return (
@@ -194,14 +242,21 @@ class ZATCABusinessSettings(Document):
 
     @property
     def fatoora_server_url(self) -> str:
-        if self.fatoora_server == 'Sandbox':
-            return 'https://gw-fatoora.zatca.gov.sa/e-invoicing/developer-portal/'
-        if self.fatoora_server == 'Simulation':
-            return 'https://gw-fatoora.zatca.gov.sa/e-invoicing/simulation/'
-        if self.fatoora_server == 'Production':
-            return 'https://gw-fatoora.zatca.gov.sa/e-invoicing/core/'
+        # Points all business settings on the site at another server, e.g. a fake one for load testing
+        # (see ksa_compliance.fake_fatoora)
+        override = frappe.conf.get('zatca_fatoora_server_url')
+        if override:
+            return override
+        if self.fatoora_server in FATOORA_SERVER_URLS:
+            return FATOORA_SERVER_URLS[self.fatoora_server]
         fthrow(f'Invalid Fatoora Server, Please update {self.company} Fatoora Server in ZATCA Business Settings')
 
+    def get_api_timeout(self, endpoint: api.ApiEndpoint) -> api.Timeout:
+        """Returns the (connect, read) timeouts for calls to [endpoint]. Unset timeouts fall back to the defaults"""
+        connect_timeout = self.connect_timeout or api.DEFAULT_CONNECT_TIMEOUT
+        read_timeout = self.get(f'{endpoint}_timeout') or api.DEFAULT_READ_TIMEOUTS[endpoint]
+        return connect_timeout, read_timeout
+
     def onboard(self, otp: str) -> NoReturn:
         """Creates a CSR and issues a compliance CSID request. On success, updates the document with the CSR,
         compliance request ID, as well as credentials (security token and secret).
@@ -213,7 +268,9 @@ class ZATCABusinessSettings(Document):
         self._throw_if_api_config_missing()
 
         csr_result = self._generate_csr()
-        compliance_result, status_code = api.get_compliance_csid(self.fatoora_server_url, csr_result.csr, otp)
+        compliance_result, status_code = api.get_compliance_csid(
+            self.fatoora_server_url, csr_result.csr, otp, timeout=self.get_api_timeout('csid')
+        )
         if is_err(compliance_result):
             fthrow(compliance_result.err_value, title=_('Compliance API Error'))
 
@@ -240,7 +297,12 @@ class ZATCABusinessSettings(Document):
             fthrow(_("Please onboard first to generate a 'Compliance Request ID'"))
 
         csid_result, status_code = api.get_production_csid(
-            self.fatoora_server_url, self.compliance_request_id, otp, self.security_token, self.get_password('secret')
+            self.fatoora_server_url,
+            self.compliance_request_id,
+            otp,
+            self.security_token,
+            self.get_password('secret'),
+            timeout=self.get_api_timeout('csid'),
         )
         if is_err(csid_result):
             fthrow(csid_result.err_value, title=_('Production CSID Error'))
@@ -278,11 +340,92 @@ class ZATCABusinessSettings(Document):
             'category': self.company_category,
         }
 
+    def sign_invoice(self, invoice_xml: str, cert_path: str, persistent: Optional[bool] = None) -> cli.SigningResult:
+        """
+        Signs [invoice_xml] with the certificate at [cert_path] using the configured signing engine. [persistent]
+        overrides 'Keep CLI Running' for the CLI engine
+        """
+        if self.effective_signing_engine == 'Native':
+            credentials = native_signer.SigningCredentials.load_cached(cert_path, self.private_key_path)
+            result = native_signer.sign_invoice(invoice_xml, credentials)
+            return cli.SigningResult(result.signed_invoice_xml, result.invoice_hash, result.qr_code)
+
+        return cli.sign_invoice(
+            self.zatca_cli_path,
+            self.java_home,
+            invoice_xml,
+            cert_path,
+            self.private_key_path,
+            persistent=self.keep_cli_running if persistent is None else persistent,
+        )
+
+    def sign_invoices(self, docs: list['SalesInvoiceAdditionalFields']) -> list[cli.SigningResult]:
+        """
+        Inserts (and so signs) the new additional fields [docs] of invoices using these settings, in order. Each one gets
+        the next invoice counter and the hash of the one before it as its PIH, through the same insert path as a single
+        invoice, which also updates the ZATCA Invoice Counting Settings. The counting settings are locked first, so
+        no other invoice can join the chain until the transaction ends. Returns the signing results in the same order.
+
+        With the CLI engine, all invoices are signed through a single CLI process (as with 'Keep CLI Running'), so JVM
+        startup is paid once per batch rather than once per invoice. Nothing is committed here: if an invoice fails,
+        rolling back the transaction undoes the whole batch
+        """
+        for doc in docs:
+            if doc.precomputed:
+                fthrow(ft('Precomputed invoice $invoice is already signed by its device', invoice=doc.sales_invoice))
+
+            settings = ZATCABusinessSettings.for_invoice(doc.sales_invoice, doc.invoice_doctype)
+            if not settings or settings.name != self.name:
+                fthrow(ft('Invoice $invoice uses other ZATCA Business Settings', invoice=doc.sales_invoice))
+
+        frappe.db.get_value(
+            'ZATCA Invoice Counting Settings', {'business_settings_reference': self.name}, 'name', for_update=True
+        )
+        results = []
+        for doc in docs:
+            doc.flags.sign_in_batch = True
+            doc.insert()
+            results.append(cli.SigningResult(doc.invoice_xml, doc.invoice_hash, doc.qr_code))
+        return results
+
+    def validate_invoice(
+        self, signed_invoice_xml: str, cert_path: str, previous_invoice_hash: str
+    ) -> cli.ValidationResult:
+        """
+        Validates a signed invoice using the configured validation engine. If the native validator isn't available,
+        we fall back to the CLI
+        """
+        native_result = None
+        if self.validation_engine in ('Native', 'Both'):
+            base_path = os.path.normpath(os.path.join(os.path.dirname(self.zatca_cli_path), '../'))
+            try:
+                native_result = native_validator.validate_invoice(signed_invoice_xml, base_path, previous_invoice_hash)
+            except native_validator.NativeValidatorUnavailable as e:
+                logger.warning(f'Native validator is not available, falling back to the CLI: {e}')
+            except Exception as e:
+                if self.validation_engine != 'Both':
+                    raise
+                # The CLI result is the one that counts in 'Both' mode, so a native validator failure mustn't block
+                # the invoice
+                logger.error('Native validator failed, using the CLI result only', exc_info=e)
+
+            if native_result and self.validation_engine == 'Native':
+                return native_result
+
+        cli_result = cli.validate_invoice(
+            self.zatca_cli_path, self.java_home, signed_invoice_xml, cert_path, previous_invoice_hash
+        )
+        if native_result:
+            differences = native_validator.diff_results(cli_result, native_result)
+            if differences:
+                logger.warning('Native and CLI validation results differ:\n' + '\n'.join(differences))
+        return cli_result
+
     @staticmethod
     def for_invoice(
         invoice_id: str, doctype: Literal['Sales Invoice', 'POS Invoice', 'Payment Entry']
     ) -> Optional['ZATCABusinessSettings']:
-        company_id = frappe.db.get_value(doctype, invoice_id, ['company'])
+        company_id = frappe.db.get_value(doctype, invoice_id, 'company', cache=True)
         if not company_id:
             return None
 
@@ -290,48 +433,35 @@ class ZATCABusinessSettings(Document):
 
     @staticmethod
     def for_company(company_id: str, include_revoked=False) -> Optional['ZATCABusinessSettings']:
-        business_settings_id = frappe.db.get_value(
-            'ZATCA Business Settings', filters={'company': company_id, 'status': 'Active'}
-        )
+        """
+        Returns the active business settings of [company_id] (or the most recently revoked ones if [include_revoked]).
+        The settings come from the document cache. Each caller gets its own copy, so changing it doesn't affect the
+        cached document
+        """
+        company_settings = _get_company_settings(company_id)
+        business_settings_id = company_settings.active
         if not business_settings_id and include_revoked:
-            # frappe.db.exists doesn't order, so it could return the oldest revoked settings. We want the most
-            # recent revoked settings instead
-            business_settings_id = frappe.db.get_value(
-                'ZATCA Business Settings',
-                {'company': company_id, 'status': 'Revoked'},
-                ignore=True,
-                order_by='modified desc',
-            )
+            business_settings_id = company_settings.latest_revoked
 
         if not business_settings_id:
             return None
 
-        return cast(ZATCABusinessSettings, frappe.get_doc('ZATCA Business Settings', business_settings_id))
+        settings = frappe.get_cached_doc('ZATCA Business Settings', business_settings_id)
+        return cast(ZATCABusinessSettings, copy.deepcopy(settings))
 
     @staticmethod
     def is_revoked_for_company(company_id: str) -> bool:
-        business_settings_id = frappe.db.get_value(
-            'ZATCA Business Settings', filters={'company': company_id, 'status': 'Revoked'}
-        )
-        return bool(business_settings_id)
+        return bool(_get_company_settings(company_id).latest_revoked)
 
     @staticmethod
     def is_enabled_for_company(company_id: str) -> bool:
-        return bool(
-            frappe.db.get_value(
-                'ZATCA Business Settings',
-                filters={'company': company_id, 'status': 'Active', 'enable_zatca_integration': True},
-            )
-        )
+        company_settings = _get_company_settings(company_id)
+        return bool(company_settings.active and company_settings.enable_zatca_integration)
 
     @staticmethod
     def is_branch_config_enabled(company_id: str) -> bool:
-        return bool(
-            frappe.db.get_value(
-                'ZATCA Business Settings',
-                filters={'company': company_id, 'status': 'Active', 'enable_branch_configuration': True},
-            )
-        )
+        company_settings = _get_company_settings(company_id)
+        return bool(company_settings.active and company_settings.enable_branch_configuration)
 
     def _generate_csr(self) -> cli.CsrResult:
         config = frappe.render_template(
@@ -499,5 +629,46 @@ def revoke_business_settings(settings_id: str, company: str):
         )
 
     frappe.db.set_value('ZATCA Business Settings', settings_id, 'status', 'Revoked')
+    frappe.clear_document_cache('ZATCA Business Settings', settings_id)
+    clear_company_settings_cache()
 
     frappe.msgprint(ft('CSID and Business Settings is now revoked.'), ft('Successfully Revoked'))
+
+
+def clear_company_settings_cache() -> None:
+    """Clears the company -> business settings cache of the current site, in Redis and in the current request"""
+    frappe.cache.delete_value(COMPANY_SETTINGS_CACHE_KEY)
+
+
+def _get_company_settings(company_id: str) -> _CompanySettings:
+    # hget keeps a request-local copy too, so repeated lookups during the same request don't hit Redis
+    return frappe.cache.hget(
+        COMPANY_SETTINGS_CACHE_KEY, company_id, generator=lambda: _load_company_settings(company_id)
+    )
+
+
+def _load_company_settings(company_id: str) -> _CompanySettings:
+    active = frappe.db.get_value(
+        'ZATCA Business Settings',
+        {'company': company_id, 'status': 'Active'},
+        ['name', 'enable_zatca_integration', 'enable_branch_configuration'],
+        as_dict=True,
+    )
+    # frappe.db.exists doesn't order, so it could return the oldest revoked settings. We want the most recent revoked
+    # settings instead
+    latest_revoked = frappe.db.get_value(
+        'ZATCA Business Settings', {'company': company_id, 'status': 'Revoked'}, ignore=True, order_by='modified desc'
+    )
+    return _CompanySettings(
+        active=active.name if active else None,
+        latest_revoked=latest_revoked,
+        enable_zatca_integration=bool(active and active.enable_zatca_integration),
+        enable_branch_configuration=bool(active and active.enable_branch_configuration),
+    )
+
+
+def _is_native_signing_enabled() -> bool:
+    # The native engine isn't verified against the CLI output yet (see test_native_signer), so 'Native' is hidden and
+    # only takes effect on sites that opt in using the 'zatca_enable_native_signing' site config key. Other sites keep
+    # signing with the CLI
+    return bool(frappe.conf.get('zatca_enable_native_signing'))
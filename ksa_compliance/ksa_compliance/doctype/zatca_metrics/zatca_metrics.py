@@ -0,0 +1,27 @@
+# Copyright (c) 2026, Lavaloon and contributors
+# For license information, please see license.txt
+
+# import frappe
+from frappe.model.document import Document
+
+
+class ZATCAMetrics(Document):
+    # begin: auto-generated types
+    # This code is auto-generated. Do not modify anything in this block.
+
+    from typing import TYPE_CHECKING
+
+    if TYPE_CHECKING:
+        from frappe.types import DF
+
+        buckets: DF.SmallText | None
+        mean: DF.Float
+        p50: DF.Float
+        p95: DF.Float
+        p99: DF.Float
+        period_start: DF.Datetime
+        samples: DF.Int
+        stage: DF.Literal['before_insert', 'einvoice', 'generate_xml', 'sign', 'validate', 'send', 'save']
+        total_seconds: DF.Float
+    # end: auto-generated types
+    pass
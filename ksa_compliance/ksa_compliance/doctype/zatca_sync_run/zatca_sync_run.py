@@ -0,0 +1,109 @@
+# Copyright (c) 2026, Lavaloon and contributors
+# For license information, please see license.txt
+import datetime
+from typing import Literal, Optional, cast
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import now_datetime, time_diff_in_seconds
+
+# The statuses of a run that ended. 'Interrupted' runs were killed (e.g. job timeout, worker restart) before recording
+# how they ended, which is noticed by the next run
+SyncRunEndStatus = Literal['Completed', 'Timed Out', 'Interrupted', 'Failed']
+
+
+class ZATCASyncRun(Document):
+    # begin: auto-generated types
+    # This code is auto-generated. Do not modify anything in this block.
+
+    from typing import TYPE_CHECKING
+
+    if TYPE_CHECKING:
+        from frappe.types import DF
+
+        accepted: DF.Int
+        check_date: DF.Datetime | None
+        cursor_creation: DF.Datetime | None
+        cursor_name: DF.Data | None
+        ended_at: DF.Datetime | None
+        processed: DF.Int
+        rejected: DF.Int
+        resend: DF.Int
+        resumed_from: DF.Link | None
+        started_at: DF.Datetime
+        status: DF.Literal['Running', 'Completed', 'Timed Out', 'Interrupted', 'Failed']
+        throughput: DF.Float
+    # end: auto-generated types
+
+    @staticmethod
+    def start(check_date: Optional[datetime.datetime]) -> 'ZATCASyncRun':
+        """
+        Records the start of a sync of the invoices created after [check_date]. If the previous sync from the same date
+        didn't complete, the new run starts from its checkpoint ([cursor_creation], [cursor_name]) instead of scanning
+        the invoices it already went through again
+        """
+        run = cast(ZATCASyncRun, frappe.new_doc('ZATCA Sync Run'))
+        run.status = 'Running'
+        run.check_date = check_date
+        run.started_at = now_datetime()
+
+        previous = _get_previous_run(check_date)
+        if previous and previous.status != 'Completed':
+            if previous.status == 'Running':
+                # Sync jobs don't overlap, so the previous run was killed
+                frappe.db.set_value('ZATCA Sync Run', previous.name, 'status', 'Interrupted')
+            if previous.cursor_name:
+                run.resumed_from = previous.name
+                run.cursor_creation = previous.cursor_creation
+                run.cursor_name = previous.cursor_name
+
+        run.insert(ignore_permissions=True)
+        frappe.db.commit()
+        return run
+
+    def record_batch(self, names: list[str], processed: int, cursor: Optional[dict]) -> None:
+        """
+        Adds the results of sending a batch of invoices ([names]) and moves the checkpoint to [cursor] (the last invoice
+        of the batch), if given. The checkpoint stays where it is if the batch was cut short, so that its remaining
+        invoices are picked up if the run is resumed
+        """
+        self.processed += processed
+        statuses = frappe.get_all(
+            'Sales Invoice Additional Fields',
+            filters={'name': ['in', names], 'last_attempt': ['>=', self.started_at]},
+            fields=['integration_status', 'count(name) as count'],
+            group_by='integration_status',
+        )
+        for row in statuses:
+            if row.integration_status in ('Accepted', 'Accepted with warnings'):
+                self.accepted += row.count
+            elif row.integration_status == 'Resend':
+                self.resend += row.count
+            elif row.integration_status == 'Rejected':
+                self.rejected += row.count
+
+        if cursor:
+            self.cursor_creation = cursor['creation']
+            self.cursor_name = cursor['name']
+        self.save(ignore_permissions=True)
+        frappe.db.commit()
+
+    def finish(self, status: SyncRunEndStatus) -> None:
+        self.status = status
+        self.ended_at = now_datetime()
+        elapsed = time_diff_in_seconds(self.ended_at, self.started_at)
+        self.throughput = self.processed / elapsed if elapsed > 0 else 0
+        self.save(ignore_permissions=True)
+        frappe.db.commit()
+
+
+def _get_previous_run(check_date: Optional[datetime.datetime]) -> Optional[dict]:
+    filters = {'check_date': check_date} if check_date else {'check_date': ['is', 'not set']}
+    runs = frappe.get_all(
+        'ZATCA Sync Run',
+        filters=filters,
+        fields=['name', 'status', 'cursor_creation', 'cursor_name'],
+        order_by='started_at desc',
+        limit=1,
+    )
+    return runs[0] if runs else None
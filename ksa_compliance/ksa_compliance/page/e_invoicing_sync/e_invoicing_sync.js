@@ -22,6 +22,88 @@ function initialize(page, batch_date) {
 		},
 	});
 	let $btn = page.set_primary_action('submit', () => sync_invoices(batch_date));
+
+	let $status = $('<div class="zatca-server-status" style="padding: var(--padding-md)"></div>').appendTo(page.main);
+	let $runs = $('<div class="zatca-sync-runs" style="padding: var(--padding-md)"></div>').appendTo(page.main);
+	page.set_secondary_action(__('Refresh Status'), () => {
+		load_server_status($status);
+		load_sync_runs($runs);
+	});
+	load_server_status($status);
+	load_sync_runs($runs);
+}
+
+function load_server_status($status) {
+	// Shows the circuit breaker state of the ZATCA servers. While a server is open, invoices aren't sent to it
+	frappe.call({
+		method: 'ksa_compliance.background_jobs.get_zatca_server_status',
+		callback: function (r) {
+			let colors = { Closed: 'green', Open: 'red', 'Half-Open': 'orange' };
+			let rows = (r.message || []).map((status) => {
+				let details =
+					status.state === 'Open'
+						? __('Paused after {0} consecutive failures. Retrying in {1}s', [status.failures, status.retry_in])
+						: status.state === 'Half-Open'
+							? __('Checking whether ZATCA is back')
+							: __('Available');
+				return `<p>
+					<span class="indicator-pill ${colors[status.state]}">${__(status.server)}: ${__(status.state)}</span>
+					<span class="text-muted">${details}</span>
+				</p>`;
+			});
+			$status.html(`<h5>${__('ZATCA Servers')}</h5>` + rows.join(''));
+		},
+	});
+}
+
+function load_sync_runs($runs) {
+	// Shows the recent runs of the sync job. Runs that didn't complete are resumed by the next run
+	frappe.call({
+		method: 'ksa_compliance.background_jobs.get_sync_runs',
+		callback: function (r) {
+			let colors = {
+				Running: 'blue',
+				Completed: 'green',
+				'Timed Out': 'orange',
+				Interrupted: 'orange',
+				Failed: 'red',
+			};
+			let rows = (r.message || []).map((run) => {
+				let resumed = run.resumed_from
+					? `<div class="text-muted small">${__('Resumed from {0}', [run.resumed_from])}</div>`
+					: '';
+				return `<tr>
+					<td><a href="/app/zatca-sync-run/${run.name}">${frappe.datetime.str_to_user(run.started_at)}</a>${resumed}</td>
+					<td>${run.ended_at ? frappe.datetime.str_to_user(run.ended_at) : ''}</td>
+					<td><span class="indicator-pill ${colors[run.status]}">${__(run.status)}</span></td>
+					<td class="text-right">${run.processed}</td>
+					<td class="text-right">${run.accepted}</td>
+					<td class="text-right">${run.resend}</td>
+					<td class="text-right">${run.rejected}</td>
+					<td class="text-right">${format_number(run.throughput, null, 2)}</td>
+				</tr>`;
+			});
+			if (!rows.length) {
+				rows.push(`<tr><td colspan="8" class="text-muted">${__('No sync runs yet')}</td></tr>`);
+			}
+			$runs.html(`<h5>${__('Sync History')}</h5>
+				<table class="table table-bordered">
+					<thead>
+						<tr>
+							<th>${__('Started At')}</th>
+							<th>${__('Ended At')}</th>
+							<th>${__('Status')}</th>
+							<th class="text-right">${__('Processed')}</th>
+							<th class="text-right">${__('Accepted')}</th>
+							<th class="text-right">${__('Resend')}</th>
+							<th class="text-right">${__('Rejected')}</th>
+							<th class="text-right">${__('Invoices per Second')}</th>
+						</tr>
+					</thead>
+					<tbody>${rows.join('')}</tbody>
+				</table>`);
+		},
+	});
 }
 
 function sync_invoices(batch_date) {
@@ -0,0 +1,181 @@
+import time
+from functools import partial
+from typing import TYPE_CHECKING, cast
+
+import frappe
+import frappe.utils.background_jobs
+from redis.commands.core import Script
+from result import is_ok
+
+from ksa_compliance import logger
+
+if TYPE_CHECKING:
+    from ksa_compliance.ksa_compliance.doctype.sales_invoice_additional_fields.sales_invoice_additional_fields import (
+        SalesInvoiceAdditionalFields,
+    )
+
+# Invoices submitted with live sync are queued, then sent together by a single job. That job waits up to this many
+# seconds after the first invoice is queued for more to arrive, unless a full batch is queued earlier. Can be overridden
+# using the 'zatca_live_sync_max_delay' site config key. 0 sends each invoice from its own job instead
+DEFAULT_MAX_DELAY_SECONDS = 2.0
+
+# The maximum number of invoices sent by the job at a time. Can be overridden using the 'zatca_live_sync_batch_size'
+# site config key
+DEFAULT_BATCH_SIZE = 50
+
+# How often the job checks whether a full batch was queued while waiting
+POLL_INTERVAL_SECONDS = 0.05
+
+# The job keeps sending batches as long as invoices keep arriving, up to this long. Then it hands over to a new job so
+# that a single job doesn't run forever during a busy day
+MAX_FLUSH_SECONDS = 240
+
+# The timeout of the job. A batch started just before [MAX_FLUSH_SECONDS] gets the remaining time
+FLUSH_JOB_TIMEOUT = 300
+
+# Once queued, the job (and the invoices waiting for it) rely on the scheduled flag. If the job dies without clearing it,
+# it expires after this long and the next invoice queues a new job. Invoices left behind are sent by the batch sync
+SCHEDULED_FLAG_TTL_SECONDS = FLUSH_JOB_TIMEOUT + 60
+
+# Clears the scheduled flag, unless invoices were queued since the job last looked. Checking and clearing in one step
+# guarantees that an invoice is either seen by the running job, or queues a new one
+_RELEASE_SCRIPT = """
+if redis.call('LLEN', KEYS[1]) == 0 then
+    redis.call('DEL', KEYS[2])
+    return 1
+end
+return 0
+"""
+
+_scripts: dict[str, Script] = {}
+
+
+def queue_for_live_sync(siaf: 'SalesInvoiceAdditionalFields') -> None:
+    """
+    Sends [siaf] to ZATCA in the background once the current transaction commits. Invoices queued within a short window
+    (see [DEFAULT_MAX_DELAY_SECONDS]) are sent together by a single job, which shares settings, HTTP connections and
+    the sync concurrency between them
+    """
+    if _get_max_delay() <= 0:
+        frappe.utils.background_jobs.enqueue(
+            submit_additional_fields, enqueue_after_commit=True, **get_job_kwargs(siaf)
+        )
+        return
+
+    frappe.db.after_commit.add(partial(_push, siaf.name))
+
+
+def get_job_kwargs(siaf: 'SalesInvoiceAdditionalFields') -> dict:
+    """
+    Returns the arguments of the job sending [siaf]: its name rather than the document itself, which would be pickled
+    into Redis with its XML and child tables, and would be stale by the time the job runs. The job sends the latest
+    version instead
+    """
+    return {'name': siaf.name}
+
+
+def flush_live_sync_queue() -> None:
+    """Sends the invoices queued by [queue_for_live_sync] in batches until the queue is empty"""
+    from ksa_compliance import background_jobs
+
+    queue_key, flag_key = _get_keys()
+    batch_size = int(frappe.conf.get('zatca_live_sync_batch_size', DEFAULT_BATCH_SIZE))
+    start = time.monotonic()
+    deadline = start + FLUSH_JOB_TIMEOUT - background_jobs.SYNC_DEADLINE_MARGIN_SECONDS
+
+    # Only the first batch waits for more invoices. Later ones were queued while the previous batch was being sent
+    scheduled_at = float(frappe.cache.get(flag_key) or time.time())
+    _wait_for_batch(queue_key, batch_size, scheduled_at + _get_max_delay())
+    while True:
+        names = _pop(queue_key, batch_size)
+        if names:
+            logger.info(f'Live sync: sending {len(names)} invoices')
+            try:
+                background_jobs.submit_invoices(names, deadline)
+            except Exception as e:
+                # Keep going, so that the flag is released or handed over. Unsent invoices are left to the batch sync
+                logger.error(f'Live sync: could not send {len(names)} invoices', exc_info=e)
+                frappe.db.rollback()
+
+        if _get_script(_RELEASE_SCRIPT)(keys=[queue_key, flag_key]):
+            return
+
+        if time.monotonic() - start >= MAX_FLUSH_SECONDS:
+            # The flag stays set, so the new job is the only one sending queued invoices
+            frappe.cache.expire(flag_key, SCHEDULED_FLAG_TTL_SECONDS)
+            _enqueue_flush()
+            return
+
+
+def _push(name: str) -> None:
+    queue_key, flag_key = _get_keys()
+    try:
+        pipeline = frappe.cache.pipeline()
+        pipeline.rpush(queue_key, name)
+        pipeline.set(flag_key, time.time(), nx=True, ex=SCHEDULED_FLAG_TTL_SECONDS)
+        _length, scheduled = pipeline.execute()
+        if scheduled:
+            _enqueue_flush()
+    except Exception as e:
+        # The invoice stays 'Ready For Batch', so the batch sync sends it
+        logger.error(f'Could not queue {name} for live sync', exc_info=e)
+
+
+def _enqueue_flush() -> None:
+    try:
+        frappe.enqueue(
+            'ksa_compliance.live_sync.flush_live_sync_queue',
+            queue='short',
+            timeout=FLUSH_JOB_TIMEOUT,
+            job_name='ZATCA Live Sync',
+        )
+    except Exception:
+        # Let the next invoice try again rather than wait for the flag to expire
+        frappe.cache.delete(_get_keys()[1])
+        raise
+
+
+def _wait_for_batch(queue_key: str, batch_size: int, until: float) -> None:
+    # [frappe.cache.llen] expects a site-prefixed key, so we send the command as is
+    while time.time() < until and frappe.cache.execute_command('LLEN', queue_key) < batch_size:
+        time.sleep(POLL_INTERVAL_SECONDS)
+
+
+def _pop(queue_key: str, count: int) -> list[str]:
+    pipeline = frappe.cache.pipeline()
+    pipeline.lrange(queue_key, 0, count - 1)
+    pipeline.ltrim(queue_key, count, -1)
+    names, _trimmed = pipeline.execute()
+    return [name.decode() for name in names]
+
+
+def submit_additional_fields(name: str):
+    """The job sending a single invoice, queued by [queue_for_live_sync]. Invoices that were already sent are skipped"""
+    from ksa_compliance import background_jobs
+
+    doc = cast('SalesInvoiceAdditionalFields', frappe.get_doc('Sales Invoice Additional Fields', name))
+    if doc.docstatus != 0 or doc.integration_status not in background_jobs.PENDING_INTEGRATION_STATUSES:
+        logger.info(f'Not submitting {name}, it was already sent ({doc.integration_status})')
+        return
+
+    logger.info(f'Submitting {name}')
+    result = doc.submit_to_zatca()
+    message = result.ok_value if is_ok(result) else result.err_value
+    logger.info(f'Submission result: {message}')
+
+
+def _get_max_delay() -> float:
+    return float(frappe.conf.get('zatca_live_sync_max_delay', DEFAULT_MAX_DELAY_SECONDS))
+
+
+def _get_script(source: str) -> Script:
+    script = _scripts.get(source)
+    if script is None:
+        script = _scripts[source] = frappe.cache.register_script(source)
+    return script
+
+
+def _get_keys() -> tuple[str, str]:
+    """Returns the keys of the queue of the current site and of its scheduled flag"""
+    prefix = f'ksa_compliance:live_sync:{frappe.local.site}'
+    return f'{prefix}:queue', f'{prefix}:scheduled'
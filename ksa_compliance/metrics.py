@@ -0,0 +1,216 @@
+import bisect
+import datetime
+import json
+import os
+import random
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Iterator, Literal, Optional, get_args
+
+import frappe
+from frappe.utils import convert_utc_to_system_timezone
+from redis.exceptions import RedisError
+
+from ksa_compliance import logger
+
+# The stages of sending an invoice to ZATCA. 'before_insert' covers the whole preparation of an invoice (including the
+# next four stages), 'send' is the API call (including rate limiting and retries) and 'save' records the response
+Stage = Literal['before_insert', 'einvoice', 'generate_xml', 'sign', 'validate', 'send', 'save']
+STAGES: tuple[Stage, ...] = get_args(Stage)
+
+# Upper bounds (in seconds) of the histogram buckets durations are counted in. Durations beyond the last bound are
+# counted in an extra (+Inf) bucket
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# The fraction of stage executions that are measured. Each measurement is a Redis round trip, so only a few are measured
+# by default; percentiles only need a representative sample. Can be overridden using the 'zatca_metrics_sample_rate'
+# site config key. 0 disables metrics
+DEFAULT_SAMPLE_RATE = 0.05
+
+# How long hourly histograms are kept in Redis if they're never flushed (e.g. the scheduler is disabled)
+HOURLY_RETENTION_SECONDS = 3 * 86400
+
+
+@dataclass
+class Histogram:
+    """Duration counts per bucket (see [BUCKETS]), not cumulative. The last count is the +Inf bucket"""
+
+    counts: list[int]
+    total: float
+
+    @staticmethod
+    def empty() -> 'Histogram':
+        return Histogram([0] * (len(BUCKETS) + 1), 0.0)
+
+    @property
+    def samples(self) -> int:
+        return sum(self.counts)
+
+    def merge(self, other: 'Histogram') -> None:
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.total += other.total
+
+    def get_percentile(self, percentile: float) -> float:
+        """
+        Estimates a percentile (0-1) by interpolating linearly within the bucket it falls in, like Prometheus'
+        histogram_quantile. Durations in the +Inf bucket are reported as the last bound
+        """
+        rank = percentile * self.samples
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                if index == len(BUCKETS):
+                    return BUCKETS[-1]
+                lower = BUCKETS[index - 1] if index else 0
+                return lower + (BUCKETS[index] - lower) * (rank - seen) / count
+            seen += count
+        return 0.0
+
+
+@dataclass(frozen=True)
+class StageMetrics:
+    """
+    Records stage durations into per-site histograms in Redis: one per hour (flushed into ZATCA Metrics by
+    [flush_metrics]) and a running total (exported by [get_prometheus_text]). Recorders don't touch [frappe.local],
+    so they can be used from any thread once created
+    """
+
+    site: str
+    sample_rate: float
+
+    @staticmethod
+    def for_site() -> Optional['StageMetrics']:
+        """Returns a recorder configured from the site config, or None if metrics are disabled"""
+        sample_rate = float(frappe.conf.get('zatca_metrics_sample_rate', DEFAULT_SAMPLE_RATE))
+        if sample_rate <= 0:
+            return None
+        return StageMetrics(site=frappe.local.site, sample_rate=min(sample_rate, 1.0))
+
+    @contextmanager
+    def span(self, stage: Stage) -> Iterator[None]:
+        """Measures the enclosed block as [stage], whether it succeeds or raises"""
+        if random.random() >= self.sample_rate:
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def record(self, stage: Stage, seconds: float) -> None:
+        bucket = bisect.bisect_left(BUCKETS, seconds)
+        hour = int(time.time() // 3600 * 3600)
+        hour_key = _get_hour_key(self.site, hour)
+        try:
+            pipeline = frappe.cache.pipeline(transaction=False)
+            for key in (hour_key, _get_total_key(self.site)):
+                pipeline.hincrby(key, f'{stage}:{bucket}', 1)
+                pipeline.hincrbyfloat(key, f'{stage}:sum', seconds)
+            pipeline.expire(hour_key, HOURLY_RETENTION_SECONDS)
+            pipeline.execute()
+        except RedisError as e:
+            logger.warning(f'Could not record ZATCA metrics: {e}')
+
+
+@contextmanager
+def span(stage: Stage) -> Iterator[None]:
+    """Measures the enclosed block as [stage] for the current site. See [StageMetrics.span]"""
+    metrics = StageMetrics.for_site()
+    if not metrics:
+        yield
+        return
+
+    with metrics.span(stage):
+        yield
+
+
+def flush_metrics() -> None:
+    """
+    Moves the histograms of past hours from Redis into ZATCA Metrics, one record per hour and stage. Runs hourly
+    """
+    site = frappe.local.site
+    current_hour = int(time.time() // 3600 * 3600)
+    hour_keys = {int(key.rpartition(b':')[2]): key for key in frappe.cache.scan_iter(_get_hour_key(site, '*'))}
+    for hour, hour_key in sorted(hour_keys.items()):
+        if hour >= current_hour:
+            continue
+
+        period_start = convert_utc_to_system_timezone(datetime.datetime.fromtimestamp(hour, datetime.timezone.utc))
+        for stage, histogram in _read_histograms(hour_key).items():
+            doc = frappe.new_doc('ZATCA Metrics')
+            doc.update(
+                {
+                    'period_start': period_start.replace(tzinfo=None),
+                    'stage': stage,
+                    'samples': histogram.samples,
+                    'total_seconds': histogram.total,
+                    'mean': histogram.total / histogram.samples if histogram.samples else 0,
+                    'p50': histogram.get_percentile(0.5),
+                    'p95': histogram.get_percentile(0.95),
+                    'p99': histogram.get_percentile(0.99),
+                    'buckets': json.dumps(histogram.counts),
+                }
+            )
+            doc.insert(ignore_permissions=True)
+
+        frappe.db.commit()
+        frappe.cache.delete(hour_key)
+
+
+def write_prometheus_textfile() -> None:
+    """
+    Writes [get_prometheus_text] to the path in the 'zatca_metrics_textfile' site config key, if any, for the
+    node_exporter textfile collector. The file is replaced atomically. Runs every few minutes
+    """
+    path = frappe.conf.get('zatca_metrics_textfile')
+    if not path:
+        return
+
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w') as f:
+        f.write(get_prometheus_text())
+    os.replace(temp_path, path)
+
+
+def get_prometheus_text() -> str:
+    """Returns the running stage histograms of the current site in the Prometheus text exposition format"""
+    site = frappe.local.site
+    histograms = _read_histograms(_get_total_key(site))
+    name = 'ksa_compliance_stage_duration_seconds'
+    lines = [
+        f'# HELP {name} Time spent in each stage of sending an invoice to ZATCA',
+        f'# TYPE {name} histogram',
+    ]
+    for stage, histogram in histograms.items():
+        labels = f'site="{site}",stage="{stage}"'
+        cumulative = 0
+        for bound, count in zip([*BUCKETS, '+Inf'], histogram.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_sum{{{labels}}} {histogram.total}')
+        lines.append(f'{name}_count{{{labels}}} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+def _read_histograms(key: str) -> dict[Stage, Histogram]:
+    # [frappe.cache.hgetall] expects pickled values under site-prefixed keys, hence hscan_iter
+    histograms: dict[Stage, Histogram] = {}
+    for field, value in frappe.cache.hscan_iter(key):
+        stage, _sep, suffix = field.decode().rpartition(':')
+        histogram = histograms.setdefault(stage, Histogram.empty())
+        if suffix == 'sum':
+            histogram.total = float(value)
+        else:
+            histogram.counts[int(suffix)] = int(value)
+    return {stage: histograms[stage] for stage in STAGES if stage in histograms}
+
+
+def _get_hour_key(site: str, hour: int | str) -> str:
+    return f'ksa_compliance:metrics:{site}:hour:{hour}'
+
+
+def _get_total_key(site: str) -> str:
+    return f'ksa_compliance:metrics:{site}:total'
@@ -0,0 +1,381 @@
+"""
+In-process implementation of ZATCA invoice signing. This mirrors what 'zatca-cli sign' does, without starting a JVM:
+
+1. Compute the invoice hash: SHA-256 over the canonical (C14N) form of the invoice, excluding UBLExtensions, the
+   cac:Signature element and the QR additional document reference
+2. Sign the hash using ECDSA (secp256k1) with the EGS private key
+3. Embed a XAdES signature block in UBLExtensions, along with the cac:Signature and QR elements
+4. Build the TLV-encoded QR code
+
+This module intentionally doesn't depend on frappe, so it can be tested and benchmarked on its own.
+"""
+
+import base64
+import datetime
+import hashlib
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from lxml import etree
+
+NAMESPACES = {
+    'inv': 'urn:oasis:names:specification:ubl:schema:xsd:Invoice-2',
+    'cac': 'urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2',
+    'cbc': 'urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2',
+    'ext': 'urn:oasis:names:specification:ubl:schema:xsd:CommonExtensionComponents-2',
+    'ds': 'http://www.w3.org/2000/09/xmldsig#',
+    'xades': 'http://uri.etsi.org/01903/v1.3.2#',
+}
+
+# The elements excluded from the invoice hash, matching the XPath transforms in the signature's SignedInfo
+HASH_EXCLUDED_XPATHS = [
+    '/inv:Invoice/ext:UBLExtensions',
+    '/inv:Invoice/cac:Signature',
+    "/inv:Invoice/cac:AdditionalDocumentReference[normalize-space(cbc:ID)='QR']",
+]
+
+# The signed properties block must be embedded with this exact layout. The signed properties hash is computed over
+# its exclusive canonical form, which preserves whitespace, so any change to the indentation here (or in
+# UBL_EXTENSIONS_TEMPLATE) changes the hash
+SIGNED_PROPERTIES_TEMPLATE = """<xades:SignedProperties Id="xadesSignedProperties">
+                                    <xades:SignedSignatureProperties>
+                                        <xades:SigningTime>{signing_time}</xades:SigningTime>
+                                        <xades:SigningCertificate>
+                                            <xades:Cert>
+                                                <xades:CertDigest>
+                                                    <ds:DigestMethod Algorithm="http://www.w3.org/2001/04/xmlenc#sha256"/>
+                                                    <ds:DigestValue>{certificate_hash}</ds:DigestValue>
+                                                </xades:CertDigest>
+                                                <xades:IssuerSerial>
+                                                    <ds:X509IssuerName>{certificate_issuer}</ds:X509IssuerName>
+                                                    <ds:X509SerialNumber>{certificate_serial_number}</ds:X509SerialNumber>
+                                                </xades:IssuerSerial>
+                                            </xades:Cert>
+                                        </xades:SigningCertificate>
+                                    </xades:SignedSignatureProperties>
+                                </xades:SignedProperties>"""
+
+UBL_EXTENSIONS_TEMPLATE = """<ext:UBLExtensions xmlns:ext="urn:oasis:names:specification:ubl:schema:xsd:CommonExtensionComponents-2" xmlns:cbc="urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2">
+    <ext:UBLExtension>
+        <ext:ExtensionURI>urn:oasis:names:specification:ubl:dsig:enveloped:xades</ext:ExtensionURI>
+        <ext:ExtensionContent>
+            <sig:UBLDocumentSignatures xmlns:sig="urn:oasis:names:specification:ubl:schema:xsd:CommonSignatureComponents-2" xmlns:sac="urn:oasis:names:specification:ubl:schema:xsd:SignatureAggregateComponents-2" xmlns:sbc="urn:oasis:names:specification:ubl:schema:xsd:SignatureBasicComponents-2">
+                <sac:SignatureInformation>
+                    <cbc:ID>urn:oasis:names:specification:ubl:signature:1</cbc:ID>
+                    <sbc:ReferencedSignatureID>urn:oasis:names:specification:ubl:signature:Invoice</sbc:ReferencedSignatureID>
+                    <ds:Signature xmlns:ds="http://www.w3.org/2000/09/xmldsig#" Id="signature">
+                        <ds:SignedInfo>
+                            <ds:CanonicalizationMethod Algorithm="http://www.w3.org/2006/12/xml-c14n11"/>
+                            <ds:SignatureMethod Algorithm="http://www.w3.org/2001/04/xmldsig-more#ecdsa-sha256"/>
+                            <ds:Reference Id="invoiceSignedData" URI="">
+                                <ds:Transforms>
+                                    <ds:Transform Algorithm="http://www.w3.org/TR/1999/REC-xpath-19991116">
+                                        <ds:XPath>not(//ancestor-or-self::ext:UBLExtensions)</ds:XPath>
+                                    </ds:Transform>
+                                    <ds:Transform Algorithm="http://www.w3.org/TR/1999/REC-xpath-19991116">
+                                        <ds:XPath>not(//ancestor-or-self::cac:Signature)</ds:XPath>
+                                    </ds:Transform>
+                                    <ds:Transform Algorithm="http://www.w3.org/TR/1999/REC-xpath-19991116">
+                                        <ds:XPath>not(//ancestor-or-self::cac:AdditionalDocumentReference[cbc:ID='QR'])</ds:XPath>
+                                    </ds:Transform>
+                                    <ds:Transform Algorithm="http://www.w3.org/2006/12/xml-c14n11"/>
+                                </ds:Transforms>
+                                <ds:DigestMethod Algorithm="http://www.w3.org/2001/04/xmlenc#sha256"/>
+                                <ds:DigestValue>{invoice_hash}</ds:DigestValue>
+                            </ds:Reference>
+                            <ds:Reference Type="http://www.w3.org/2000/09/xmldsig#SignatureProperties" URI="#xadesSignedProperties">
+                                <ds:DigestMethod Algorithm="http://www.w3.org/2001/04/xmlenc#sha256"/>
+                                <ds:DigestValue>{signed_properties_hash}</ds:DigestValue>
+                            </ds:Reference>
+                        </ds:SignedInfo>
+                        <ds:SignatureValue>{signature}</ds:SignatureValue>
+                        <ds:KeyInfo>
+                            <ds:X509Data>
+                                <ds:X509Certificate>{certificate}</ds:X509Certificate>
+                            </ds:X509Data>
+                        </ds:KeyInfo>
+                        <ds:Object>
+                            <xades:QualifyingProperties xmlns:xades="http://uri.etsi.org/01903/v1.3.2#" Target="signature">
+                                {signed_properties}
+                            </xades:QualifyingProperties>
+                        </ds:Object>
+                    </ds:Signature>
+                </sac:SignatureInformation>
+            </sig:UBLDocumentSignatures>
+        </ext:ExtensionContent>
+    </ext:UBLExtension>
+</ext:UBLExtensions>"""
+
+SIGNATURE_TEMPLATE = """<cac:Signature xmlns:cac="urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2" xmlns:cbc="urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2">
+        <cbc:ID>urn:oasis:names:specification:ubl:signature:Invoice</cbc:ID>
+        <cbc:SignatureMethod>urn:oasis:names:specification:ubl:dsig:enveloped:xades</cbc:SignatureMethod>
+    </cac:Signature>"""
+
+QR_TEMPLATE = """<cac:AdditionalDocumentReference xmlns:cac="urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2" xmlns:cbc="urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2">
+        <cbc:ID>QR</cbc:ID>
+        <cac:Attachment>
+            <cbc:EmbeddedDocumentBinaryObject mimeCode="text/plain">{qr_code}</cbc:EmbeddedDocumentBinaryObject>
+        </cac:Attachment>
+    </cac:AdditionalDocumentReference>"""
+
+
+_credentials_cache: dict[tuple, 'SigningCredentials'] = {}
+
+
+@dataclass
+class SignedInvoice:
+    """Result of signing an invoice in-process"""
+
+    signed_invoice_xml: str
+    invoice_hash: str
+    qr_code: str
+
+
+@dataclass
+class SigningCertificate:
+    """The certificate an invoice is signed with. This is all that's needed to check a signed invoice"""
+
+    certificate: x509.Certificate
+    certificate_base64: str
+
+    @staticmethod
+    def from_base64(certificate_base64: str) -> 'SigningCertificate':
+        """Loads a DER certificate, as embedded in signed invoices. Raises ValueError if it's invalid"""
+        return SigningCertificate(
+            x509.load_der_x509_certificate(base64.b64decode(certificate_base64)), certificate_base64
+        )
+
+    @property
+    def certificate_hash(self) -> str:
+        """Hex digest of the certificate (base64 text), base64 encoded, as ZATCA expects"""
+        return base64.b64encode(hashlib.sha256(self.certificate_base64.encode()).hexdigest().encode()).decode()
+
+    @property
+    def certificate_issuer(self) -> str:
+        """
+        The issuer of the certificate as the ZATCA SDK writes it (Java's X500Principal), starting from the most specific
+        RDN and separated by ', ', e.g. 'CN=TSZEINVOICE-SubCA-1, DC=extgazt, DC=gov, DC=local'. This is part of the
+        signed properties, so it must match byte for byte
+        """
+        return ', '.join(rdn.rfc4514_string() for rdn in reversed(self.certificate.issuer.rdns))
+
+    @property
+    def public_key_der(self) -> bytes:
+        return self.certificate.public_key().public_bytes(
+            serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+
+
+@dataclass
+class SigningCredentials(SigningCertificate):
+    """A certificate and its private key, loaded once and reusable across invoices"""
+
+    private_key: ec.EllipticCurvePrivateKey
+
+    @staticmethod
+    def load(cert_path: str, private_key_path: str) -> 'SigningCredentials':
+        with open(cert_path, 'rt') as f:
+            certificate_base64 = _strip_pem(f.read())
+        with open(private_key_path, 'rb') as f:
+            private_key = _load_private_key(f.read())
+
+        certificate = x509.load_der_x509_certificate(base64.b64decode(certificate_base64))
+        return SigningCredentials(certificate, certificate_base64, private_key)
+
+    @staticmethod
+    def load_cached(cert_path: str, private_key_path: str) -> 'SigningCredentials':
+        """
+        Like [load], but reuses credentials loaded earlier in this process as long as neither file has changed since
+        (e.g. after getting a new production CSID)
+        """
+        key = (cert_path, os.path.getmtime(cert_path), private_key_path, os.path.getmtime(private_key_path))
+        credentials = _credentials_cache.get(key)
+        if credentials is None:
+            credentials = SigningCredentials.load(cert_path, private_key_path)
+            for stale in [k for k in _credentials_cache if k[0] == cert_path and k[2] == private_key_path]:
+                del _credentials_cache[stale]
+            _credentials_cache[key] = credentials
+        return credentials
+
+
+def sign_invoice(
+    invoice_xml: str, credentials: SigningCredentials, signing_time: Optional[datetime.datetime] = None
+) -> SignedInvoice:
+    """Signs [invoice_xml] and returns the signed XML along with its hash and QR code"""
+    root = etree.fromstring(invoice_xml.encode('utf-8'), parser=_parser())
+    for element in _hash_excluded_elements(root):
+        _remove_preserving_tail(element)
+
+    invoice_hash = compute_invoice_hash(root)
+    signature = base64.b64encode(
+        credentials.private_key.sign(base64.b64decode(invoice_hash), ec.ECDSA(hashes.SHA256()))
+    ).decode()
+
+    signing_time = signing_time or datetime.datetime.now()
+    signed_properties = SIGNED_PROPERTIES_TEMPLATE.format(
+        signing_time=signing_time.strftime('%Y-%m-%dT%H:%M:%S'),
+        certificate_hash=credentials.certificate_hash,
+        certificate_issuer=_escape(credentials.certificate_issuer),
+        certificate_serial_number=credentials.certificate.serial_number,
+    )
+    extensions = etree.fromstring(
+        UBL_EXTENSIONS_TEMPLATE.format(
+            invoice_hash=invoice_hash,
+            signed_properties_hash='',
+            signature=signature,
+            certificate=credentials.certificate_base64,
+            signed_properties=signed_properties,
+        ),
+        parser=_parser(),
+    )
+    signed_properties_element = extensions.find('.//xades:SignedProperties', NAMESPACES)
+    extensions.find(
+        './/ds:Reference[@URI="#xadesSignedProperties"]/ds:DigestValue', NAMESPACES
+    ).text = compute_signed_properties_hash(signed_properties_element)
+
+    qr_code = build_qr_code(root, invoice_hash, signature, credentials)
+
+    # All three elements are inserted without any surrounding whitespace of their own, so removing them (as the hash
+    # transforms do) yields the exact document we hashed above
+    _first_child(root).addprevious(extensions)
+    root.find("cac:AdditionalDocumentReference[cbc:ID='PIH']", NAMESPACES).addnext(
+        etree.fromstring(QR_TEMPLATE.format(qr_code=qr_code), parser=_parser())
+    )
+    root.find('cac:AccountingSupplierParty', NAMESPACES).addprevious(
+        etree.fromstring(SIGNATURE_TEMPLATE, parser=_parser())
+    )
+
+    signed_xml = '<?xml version="1.0" encoding="UTF-8"?>\n' + etree.tostring(root, encoding='unicode')
+    return SignedInvoice(signed_xml, invoice_hash, qr_code)
+
+
+def compute_invoice_hash(root: etree._Element) -> str:
+    """
+    Returns the base64-encoded SHA-256 of the canonical form of [root]. Excluded elements must already be removed.
+
+    The signature declares C14N 1.1, while lxml only implements C14N 1.0. The two only differ for elements whose parent
+    isn't canonicalized (inherited xml:id and xml:base handling), so they produce the same output for a whole document
+    with subtrees removed, which is what the hash covers. That's why only the document element is accepted here
+    """
+    if root.getparent() is not None:
+        raise ValueError('The invoice hash must be computed over the document element')
+
+    canonical = etree.tostring(root, method='c14n', exclusive=False, with_comments=False)
+    return base64.b64encode(hashlib.sha256(canonical).digest()).decode()
+
+
+def compute_signed_properties_hash(signed_properties: etree._Element) -> str:
+    canonical = etree.tostring(signed_properties, method='c14n', exclusive=True, with_comments=False)
+    return base64.b64encode(hashlib.sha256(canonical).hexdigest().encode()).decode()
+
+
+def compute_hash_of_signed_invoice(signed_invoice_xml: str) -> str:
+    """Recomputes the invoice hash of an already signed invoice, applying the transforms from its SignedInfo"""
+    root = etree.fromstring(signed_invoice_xml.encode('utf-8'), parser=_parser())
+    for element in _hash_excluded_elements(root):
+        _remove_preserving_tail(element)
+    return compute_invoice_hash(root)
+
+
+def build_qr_code(root: etree._Element, invoice_hash: str, signature: str, certificate: SigningCertificate) -> str:
+    """
+    Builds the base64-encoded TLV QR code for an invoice. Tags 1-5 come from the invoice itself, 6-7 from signing, 8
+    is the public key, and 9 (the certificate signature) is only included for simplified invoices
+    """
+
+    def text(path: str) -> str:
+        return (root.findtext(path, default='', namespaces=NAMESPACES) or '').strip()
+
+    tags = [
+        text('cac:AccountingSupplierParty/cac:Party/cac:PartyLegalEntity/cbc:RegistrationName').encode(),
+        text('cac:AccountingSupplierParty/cac:Party/cac:PartyTaxScheme/cbc:CompanyID').encode(),
+        f"{text('cbc:IssueDate')}T{text('cbc:IssueTime')}".encode(),
+        text('cac:LegalMonetaryTotal/cbc:TaxInclusiveAmount').encode(),
+        text('cac:TaxTotal/cbc:TaxAmount').encode(),
+        invoice_hash.encode(),
+        signature.encode(),
+        certificate.public_key_der,
+    ]
+
+    invoice_type = root.find('cbc:InvoiceTypeCode', NAMESPACES)
+    if invoice_type is not None and (invoice_type.get('name') or '').startswith('02'):
+        tags.append(certificate.certificate.signature)
+
+    return base64.b64encode(encode_tlv(tags)).decode()
+
+
+def encode_tlv(values: list[bytes]) -> bytes:
+    """Encodes [values] as TLV, using 1-based positions as tags"""
+    result = bytearray()
+    for tag, value in enumerate(values, start=1):
+        if len(value) > 255:
+            raise ValueError(f'QR code tag {tag} is too long ({len(value)} bytes)')
+        result.append(tag)
+        result.append(len(value))
+        result.extend(value)
+    return bytes(result)
+
+
+def decode_tlv(data: bytes) -> dict[int, bytes]:
+    result = {}
+    i = 0
+    while i + 1 < len(data):
+        tag, length = data[i], data[i + 1]
+        result[tag] = data[i + 2 : i + 2 + length]
+        i += 2 + length
+    return result
+
+
+def _hash_excluded_elements(root: etree._Element) -> list[etree._Element]:
+    elements = []
+    for path in HASH_EXCLUDED_XPATHS:
+        elements.extend(root.xpath(path, namespaces=NAMESPACES))
+    return elements
+
+
+def _remove_preserving_tail(element: etree._Element) -> None:
+    """
+    Removes an element from its parent, keeping its tail text. lxml removes the tail along with the element, but the
+    XPath transforms in the signature only remove the element node, leaving the whitespace after it in place
+    """
+    parent = element.getparent()
+    if element.tail:
+        previous = element.getprevious()
+        if previous is not None:
+            previous.tail = (previous.tail or '') + element.tail
+        else:
+            parent.text = (parent.text or '') + element.tail
+    parent.remove(element)
+
+
+def _first_child(root: etree._Element) -> etree._Element:
+    return next(child for child in root if isinstance(child.tag, str))
+
+
+def _strip_pem(pem: str) -> str:
+    return ''.join(line.strip() for line in pem.splitlines() if line.strip() and not line.startswith('-----'))
+
+
+def _load_private_key(content: bytes) -> ec.EllipticCurvePrivateKey:
+    # Keys generated by the CLI are PEM, but the sandbox key is stored as bare base64-encoded DER
+    if content.lstrip().startswith(b'-----'):
+        key = serialization.load_pem_private_key(content, password=None)
+    else:
+        key = serialization.load_der_private_key(base64.b64decode(_strip_pem(content.decode())), password=None)
+
+    if not isinstance(key, ec.EllipticCurvePrivateKey):
+        raise ValueError('Expected an EC private key')
+    return key
+
+
+def _escape(value: str) -> str:
+    return value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def _parser() -> etree.XMLParser:
+    # Whitespace is significant for the invoice and signed properties hashes, so we never strip blank text
+    return etree.XMLParser(remove_blank_text=False, resolve_entities=False, no_network=True)
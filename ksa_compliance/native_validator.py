@@ -0,0 +1,275 @@
+"""
+In-process validation of signed invoices. This mirrors what 'zatca-cli validate' does, without starting a JVM:
+
+1. XSD validation against the UBL 2.1 invoice schema
+2. EN 16931 (BR-*) and ZATCA (BR-KSA-*) business rules, using the schematron XSLs shipped with the ZATCA SDK
+3. Signature validation: the invoice and signed properties digests, and the ECDSA signature itself
+4. QR validation: the embedded QR must match the invoice, its hash and signature
+5. The previous invoice hash (PIH) must match the one we expect
+
+The schema and rules are read from the SDK data that ships with the CLI (the same base path passed to
+'zatca-cli validate -b'), compiled once per process and cached. The schematron XSLs are XSLT 2.0, which lxml doesn't
+support, so the business rules require the optional 'saxonche' package.
+"""
+
+import base64
+import fnmatch
+import os
+import threading
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from lxml import etree
+
+import ksa_compliance.native_signer as native_signer
+from ksa_compliance.native_signer import NAMESPACES
+from ksa_compliance.zatca_cli import ValidationDetails, ValidationResult
+
+INVOICE_SCHEMA_FILE = 'UBL-Invoice-2.1.xsd'
+EN_RULES_FILE = 'CEN-EN16931-UBL.xsl'
+KSA_RULES_PATTERN = '*ZATCA*Validation*Rules*.xsl'
+
+SVRL_NAMESPACE = 'http://purl.oclc.org/dsdl/svrl'
+
+_rules_cache: dict[tuple, 'CompiledRules'] = {}
+# Why the rules couldn't be loaded, so that invoices fall back to the CLI straight away instead of looking for the SDK
+# data (or saxonche) every time
+_unavailable_cache: dict[tuple, 'NativeValidatorUnavailable'] = {}
+_rules_cache_lock = threading.Lock()
+
+
+class NativeValidatorUnavailable(Exception):
+    """Raised when the native validator can't be used, e.g. the SDK data or saxonche are missing"""
+
+    pass
+
+
+@dataclass
+class CompiledRules:
+    schema: etree.XMLSchema
+    # Kept alive for as long as the compiled stylesheets are in use
+    processor: Any
+    # (name, compiled stylesheet) pairs
+    stylesheets: list[tuple[str, Any]]
+    lock: threading.Lock
+
+    @staticmethod
+    def load(base_path: str) -> 'CompiledRules':
+        try:
+            from saxonche import PySaxonApiError, PySaxonProcessor
+        except ImportError:
+            raise NativeValidatorUnavailable('saxonche is not installed')
+
+        schema_path = _find_file(base_path, INVOICE_SCHEMA_FILE)
+        en_rules_path = _find_file(base_path, EN_RULES_FILE)
+        ksa_rules_path = _find_file(base_path, KSA_RULES_PATTERN)
+
+        try:
+            schema = etree.XMLSchema(etree.parse(schema_path))
+        except (etree.XMLSchemaParseError, etree.XMLSyntaxError, OSError) as e:
+            raise NativeValidatorUnavailable(f'Could not load {schema_path}: {e}')
+
+        processor = PySaxonProcessor(license=False)
+        xslt = processor.new_xslt30_processor()
+        try:
+            stylesheets = [
+                ('EN', xslt.compile_stylesheet(stylesheet_file=en_rules_path)),
+                ('KSA', xslt.compile_stylesheet(stylesheet_file=ksa_rules_path)),
+            ]
+        except PySaxonApiError as e:
+            raise NativeValidatorUnavailable(f'Could not compile the business rules: {e}')
+        return CompiledRules(schema, processor, stylesheets, threading.Lock())
+
+    @staticmethod
+    def load_cached(base_path: str) -> 'CompiledRules':
+        """
+        Like [load], but reuses the rules compiled earlier in this process. If they couldn't be loaded, that's
+        remembered too, so [NativeValidatorUnavailable] is raised again without looking for the SDK data
+        """
+        # Compiled stylesheets hold native resources, so they're never shared with forked processes
+        key = (os.getpid(), base_path)
+        with _rules_cache_lock:
+            rules = _rules_cache.get(key)
+            if rules is None:
+                unavailable = _unavailable_cache.get(key)
+                if unavailable:
+                    raise unavailable
+
+                try:
+                    rules = CompiledRules.load(base_path)
+                except NativeValidatorUnavailable as e:
+                    _unavailable_cache[key] = e
+                    raise
+                _rules_cache[key] = rules
+            return rules
+
+    def apply_rules(self, signed_invoice_xml: str) -> tuple[dict[str, str], dict[str, str]]:
+        """Runs the business rules against [signed_invoice_xml], returning (errors, warnings)"""
+        errors, warnings = {}, {}
+        with self.lock:
+            document = self.processor.parse_xml(xml_text=signed_invoice_xml)
+            reports = [stylesheet.transform_to_string(xdm_node=document) for _, stylesheet in self.stylesheets]
+
+        for report in reports:
+            for code, message, is_error in _parse_svrl(report):
+                (errors if is_error else warnings)[code] = message
+        return errors, warnings
+
+
+def validate_invoice(signed_invoice_xml: str, base_path: str, previous_invoice_hash: str) -> ValidationResult:
+    """
+    Validates [signed_invoice_xml] using the SDK data under [base_path]. Raises [NativeValidatorUnavailable] if the
+    SDK data or saxonche are missing
+    """
+    rules = CompiledRules.load_cached(base_path)
+    root = etree.fromstring(signed_invoice_xml.encode('utf-8'), parser=native_signer._parser())
+
+    messages = []
+    errors, warnings = {}, {}
+
+    if rules.schema.validate(root):
+        messages.append('XSD validation: PASSED')
+    else:
+        messages.append('XSD validation: FAILED')
+        errors['XSD_ZATCA_INVALID'] = '\n'.join(str(e.message) for e in rules.schema.error_log)
+
+    rule_errors, rule_warnings = rules.apply_rules(signed_invoice_xml)
+    errors.update(rule_errors)
+    warnings.update(rule_warnings)
+    messages.append('Business rules validation: ' + ('FAILED' if rule_errors else 'PASSED'))
+
+    invoice_hash = native_signer.compute_hash_of_signed_invoice(signed_invoice_xml)
+    signature_error = _check_signature(root, invoice_hash)
+    is_valid_signature = signature_error is None
+    if signature_error:
+        errors['SIGNATURE_INVALID'] = signature_error
+    messages.append('Signature validation: ' + ('PASSED' if is_valid_signature else 'FAILED'))
+
+    qr_error = _check_qr_code(root, invoice_hash)
+    is_valid_qr = qr_error is None
+    if qr_error:
+        errors['QRCODE_INVALID'] = qr_error
+    messages.append('QR validation: ' + ('PASSED' if is_valid_qr else 'FAILED'))
+
+    pih = _text(root, "cac:AdditionalDocumentReference[cbc:ID='PIH']/cac:Attachment/cbc:EmbeddedDocumentBinaryObject")
+    if pih != previous_invoice_hash:
+        errors['PIH_INVALID'] = f'Previous invoice hash {pih} does not match the expected hash {previous_invoice_hash}'
+    messages.append('PIH validation: ' + ('PASSED' if pih == previous_invoice_hash else 'FAILED'))
+
+    errors_and_warnings = [f'[ERROR] {code}: {message}' for code, message in errors.items()]
+    errors_and_warnings += [f'[WARNING] {code}: {message}' for code, message in warnings.items()]
+    details = ValidationDetails(
+        is_valid=not errors,
+        is_valid_qr=is_valid_qr,
+        is_valid_signature=is_valid_signature,
+        errors=errors,
+        warnings=warnings,
+    )
+    return ValidationResult(messages, errors_and_warnings, details)
+
+
+def diff_results(cli_result: ValidationResult, native_result: ValidationResult) -> list[str]:
+    """Returns a human-readable list of differences between the CLI and native validation results"""
+    differences = []
+    if not cli_result.details or not native_result.details:
+        return differences
+
+    for kind in ('errors', 'warnings'):
+        cli_codes = set(getattr(cli_result.details, kind))
+        native_codes = set(getattr(native_result.details, kind))
+        for code in sorted(cli_codes - native_codes):
+            differences.append(f'{kind[:-1].capitalize()} {code} reported by CLI only')
+        for code in sorted(native_codes - cli_codes):
+            differences.append(f'{kind[:-1].capitalize()} {code} reported by native validator only')
+
+    for flag in ('is_valid', 'is_valid_qr', 'is_valid_signature'):
+        cli_value, native_value = getattr(cli_result.details, flag), getattr(native_result.details, flag)
+        if cli_value != native_value:
+            differences.append(f'{flag}: CLI={cli_value}, native={native_value}')
+    return differences
+
+
+def _check_signature(root: etree._Element, invoice_hash: str) -> Optional[str]:
+    signature = root.find('.//ds:Signature', NAMESPACES)
+    if signature is None:
+        return 'Invoice is not signed'
+
+    digest = _text(signature, "ds:SignedInfo/ds:Reference[@Id='invoiceSignedData']/ds:DigestValue")
+    if digest != invoice_hash:
+        return f'Invoice digest {digest} does not match the invoice hash {invoice_hash}'
+
+    signed_properties = signature.find('.//xades:SignedProperties', NAMESPACES)
+    if signed_properties is None:
+        return 'Signed properties are missing'
+    digest = _text(signature, "ds:SignedInfo/ds:Reference[@URI='#xadesSignedProperties']/ds:DigestValue")
+    if digest != native_signer.compute_signed_properties_hash(signed_properties):
+        return 'Signed properties digest does not match'
+
+    try:
+        certificate = x509.load_der_x509_certificate(
+            base64.b64decode(_text(signature, 'ds:KeyInfo/ds:X509Data/ds:X509Certificate'))
+        )
+        certificate.public_key().verify(
+            base64.b64decode(_text(signature, 'ds:SignatureValue')),
+            base64.b64decode(invoice_hash),
+            ec.ECDSA(hashes.SHA256()),
+        )
+    except InvalidSignature:
+        return 'Signature value does not match the invoice hash'
+    except ValueError as e:
+        return f'Invalid certificate or signature: {e}'
+    return None
+
+
+def _check_qr_code(root: etree._Element, invoice_hash: str) -> Optional[str]:
+    qr_code = _text(
+        root, "cac:AdditionalDocumentReference[cbc:ID='QR']/cac:Attachment/cbc:EmbeddedDocumentBinaryObject"
+    )
+    if not qr_code:
+        return 'QR code is missing'
+
+    try:
+        certificate = native_signer.SigningCertificate.from_base64(_text(root, './/ds:X509Certificate'))
+    except ValueError as e:
+        return f'Invalid certificate: {e}'
+
+    expected = native_signer.build_qr_code(root, invoice_hash, _text(root, './/ds:SignatureValue'), certificate)
+    if qr_code != expected:
+        actual_tags = native_signer.decode_tlv(base64.b64decode(qr_code))
+        expected_tags = native_signer.decode_tlv(base64.b64decode(expected))
+        mismatched = sorted(
+            tag for tag in expected_tags.keys() | actual_tags.keys() if expected_tags.get(tag) != actual_tags.get(tag)
+        )
+        return f'QR code does not match the invoice (tags {", ".join(str(t) for t in mismatched)})'
+    return None
+
+
+def _parse_svrl(report: str) -> list[tuple[str, str, bool]]:
+    """Returns (code, message, is_error) for each failed assertion in a schematron validation report"""
+    results = []
+    root = etree.fromstring(report.encode('utf-8'))
+    for failure in root.iter(f'{{{SVRL_NAMESPACE}}}failed-assert', f'{{{SVRL_NAMESPACE}}}successful-report'):
+        text = ' '.join(''.join(failure.itertext()).split())
+        code = failure.get('id')
+        # Rules are phrased as '[BR-KSA-08]-The seller identification...'
+        if text.startswith('[') and ']' in text:
+            code = code or text[1 : text.index(']')]
+            text = text[text.index(']') + 1 :].lstrip('-').strip()
+        results.append((code or failure.get('location', ''), text, failure.get('flag', 'fatal') != 'warning'))
+    return results
+
+
+def _find_file(base_path: str, pattern: str) -> str:
+    for directory, _, files in os.walk(base_path):
+        for name in sorted(files):
+            if fnmatch.fnmatch(name, pattern):
+                return os.path.join(directory, name)
+    raise NativeValidatorUnavailable(f'Could not find {pattern} under {base_path}')
+
+
+def _text(element: etree._Element, path: str) -> str:
+    return (element.findtext(path, default='', namespaces=NAMESPACES) or '').strip()
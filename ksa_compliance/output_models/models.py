@@ -3,7 +3,7 @@ from typing import Optional, List
 from erpnext.stock.doctype.item.item import Item
 
 
-@dataclass
+@dataclass(frozen=True)
 class ZatcaTaxCategory:
     """Holds ZATCA tax category code, reason and reason code"""
 
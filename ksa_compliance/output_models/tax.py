@@ -1,8 +1,8 @@
 import frappe
 
-from ksa_compliance.standard_doctypes.tax_category import map_tax_category
+from ksa_compliance.standard_doctypes.tax_category import map_tax_category, map_zatca_category
 from .service import get_right_fieldname, dataclass_to_frappe_dict
-from .models import TaxCategory, TaxCategoryByItems, TaxTotal, TaxSubtotal, AllowanceCharge
+from .models import TaxCategory, TaxCategoryByItems, TaxTotal, TaxSubtotal, AllowanceCharge, ZatcaTaxCategory
 
 from erpnext.accounts.doctype.sales_invoice.sales_invoice import SalesInvoice
 from erpnext.accounts.doctype.payment_entry.payment_entry import PaymentEntry
@@ -54,24 +54,16 @@ def create_tax_categories(doc: SalesInvoice | PaymentEntry, item_lines: list, is
 
     check_item_tax_template(doc, item_lines, sales_taxes_and_charges_template)
 
+    # Lines mostly share a handful of templates, so we resolve each template once rather than once per line
+    template_categories = _get_item_tax_template_categories(set(item_tax_templates))
+    taxes_and_charges_category = None
     for row in item_lines:
         if not row.item_tax_template and sales_taxes_and_charges_template:
-            tax_category_id = frappe.db.get_value(
-                'Sales Taxes and Charges Template', sales_taxes_and_charges_template, 'tax_category'
-            )
-            tax_category_id = map_tax_category(tax_category_id=tax_category_id)
-            tax_category_percent = frappe.db.get_value(
-                'Sales Taxes and Charges', {'parent': sales_taxes_and_charges_template}, 'rate'
-            )
-            zatca_category = frappe.db.get_value('Tax Category', tax_category_id, 'custom_zatca_category')
+            if taxes_and_charges_category is None:
+                taxes_and_charges_category = _get_taxes_and_charges_template_category(sales_taxes_and_charges_template)
+            zatca_category, tax_category_id, tax_category_percent = taxes_and_charges_category
         else:
-            tax_category_id = map_tax_category(item_tax_template_id=row.item_tax_template)
-            tax_category_percent = frappe.db.get_value(
-                'Item Tax Template Detail', {'parent': row.item_tax_template}, 'tax_rate'
-            )
-            zatca_category = frappe.db.get_value(
-                'Item Tax Template', row.item_tax_template, 'custom_zatca_item_tax_category'
-            )
+            zatca_category, tax_category_id, tax_category_percent = template_categories[row.item_tax_template]
         tax_category = TaxCategory(
             zatca_tax_category_id=tax_category_id, percent=tax_category_percent, tax_scheme_id='VAT'
         )
@@ -85,6 +77,41 @@ def create_tax_categories(doc: SalesInvoice | PaymentEntry, item_lines: list, is
     return tax_category_map
 
 
+def _get_item_tax_template_categories(templates: set[str]) -> dict[str, tuple[str, ZatcaTaxCategory, float]]:
+    """Returns the ZATCA category (as set on the template), tax category and rate of each of [templates]"""
+    if not templates:
+        return {}
+
+    rates = {}
+    for detail in frappe.get_all(
+        'Item Tax Template Detail',
+        filters={'parent': ['in', list(templates)], 'parenttype': 'Item Tax Template'},
+        fields=['parent', 'tax_rate'],
+        order_by='idx asc',
+    ):
+        rates.setdefault(detail.parent, detail.tax_rate)
+
+    categories = {}
+    for template in frappe.get_all(
+        'Item Tax Template',
+        filters={'name': ['in', list(templates)]},
+        fields=['name', 'custom_zatca_item_tax_category', 'custom_category_reason'],
+    ):
+        tax_category = map_zatca_category(template.custom_zatca_item_tax_category, template.custom_category_reason)
+        categories[template.name] = (template.custom_zatca_item_tax_category, tax_category, rates.get(template.name))
+    return categories
+
+
+def _get_taxes_and_charges_template_category(template: str) -> tuple[str, ZatcaTaxCategory, float]:
+    """Returns the ZATCA category (as set on its tax category), tax category and rate of a taxes and charges template"""
+    tax_category_id = frappe.db.get_value('Sales Taxes and Charges Template', template, 'tax_category')
+    zatca_category, custom_category_reason = frappe.db.get_value(
+        'Tax Category', tax_category_id, ['custom_zatca_category', 'custom_category_reason']
+    ) or (None, None)
+    tax_category_percent = frappe.db.get_value('Sales Taxes and Charges', {'parent': template}, 'rate')
+    return zatca_category, map_zatca_category(zatca_category, custom_category_reason), tax_category_percent
+
+
 def check_item_tax_template(doc: SalesInvoice, item_lines: list, sales_taxes_and_charges_template: str) -> None:
     invalid_items = [row.item_name for row in item_lines if not row.item_tax_template]
     if invalid_items and not sales_taxes_and_charges_template:
@@ -0,0 +1,11 @@
+import frappe
+
+from ksa_compliance.ksa_compliance.doctype.sales_invoice_additional_fields.sales_invoice_additional_fields import (
+    SYNC_QUEUE_INDEX,
+    SYNC_QUEUE_INDEX_COLUMNS,
+)
+
+
+def execute():
+    # New sites get the index from [on_doctype_update]. On a large table, this may take a while
+    frappe.db.add_index('Sales Invoice Additional Fields', SYNC_QUEUE_INDEX_COLUMNS, SYNC_QUEUE_INDEX)
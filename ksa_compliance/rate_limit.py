@@ -0,0 +1,170 @@
+import email.utils
+import hashlib
+import random
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+import frappe
+from redis.commands.core import Script
+from redis.exceptions import RedisError
+
+from ksa_compliance import logger
+
+# The sustained number of API calls per second to a ZATCA server using the same credentials, and the number of calls
+# that can be made in a burst. Can be overridden using the 'zatca_rate_limit_per_second' and 'zatca_rate_limit_burst'
+# site config keys. A rate of 0 disables rate limiting
+DEFAULT_RATE_PER_SECOND = 10
+DEFAULT_BURST = 20
+
+# When ZATCA throttles us, the rate is halved down to this fraction of the configured rate, then recovers gradually
+MIN_RATE_FRACTION = 0.1
+RATE_RECOVERY_FRACTION = 0.01
+
+# How long a call may wait for the rate limiter when the caller doesn't have a deadline of its own
+DEFAULT_MAX_WAIT_SECONDS = 60
+
+# Retry-After values beyond this are treated as this. We'd rather check again than park a worker for an hour
+MAX_RETRY_AFTER_SECONDS = 300
+
+# Bucket state is shared by all sites and workers, since ZATCA limits are per server and credentials rather than per
+# site. The hash holds the available tokens, the current rate, the last refill time and the time until which calls
+# are blocked (Retry-After)
+_ACQUIRE_SCRIPT = """
+local max_rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local recovery = tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'rate', 'updated', 'blocked_until')
+local tokens = tonumber(state[1]) or burst
+local rate = math.min(tonumber(state[2]) or max_rate, max_rate)
+local updated = tonumber(state[3]) or now
+local blocked_until = tonumber(state[4]) or 0
+if blocked_until > now then
+    return tostring(blocked_until - now)
+end
+
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    rate = math.min(max_rate, rate + max_rate * recovery)
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'rate', tostring(rate), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 3600)
+return tostring(wait)
+"""
+
+_THROTTLE_SCRIPT = """
+local max_rate = tonumber(ARGV[1])
+local blocked_until = tonumber(ARGV[2])
+local min_rate = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'rate', 'blocked_until')
+local rate = math.max(min_rate, (tonumber(state[1]) or max_rate) / 2)
+blocked_until = math.max(blocked_until, tonumber(state[2]) or 0)
+redis.call('HSET', KEYS[1], 'tokens', '0', 'rate', tostring(rate), 'blocked_until', tostring(blocked_until))
+redis.call('EXPIRE', KEYS[1], 3600)
+return tostring(rate)
+"""
+
+_scripts: dict[str, Script] = {}
+
+
+class RateLimitExceeded(Exception):
+    """Raised when an API call can't be made within its deadline because of rate limiting"""
+
+    def __init__(self, wait: float):
+        super().__init__(f'ZATCA rate limit exceeded. The next call is allowed in {wait:.1f}s')
+        self.wait = wait
+
+
+@dataclass(frozen=True)
+class RateLimiter:
+    """
+    A token bucket limiting API calls per ZATCA server and credentials, shared by all workers through Redis. Limiters
+    don't touch [frappe.local], so they can be used from any thread once created
+    """
+
+    rate: float
+    burst: int
+
+    @staticmethod
+    def for_site() -> Optional['RateLimiter']:
+        """Returns a limiter configured from the site config, or None if rate limiting is disabled"""
+        rate = float(frappe.conf.get('zatca_rate_limit_per_second', DEFAULT_RATE_PER_SECOND))
+        if rate <= 0:
+            return None
+        return RateLimiter(rate=rate, burst=max(int(frappe.conf.get('zatca_rate_limit_burst', DEFAULT_BURST)), 1))
+
+    def acquire(self, server: str, credential: str, deadline: Optional[float] = None) -> None:
+        """
+        Blocks until a call to [server] using [credential] is allowed. Raises [RateLimitExceeded] if that can't happen
+        before [deadline] (a [time.monotonic] value). If Redis is unavailable, calls are not limited
+        """
+        deadline = deadline or time.monotonic() + DEFAULT_MAX_WAIT_SECONDS
+        key = _get_key(server, credential)
+        while True:
+            try:
+                args = [self.rate, self.burst, time.time(), RATE_RECOVERY_FRACTION]
+                wait = float(_get_script(_ACQUIRE_SCRIPT)(keys=[key], args=args))
+            except RedisError as e:
+                logger.warning(f'Could not check the ZATCA rate limit, continuing without it: {e}')
+                return
+
+            if wait <= 0:
+                return
+
+            if time.monotonic() + wait >= deadline:
+                raise RateLimitExceeded(wait)
+
+            # Jitter spreads out the workers that were all waiting for the same token
+            time.sleep(wait + random.uniform(0, 1 / self.rate))
+
+    def throttle(self, server: str, credential: str, retry_after: float) -> None:
+        """Blocks calls to [server] using [credential] for [retry_after] seconds and halves the rate"""
+        try:
+            rate = float(
+                _get_script(_THROTTLE_SCRIPT)(
+                    keys=[_get_key(server, credential)],
+                    args=[self.rate, time.time() + retry_after, self.rate * MIN_RATE_FRACTION],
+                )
+            )
+            logger.info(f'ZATCA is throttling {server}. Pausing for {retry_after:.1f}s, then sending {rate:g}/s')
+        except RedisError as e:
+            logger.warning(f'Could not record ZATCA throttling: {e}')
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parses a Retry-After header, which is either a number of seconds or an HTTP date"""
+    if not value:
+        return None
+
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+
+    return min(max(seconds, 0), MAX_RETRY_AFTER_SECONDS)
+
+
+def get_backoff(attempt: int, base: float = 1, cap: float = 30) -> float:
+    """Returns the delay before retry number [attempt] (starting at 0): exponential backoff with full jitter"""
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+def _get_key(server: str, credential: str) -> str:
+    # Credentials are hashed so that tokens don't end up in Redis keys
+    digest = hashlib.sha256(f'{server}\n{credential}'.encode()).hexdigest()
+    return f'ksa_compliance:rate_limit:{digest}'
+
+
+def _get_script(source: str) -> Script:
+    script = _scripts.get(source)
+    if script is None:
+        script = _scripts[source] = frappe.cache.register_script(source)
+    return script
@@ -9,11 +9,10 @@ from erpnext.accounts.doctype.payment_entry.payment_entry import PaymentEntry
 
 
 from ksa_compliance import logger
+from ksa_compliance.live_sync import queue_for_live_sync, submit_additional_fields
 from ksa_compliance.throw import fthrow
 from ksa_compliance.translation import ft
 
-from result import is_ok
-
 
 def validate_payment_entry(self: PaymentEntry, method: str = None):
     if not getattr(self, 'custom_prepayment_invoice', None):
@@ -65,16 +64,12 @@ def create_prepayment_invoice_additional_fields_doctype(self: PaymentEntry, meth
     if is_live_sync:
         # We're running in the context of invoice submission (on_submit hook). We only want to run our ZATCA logic if
         # the invoice submits successfully after on_submit is run successfully from all apps.
-        frappe.utils.background_jobs.enqueue(
-            _submit_additional_fields, doc=prepayment_additional_fields_doc, enqueue_after_commit=True
-        )
+        queue_for_live_sync(prepayment_additional_fields_doc)
 
 
 def _submit_additional_fields(doc: SalesInvoiceAdditionalFields):
-    logger.info(f'Submitting {doc.name}')
-    result = doc.submit_to_zatca()
-    message = result.ok_value if is_ok(result) else result.err_value
-    logger.info(f'Submission result: {message}')
+    # Live sync jobs queued before upgrading still call this with the document. See [live_sync.submit_additional_fields]
+    submit_additional_fields(doc.name)
 
 
 def prevent_cancellation_of_prepayment_invoice(self: PaymentEntry, method):
@@ -2,14 +2,13 @@ from datetime import date
 from typing import Dict, Optional, cast
 
 import frappe
-import frappe.utils.background_jobs
 from erpnext.accounts.doctype.pos_invoice.pos_invoice import POSInvoice
 from erpnext.accounts.doctype.sales_invoice.sales_invoice import SalesInvoice
 from erpnext.selling.doctype.customer.customer import Customer
 from frappe import _
-from result import is_ok
 
 from ksa_compliance import logger
+from ksa_compliance.live_sync import queue_for_live_sync, submit_additional_fields
 from ksa_compliance.ksa_compliance.doctype.sales_invoice_additional_fields.sales_invoice_additional_fields import (
     SalesInvoiceAdditionalFields,
     is_b2b_customer,
@@ -92,16 +91,12 @@ def create_sales_invoice_additional_fields_doctype(self: SalesInvoice | POSInvoi
     if is_live_sync:
         # We're running in the context of invoice submission (on_submit hook). We only want to run our ZATCA logic if
         # the invoice submits successfully after on_submit is run successfully from all apps.
-        frappe.utils.background_jobs.enqueue(
-            _submit_additional_fields, doc=si_additional_fields_doc, enqueue_after_commit=True
-        )
+        queue_for_live_sync(si_additional_fields_doc)
 
 
 def _submit_additional_fields(doc: SalesInvoiceAdditionalFields):
-    logger.info(f'Submitting {doc.name}')
-    result = doc.submit_to_zatca()
-    message = result.ok_value if is_ok(result) else result.err_value
-    logger.info(f'Submission result: {message}')
+    # Live sync jobs queued before upgrading still call this with the document. See [live_sync.submit_additional_fields]
+    submit_additional_fields(doc.name)
 
 
 def _should_enable_zatca_for_invoice(invoice_id: str) -> bool:
@@ -0,0 +1,61 @@
+# Copyright (c) 2026, LavaLoon and Contributors
+# See license.txt
+import datetime
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from ksa_compliance.background_jobs import build_query
+from ksa_compliance.ksa_compliance.doctype.sales_invoice_additional_fields.sales_invoice_additional_fields import (
+    SYNC_QUEUE_INDEX,
+    on_doctype_update,
+)
+
+# Far enough in the future not to pick up invoices created by other tests
+SHARED_CREATION = datetime.datetime(2099, 1, 1, 12, 0, 0)
+
+# Rows added before checking the query plan. The optimizer picks indexes based on the number of rows it expects to read
+SEEDED_ROWS = 2000
+
+
+class TestSyncQueueQuery(FrappeTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        on_doctype_update()
+
+    def test_query_uses_sync_queue_index(self):
+        if frappe.db.db_type != 'mariadb':
+            self.skipTest('EXPLAIN output is MariaDB specific')
+
+        # The optimizer may scan a (nearly) empty table rather than use any index, so give it rows like a real site's:
+        # many invoices created after the sync's offset, most of them already sent. Only the sync queue index narrows
+        # those down to the pending ones; an index on creation alone would have to read all of them
+        rows = []
+        for index in range(SEEDED_ROWS):
+            creation = SHARED_CREATION + datetime.timedelta(seconds=index + 1)
+            rows.append((f'TEST-SYNC-INDEX-{index}', creation, creation, 1, 'Accepted'))
+        frappe.db.bulk_insert(
+            'Sales Invoice Additional Fields', ['name', 'creation', 'modified', 'docstatus', 'integration_status'], rows
+        )
+
+        for after_name in (None, 'SIAF-0001'):
+            query = build_query(SHARED_CREATION, 100, after_name)
+            plan = frappe.db.sql(f'EXPLAIN {query.get_sql()}', as_dict=True)
+            self.assertEqual(plan[0].key, SYNC_QUEUE_INDEX, plan)
+
+    def test_cursor_does_not_skip_invoices_sharing_a_creation(self):
+        names = [f'TEST-SYNC-QUEUE-{index}' for index in range(5)]
+        frappe.db.bulk_insert(
+            'Sales Invoice Additional Fields',
+            ['name', 'creation', 'modified', 'docstatus', 'integration_status'],
+            [(name, SHARED_CREATION, SHARED_CREATION, 0, 'Ready For Batch') for name in names],
+        )
+
+        seen = []
+        offset, offset_name = SHARED_CREATION - datetime.timedelta(seconds=1), None
+        while batch := build_query(offset, 2, offset_name).run(as_dict=True):
+            seen.extend(row.name for row in batch)
+            offset, offset_name = batch[-1].creation, batch[-1].name
+
+        self.assertEqual(seen, names)
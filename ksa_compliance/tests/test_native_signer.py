@@ -0,0 +1,270 @@
+# Copyright (c) 2024, LavaLoon and Contributors
+# See license.txt
+import base64
+import ctypes
+import ctypes.util
+import datetime
+import hashlib
+import json
+import os
+import tempfile
+import unittest
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+from frappe.tests.utils import FrappeTestCase
+from lxml import etree
+
+from ksa_compliance import native_signer
+from ksa_compliance.native_signer import NAMESPACES, SigningCredentials, decode_tlv
+
+FIXTURES_PATH = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+# A fixed certificate and key, so that the CLI output for them can be committed as golden files. The issuer is shaped
+# like the ZATCA sandbox one, which the SDK writes as below
+CERTIFICATE_FIXTURE = 'signing_certificate.pem'
+PRIVATE_KEY_FIXTURE = 'signing_private_key.pem'
+SDK_CERTIFICATE_ISSUER = 'CN=TSZEINVOICE-SubCA-1, DC=extgazt, DC=gov, DC=local'
+
+# The output of 'zatca-cli sign' for simplified_invoice.xml using the fixed certificate and key: the signed XML, and
+# the hash and QR code it reported. Written by [TestNativeSigner.test_matches_cli] if ZATCA_WRITE_GOLDENS is set
+CLI_SIGNED_INVOICE_FIXTURE = 'simplified_invoice.cli_signed.xml'
+CLI_SIGNING_RESULT_FIXTURE = 'simplified_invoice.cli_signed.json'
+
+# The system libxml2, which implements C14N 1.1 (lxml only exposes C14N 1.0). Used to check the invoice hash against the
+# canonicalization the signature declares
+LIBXML2_PATH = ctypes.util.find_library('xml2')
+XML_C14N_1_1 = 2
+
+QR_CODE_PATH = "cac:AdditionalDocumentReference[cbc:ID='QR']/cac:Attachment/cbc:EmbeddedDocumentBinaryObject"
+
+
+def _read_fixture(name: str) -> str:
+    with open(os.path.join(FIXTURES_PATH, name), 'rt') as f:
+        return f.read()
+
+
+class TestNativeSigner(FrappeTestCase):
+    """
+    Checks the native signing engine against itself (hash, signature and QR round trips), and against the golden
+    output of the CLI for the fixed certificate and key. If ZATCA_CLI_PATH is set in the environment (and optionally
+    ZATCA_JAVA_HOME), the output is also compared against the CLI directly. ECDSA signatures are randomized, so the
+    signature itself (and QR tag 7) is verified rather than compared.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.cert_path, cls.key_path = _generate_credentials(cls.directory.name)
+        cls.credentials = SigningCredentials.load(cls.cert_path, cls.key_path)
+        cls.fixture_cert_path = os.path.join(FIXTURES_PATH, CERTIFICATE_FIXTURE)
+        cls.fixture_key_path = os.path.join(FIXTURES_PATH, PRIVATE_KEY_FIXTURE)
+        cls.fixture_credentials = SigningCredentials.load(cls.fixture_cert_path, cls.fixture_key_path)
+        cls.invoice_xml = _read_fixture('simplified_invoice.xml')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+        super().tearDownClass()
+
+    def test_hash_matches_signed_invoice(self):
+        result = native_signer.sign_invoice(self.invoice_xml, self.credentials)
+        self.assertEqual(result.invoice_hash, native_signer.compute_hash_of_signed_invoice(self.invoice_xml))
+        self.assertEqual(result.invoice_hash, native_signer.compute_hash_of_signed_invoice(result.signed_invoice_xml))
+
+    def test_signature_is_valid(self):
+        result = native_signer.sign_invoice(self.invoice_xml, self.credentials)
+        root = etree.fromstring(result.signed_invoice_xml.encode())
+        signature = root.findtext('.//ds:SignatureValue', namespaces=NAMESPACES)
+        self.credentials.certificate.public_key().verify(
+            base64.b64decode(signature), base64.b64decode(result.invoice_hash), ec.ECDSA(hashes.SHA256())
+        )
+
+    def test_signed_properties_hash(self):
+        result = native_signer.sign_invoice(self.invoice_xml, self.credentials)
+        root = etree.fromstring(result.signed_invoice_xml.encode())
+        signed_properties = root.find('.//xades:SignedProperties', NAMESPACES)
+        digest = root.findtext('.//ds:Reference[@URI="#xadesSignedProperties"]/ds:DigestValue', namespaces=NAMESPACES)
+        self.assertEqual(digest, native_signer.compute_signed_properties_hash(signed_properties))
+
+    def test_qr_code(self):
+        result = native_signer.sign_invoice(self.invoice_xml, self.credentials)
+        tags = decode_tlv(base64.b64decode(result.qr_code))
+        self.assertEqual(tags[2], b'399999999900003')
+        self.assertEqual(tags[3], b'2024-03-01T13:41:08')
+        self.assertEqual(tags[4], b'115.0')
+        self.assertEqual(tags[5], b'15.0')
+        self.assertEqual(tags[6], result.invoice_hash.encode())
+        self.assertEqual(tags[8], self.credentials.public_key_der)
+        self.assertEqual(tags[9], self.credentials.certificate.signature)
+
+        root = etree.fromstring(result.signed_invoice_xml.encode())
+        embedded = root.findtext(
+            "cac:AdditionalDocumentReference[cbc:ID='QR']/cac:Attachment/cbc:EmbeddedDocumentBinaryObject",
+            namespaces=NAMESPACES,
+        )
+        self.assertEqual(embedded, result.qr_code)
+
+    @unittest.skipUnless(LIBXML2_PATH, 'libxml2 is not installed')
+    def test_invoice_hash_matches_c14n11(self):
+        signed_xml = native_signer.sign_invoice(self.invoice_xml, self.credentials).signed_invoice_xml
+        for xml in (self.invoice_xml, signed_xml):
+            root = etree.fromstring(xml.encode())
+            for element in native_signer._hash_excluded_elements(root):
+                native_signer._remove_preserving_tail(element)
+
+            expected = base64.b64encode(hashlib.sha256(_canonicalize_c14n11(etree.tostring(root))).digest()).decode()
+            self.assertEqual(native_signer.compute_invoice_hash(root), expected)
+
+        with self.assertRaises(ValueError):
+            native_signer.compute_invoice_hash(root.find('cbc:IssueDate', NAMESPACES))
+
+    def test_certificate_issuer_matches_sdk(self):
+        self.assertEqual(self.fixture_credentials.certificate_issuer, SDK_CERTIFICATE_ISSUER)
+
+        result = native_signer.sign_invoice(self.invoice_xml, self.fixture_credentials)
+        root = etree.fromstring(result.signed_invoice_xml.encode())
+        self.assertEqual(root.findtext('.//ds:X509IssuerName', namespaces=NAMESPACES), SDK_CERTIFICATE_ISSUER)
+
+    @unittest.skipUnless(
+        os.path.exists(os.path.join(FIXTURES_PATH, CLI_SIGNED_INVOICE_FIXTURE)),
+        'CLI golden files are missing. Run test_matches_cli with ZATCA_CLI_PATH and ZATCA_WRITE_GOLDENS set',
+    )
+    def test_matches_cli_golden_files(self):
+        cli_xml = _read_fixture(CLI_SIGNED_INVOICE_FIXTURE)
+        cli_result = json.loads(_read_fixture(CLI_SIGNING_RESULT_FIXTURE))
+        cli_root = etree.fromstring(cli_xml.encode())
+
+        # The CLI signs at the current time, so we sign at the same time to compare the signed properties
+        signing_time = datetime.datetime.fromisoformat(cli_root.findtext('.//xades:SigningTime', namespaces=NAMESPACES))
+        native_result = native_signer.sign_invoice(self.invoice_xml, self.fixture_credentials, signing_time)
+        native_root = etree.fromstring(native_result.signed_invoice_xml.encode())
+
+        self.assertEqual(native_result.invoice_hash, cli_result['hash'])
+        self.assertEqual(native_signer.compute_hash_of_signed_invoice(cli_xml), native_result.invoice_hash)
+        self.assertEqual(
+            _canonicalize(native_root.find('.//xades:SignedProperties', NAMESPACES)),
+            _canonicalize(cli_root.find('.//xades:SignedProperties', NAMESPACES)),
+        )
+        self.assertEqual(_get_signed_properties_digest(native_root), _get_signed_properties_digest(cli_root))
+        self.assertEqual(
+            _get_qr_tags_except_signature(native_result.qr_code), _get_qr_tags_except_signature(cli_result['qrCode'])
+        )
+
+        # Apart from the signature and the QR code that embeds it, the documents must be identical
+        for root in (native_root, cli_root):
+            root.find('.//ds:SignatureValue', NAMESPACES).text = ''
+            root.find(QR_CODE_PATH, NAMESPACES).text = ''
+        self.assertEqual(_canonicalize(native_root), _canonicalize(cli_root))
+
+    @unittest.skipUnless(os.environ.get('ZATCA_CLI_PATH'), 'ZATCA_CLI_PATH is not set')
+    def test_matches_cli(self):
+        from ksa_compliance import zatca_cli
+
+        cli_result = zatca_cli.sign_invoice(
+            os.environ['ZATCA_CLI_PATH'],
+            os.environ.get('ZATCA_JAVA_HOME'),
+            self.invoice_xml,
+            self.fixture_cert_path,
+            self.fixture_key_path,
+        )
+        if os.environ.get('ZATCA_WRITE_GOLDENS'):
+            with open(os.path.join(FIXTURES_PATH, CLI_SIGNED_INVOICE_FIXTURE), 'wt') as f:
+                f.write(cli_result.signed_invoice_xml)
+            with open(os.path.join(FIXTURES_PATH, CLI_SIGNING_RESULT_FIXTURE), 'wt') as f:
+                json.dump({'hash': cli_result.invoice_hash, 'qrCode': cli_result.qr_code}, f, indent=2)
+
+        native_result = native_signer.sign_invoice(self.invoice_xml, self.fixture_credentials)
+        self.assertEqual(native_result.invoice_hash, cli_result.invoice_hash)
+        self.assertEqual(
+            native_signer.compute_hash_of_signed_invoice(cli_result.signed_invoice_xml), native_result.invoice_hash
+        )
+        self.assertEqual(
+            _get_qr_tags_except_signature(native_result.qr_code), _get_qr_tags_except_signature(cli_result.qr_code)
+        )
+
+
+def _canonicalize(element: etree._Element) -> bytes:
+    return etree.tostring(element, method='c14n', exclusive=False, with_comments=False)
+
+
+def _canonicalize_c14n11(xml: bytes) -> bytes:
+    """Returns the C14N 1.1 form of the document [xml] (without comments), as computed by [LIBXML2_PATH]"""
+    libxml2 = ctypes.CDLL(LIBXML2_PATH)
+    libxml2.xmlReadMemory.restype = ctypes.c_void_p
+    libxml2.xmlReadMemory.argtypes = [ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_int]
+    libxml2.xmlC14NDocDumpMemory.argtypes = [
+        ctypes.c_void_p,
+        ctypes.c_void_p,
+        ctypes.c_int,
+        ctypes.c_void_p,
+        ctypes.c_int,
+        ctypes.POINTER(ctypes.c_void_p),
+    ]
+    libxml2.xmlFreeDoc.argtypes = [ctypes.c_void_p]
+    xml_free = ctypes.CFUNCTYPE(None, ctypes.c_void_p).in_dll(libxml2, 'xmlFree')
+
+    document = libxml2.xmlReadMemory(xml, len(xml), None, None, 0)
+    if not document:
+        raise ValueError('libxml2 could not parse the document')
+    try:
+        output = ctypes.c_void_p()
+        length = libxml2.xmlC14NDocDumpMemory(document, None, XML_C14N_1_1, None, 0, ctypes.byref(output))
+        if length < 0:
+            raise ValueError('libxml2 could not canonicalize the document')
+        try:
+            return ctypes.string_at(output, length)
+        finally:
+            xml_free(output)
+    finally:
+        libxml2.xmlFreeDoc(document)
+
+
+def _get_signed_properties_digest(root: etree._Element) -> str:
+    return root.findtext('.//ds:Reference[@URI="#xadesSignedProperties"]/ds:DigestValue', namespaces=NAMESPACES)
+
+
+def _get_qr_tags_except_signature(qr_code: str) -> dict[int, bytes]:
+    tags = decode_tlv(base64.b64decode(qr_code))
+    tags.pop(7, None)
+    return tags
+
+
+def _generate_credentials(directory: str) -> tuple[str, str]:
+    key = ec.generate_private_key(ec.SECP256K1())
+    name = x509.Name(
+        [
+            x509.NameAttribute(NameOID.COMMON_NAME, 'TST-886431145-399999999900003'),
+            x509.NameAttribute(NameOID.ORGANIZATION_NAME, 'Maximum Speed Tech Supply LTD'),
+            x509.NameAttribute(NameOID.COUNTRY_NAME, 'SA'),
+        ]
+    )
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(datetime.datetime(2024, 1, 1))
+        .not_valid_after(datetime.datetime(2034, 1, 1))
+        .sign(key, hashes.SHA256())
+    )
+
+    cert_path = os.path.join(directory, 'cert.pem')
+    with open(cert_path, 'wb') as f:
+        f.write(b'-----BEGIN CERTIFICATE-----\n')
+        f.write(base64.b64encode(certificate.public_bytes(serialization.Encoding.DER)))
+        f.write(b'\n-----END CERTIFICATE-----')
+
+    key_path = os.path.join(directory, 'key.pem')
+    with open(key_path, 'wb') as f:
+        f.write(
+            key.private_bytes(
+                serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL, serialization.NoEncryption()
+            )
+        )
+
+    return cert_path, key_path
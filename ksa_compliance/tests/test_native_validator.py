@@ -0,0 +1,123 @@
+# Copyright (c) 2024, LavaLoon and Contributors
+# See license.txt
+import importlib.util
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from frappe.tests.utils import FrappeTestCase
+from lxml import etree
+
+from ksa_compliance import native_signer, native_validator
+from ksa_compliance.native_signer import SigningCredentials
+from ksa_compliance.tests.test_native_signer import _generate_credentials, _read_fixture
+from ksa_compliance.zatca_cli import ValidationDetails, ValidationResult
+
+
+class TestNativeValidator(FrappeTestCase):
+    """
+    Checks the signature and QR validation of the native validator. The schema and business rules require the ZATCA
+    SDK data that ships with the CLI, so those are only checked if ZATCA_CLI_PATH is set in the environment
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.cert_path, cls.key_path = _generate_credentials(cls.directory.name)
+        cls.credentials = SigningCredentials.load(cls.cert_path, cls.key_path)
+        cls.signed = native_signer.sign_invoice(_read_fixture('simplified_invoice.xml'), cls.credentials)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+        super().tearDownClass()
+
+    def test_valid_signature_and_qr(self):
+        root = etree.fromstring(self.signed.signed_invoice_xml.encode())
+        self.assertIsNone(native_validator._check_signature(root, self.signed.invoice_hash))
+        self.assertIsNone(native_validator._check_qr_code(root, self.signed.invoice_hash))
+
+    def test_tampered_invoice(self):
+        tampered_xml = self.signed.signed_invoice_xml.replace('<cbc:IssueTime>13:41:08', '<cbc:IssueTime>13:41:09')
+        root = etree.fromstring(tampered_xml.encode())
+        invoice_hash = native_signer.compute_hash_of_signed_invoice(tampered_xml)
+        self.assertIsNotNone(native_validator._check_signature(root, invoice_hash))
+        self.assertIsNotNone(native_validator._check_qr_code(root, invoice_hash))
+
+    def test_unavailable_rules_are_cached(self):
+        with tempfile.TemporaryDirectory() as base_path:
+            with mock.patch.object(native_validator, '_find_file', wraps=native_validator._find_file) as find_file:
+                with self.assertRaises(native_validator.NativeValidatorUnavailable):
+                    native_validator.CompiledRules.load_cached(base_path)
+                calls = find_file.call_count
+
+                with self.assertRaises(native_validator.NativeValidatorUnavailable):
+                    native_validator.CompiledRules.load_cached(base_path)
+                self.assertEqual(find_file.call_count, calls)
+
+    @unittest.skipUnless(importlib.util.find_spec('saxonche'), 'saxonche is not installed')
+    def test_invalid_rules_are_cached(self):
+        valid_schema = '<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema"/>'
+        for schema, stylesheet in (('<xs:schema', ''), (valid_schema, '<xsl:stylesheet')):
+            with self.subTest(schema=schema), tempfile.TemporaryDirectory() as base_path:
+                for name, content in (
+                    (native_validator.INVOICE_SCHEMA_FILE, schema),
+                    (native_validator.EN_RULES_FILE, stylesheet),
+                    ('20210819_ZATCA_E-invoice_Validation_Rules.xsl', stylesheet),
+                ):
+                    with open(os.path.join(base_path, name), 'w') as f:
+                        f.write(content)
+
+                with mock.patch.object(
+                    native_validator.CompiledRules, 'load', wraps=native_validator.CompiledRules.load
+                ) as load:
+                    with self.assertRaises(native_validator.NativeValidatorUnavailable):
+                        native_validator.CompiledRules.load_cached(base_path)
+                    with self.assertRaises(native_validator.NativeValidatorUnavailable):
+                        native_validator.CompiledRules.load_cached(base_path)
+                    self.assertEqual(load.call_count, 1)
+
+    def test_diff_results(self):
+        cli_result = ValidationResult([], [], ValidationDetails(False, True, True, {'BR-KSA-08': 'x'}, {}))
+        native_result = ValidationResult([], [], ValidationDetails(True, True, True, {}, {'BR-KSA-F-06': 'y'}))
+        self.assertEqual(
+            native_validator.diff_results(cli_result, native_result),
+            [
+                'Error BR-KSA-08 reported by CLI only',
+                'Warning BR-KSA-F-06 reported by native validator only',
+                'is_valid: CLI=False, native=True',
+            ],
+        )
+
+    def test_parse_svrl(self):
+        report = """<svrl:schematron-output xmlns:svrl="http://purl.oclc.org/dsdl/svrl">
+            <svrl:failed-assert flag="fatal" location="/Invoice">
+                <svrl:text>[BR-01]-An Invoice shall have a Specification identifier</svrl:text>
+            </svrl:failed-assert>
+            <svrl:failed-assert flag="warning" id="BR-KSA-F-06" location="/Invoice">
+                <svrl:text>[BR-KSA-F-06]-The amount should have a maximum of 2 decimals</svrl:text>
+            </svrl:failed-assert>
+        </svrl:schematron-output>"""
+        self.assertEqual(
+            native_validator._parse_svrl(report),
+            [
+                ('BR-01', 'An Invoice shall have a Specification identifier', True),
+                ('BR-KSA-F-06', 'The amount should have a maximum of 2 decimals', False),
+            ],
+        )
+
+    @unittest.skipUnless(os.environ.get('ZATCA_CLI_PATH'), 'ZATCA_CLI_PATH is not set')
+    def test_matches_cli(self):
+        from ksa_compliance import zatca_cli
+
+        cli_path = os.environ['ZATCA_CLI_PATH']
+        base_path = os.path.normpath(os.path.join(os.path.dirname(cli_path), '../'))
+        pih = 'NWZlY2ViNjZmZmM4NmYzOGQ5NTI3ODZjNmQ2OTZjNzljMmRiYzIzOWRkNGU5MWI0NjcyOWQ3M2EyN2ZiNTdlOQ=='
+
+        cli_result = zatca_cli.validate_invoice(
+            cli_path, os.environ.get('ZATCA_JAVA_HOME'), self.signed.signed_invoice_xml, self.cert_path, pih
+        )
+        native_result = native_validator.validate_invoice(self.signed.signed_invoice_xml, base_path, pih)
+        self.assertEqual(native_validator.diff_results(cli_result, native_result), [])
@@ -1,17 +1,71 @@
 import base64
 import dataclasses
+import json
+import os
+import threading
+import time
 import traceback
 from dataclasses import dataclass
 from enum import Enum
-from typing import cast, List, Dict, Callable, TypeVar, Optional, Tuple
-from urllib.parse import urljoin
+from typing import cast, List, Dict, Callable, TypeVar, Optional, Tuple, Literal
+from urllib.parse import urljoin, urlsplit
 
+import httpx
 import requests
 from requests import HTTPError, Response, JSONDecodeError
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 from result import Result, Ok, Err
 
-from ksa_compliance import logger
+from ksa_compliance import circuit_breaker, logger
+from ksa_compliance.circuit_breaker import CircuitOpenError
+from ksa_compliance.rate_limit import (
+    DEFAULT_MAX_WAIT_SECONDS,
+    RateLimiter,
+    RateLimitExceeded,
+    get_backoff,
+    parse_retry_after,
+)
+
+# The maximum number of kept-alive connections per ZATCA server in each process. This should be at least the number of
+# concurrent API calls (see background_jobs.sync_e_invoices), otherwise extra connections are opened and thrown away
+HTTP_POOL_SIZE = 10
+
+# (connect, read) timeouts in seconds, as accepted by requests
+Timeout = Tuple[float, float]
+
+# The API endpoints that have their own timeouts in ZATCA Business Settings
+ApiEndpoint = Literal['reporting', 'clearance', 'compliance', 'csid']
+
+# Timeouts used when ZATCA Business Settings don't specify any. Clearance is synchronous on ZATCA's side (the invoice
+# is validated and stamped before the response is sent), so it gets more time than reporting
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUTS: dict[ApiEndpoint, float] = {'reporting': 30, 'clearance': 60, 'compliance': 60, 'csid': 60}
+
+# Responses that mean ZATCA didn't process the request, so it's safe to send it again. Other failures (e.g. 504) might
+# have been processed, so they're left to the 'Resend' integration status
+RETRYABLE_STATUS_CODES = (429, 503)
+
+# How many times a call that got a retryable response is retried before giving up, when using a rate limiter
+MAX_RETRIES = 3
+
+# Responses that mean the server is down (or overloaded), as opposed to rejecting a particular request. These count
+# towards opening the circuit breaker, along with network failures
+OUTAGE_STATUS_CODES = (500, 502, 503, 504)
+
+# The status code returned by [api_call] when the call was short-circuited because the server is down
+CIRCUIT_OPEN_STATUS_CODE = -1
+
+# The status code returned by [api_call] when ZATCA couldn't be reached (connection failure or timeout)
+NETWORK_ERROR_STATUS_CODE = 0
+
+# The status code returned by [api_call] when the call failed for reasons that say nothing about ZATCA: an error on
+# our side, or a timeout cut short to fit before the deadline
+LOCAL_ERROR_STATUS_CODE = -2
+
+# HTTP sessions (and their connection pools) by (process ID, server origin). See [get_session]
+_sessions: dict[tuple[int, str], requests.Session] = {}
+_sessions_lock = threading.Lock()
 
 
 class ZatcaSendMode(Enum):
@@ -119,18 +173,61 @@ class ReportOrClearInvoiceError:
     error: str
 
 
-def get_compliance_csid(server: str, csr: str, otp: str) -> Tuple[Result[ComplianceResult, str], int]:
+@dataclass
+class InvoiceRequest:
+    """The path, headers and body for reporting or clearing an invoice"""
+
+    path: str
+    headers: Dict[str, str]
+    body: Dict[str, str]
+    endpoint: ApiEndpoint
+
+    @staticmethod
+    def create(
+        invoice_xml: str, invoice_uuid: str, invoice_hash: str, clearance: bool, mode: ZatcaSendMode
+    ) -> 'InvoiceRequest':
+        b64_xml = base64.b64encode(invoice_xml.encode()).decode()
+        body = {'invoiceHash': invoice_hash, 'uuid': invoice_uuid, 'invoice': b64_xml}
+        headers = {
+            'Accept-Version': 'V2',
+        }
+        if clearance:
+            headers['Clearance-Status'] = '1'
+
+        if mode == ZatcaSendMode.Compliance:
+            return InvoiceRequest('compliance/invoices', headers, body, 'compliance')
+        if clearance:
+            return InvoiceRequest('invoices/clearance/single', headers, body, 'clearance')
+        return InvoiceRequest('invoices/reporting/single', headers, body, 'reporting')
+
+
+def get_compliance_csid(
+    server: str, csr: str, otp: str, timeout: Optional[Timeout] = None
+) -> Tuple[Result[ComplianceResult, str], int]:
     """Gets a compliance CSID from ZATCA using a CSR and OTP."""
     headers = {
         'Accept-Version': 'V2',
         'OTP': otp,
     }
     body = {'csr': csr}
-    return api_call(server, 'compliance', headers, body, ComplianceResult.from_json, try_get_csid_error)
+    return api_call(
+        server,
+        'compliance',
+        headers,
+        body,
+        ComplianceResult.from_json,
+        try_get_csid_error,
+        timeout=timeout or get_default_timeout('csid'),
+    )
 
 
 def get_production_csid(
-    server: str, compliance_request_id: str, otp: str, security_token: str, secret: str
+    server: str,
+    compliance_request_id: str,
+    otp: str,
+    security_token: str,
+    secret: str,
+    timeout: Optional[Timeout] = None,
 ) -> Tuple[Result[ComplianceResult, str], int]:
     """Gets a production CSID from ZATCA for a compliance request."""
     headers = {
@@ -140,7 +237,14 @@ def get_production_csid(
     body = {'compliance_request_id': compliance_request_id}
     auth = HTTPBasicAuth(security_token, secret)
     return api_call(
-        server, 'production/csids', headers, body, ComplianceResult.from_json, try_get_csid_error, auth=auth
+        server,
+        'production/csids',
+        headers,
+        body,
+        ComplianceResult.from_json,
+        try_get_csid_error,
+        auth=auth,
+        timeout=timeout or get_default_timeout('csid'),
     )
 
 
@@ -152,23 +256,23 @@ def report_invoice(
     security_token: str,
     secret: str,
     mode: ZatcaSendMode,
+    timeout: Optional[Timeout] = None,
+    deadline: Optional[float] = None,
+    rate_limiter: Optional[RateLimiter] = None,
 ) -> Tuple[Result[ReportOrClearInvoiceResult, ReportOrClearInvoiceError], int]:
-    """Reports a simplified invoice to ZATCA"""
-    b64_xml = base64.b64encode(invoice_xml.encode()).decode()
-    body = {'invoiceHash': invoice_hash, 'uuid': invoice_uuid, 'invoice': b64_xml}
-    headers = {
-        'Accept-Version': 'V2',
-    }
-
-    url = 'invoices/reporting/single' if mode == ZatcaSendMode.Production else 'compliance/invoices'
+    """Reports a simplified invoice to ZATCA. See [api_call] for [timeout], [deadline] and [rate_limiter]"""
+    request = InvoiceRequest.create(invoice_xml, invoice_uuid, invoice_hash, clearance=False, mode=mode)
     return api_call(
         server,
-        url,
-        headers,
-        body,
+        request.path,
+        request.headers,
+        request.body,
         ReportOrClearInvoiceResult.from_json,
         try_get_report_or_clear_error,
         auth=HTTPBasicAuth(security_token, secret),
+        timeout=timeout or get_default_timeout(request.endpoint),
+        deadline=deadline,
+        rate_limiter=rate_limiter,
     )
 
 
@@ -180,24 +284,23 @@ def clear_invoice(
     security_token: str,
     secret: str,
     mode: ZatcaSendMode,
+    timeout: Optional[Timeout] = None,
+    deadline: Optional[float] = None,
+    rate_limiter: Optional[RateLimiter] = None,
 ) -> Tuple[Result[ReportOrClearInvoiceResult, ReportOrClearInvoiceError], int]:
-    """Reports a standard invoice to ZATCA"""
-    b64_xml = base64.b64encode(invoice_xml.encode()).decode()
-    body = {'invoiceHash': invoice_hash, 'uuid': invoice_uuid, 'invoice': b64_xml}
-    headers = {
-        'Clearance-Status': '1',
-        'Accept-Version': 'V2',
-    }
-
-    url = 'invoices/clearance/single' if mode == ZatcaSendMode.Production else 'compliance/invoices'
+    """Reports a standard invoice to ZATCA. See [api_call] for [timeout], [deadline] and [rate_limiter]"""
+    request = InvoiceRequest.create(invoice_xml, invoice_uuid, invoice_hash, clearance=True, mode=mode)
     return api_call(
         server,
-        url,
-        headers,
-        body,
+        request.path,
+        request.headers,
+        request.body,
         ReportOrClearInvoiceResult.from_json,
         try_get_report_or_clear_error,
         auth=HTTPBasicAuth(security_token, secret),
+        timeout=timeout or get_default_timeout(request.endpoint),
+        deadline=deadline,
+        rate_limiter=rate_limiter,
     )
 
 
@@ -213,24 +316,95 @@ def api_call(
     result_builder: Callable[[dict, str], TOk],
     error_builder: Callable[[Response | None, Exception | None], TError],
     auth=None,
+    timeout: Optional[Timeout] = None,
+    deadline: Optional[float] = None,
+    rate_limiter: Optional[RateLimiter] = None,
 ) -> Tuple[Result[TOk, TError], int]:
     """
     Performs a ZATCA API call and builds a success result using [result_builder]. In case of 400 errors, the
-    response is parsed and a combined error is returned.
+    response is parsed and a combined error is returned. [timeout] is a (connect, read) tuple in seconds; a call that
+    times out is an error with status code [NETWORK_ERROR_STATUS_CODE], like any other network failure. Timeouts are
+    capped by [deadline] (a [time.monotonic] value), if any; a call that times out because of that cap, or fails on
+    our side before getting a response, is an error with status code [LOCAL_ERROR_STATUS_CODE].
+
+    If [rate_limiter] is given, the call waits for its turn, and retryable responses (429/503) pause further calls
+    using the same credentials for the duration in Retry-After (or a jittered backoff) and are retried, as long as
+    that fits before [deadline]. A call that can't be made before [deadline] is an error with status code 429.
+
+    Calls go through a circuit breaker per server (see [circuit_breaker]). While the server is considered down, no
+    request is made and the result is an error with status code [CIRCUIT_OPEN_STATUS_CODE].
 
     Never throws an exception
     """
     if not server.endswith('/'):
         server = server + '/'
 
+    if not circuit_breaker.allow_call(server):
+        logger.info(f'Not calling {server}{path}: ZATCA is unavailable')
+        return Err(error_builder(None, CircuitOpenError(server))), CIRCUIT_OPEN_STATUS_CODE
+
+    result, status_code = _call_api(
+        server, path, headers, body, result_builder, error_builder, auth, timeout, deadline, rate_limiter
+    )
+    record_outcome(server, status_code)
+    return result, status_code
+
+
+def record_outcome(server: str, status_code: int) -> None:
+    """
+    Records the outcome of a call to [server] in its circuit breaker. Only network failures and [OUTAGE_STATUS_CODES]
+    count as failures. Local errors and rate limiting tell nothing about the server, so they aren't recorded
+    """
+    if status_code == NETWORK_ERROR_STATUS_CODE or status_code in OUTAGE_STATUS_CODES:
+        circuit_breaker.record_failure(server)
+    elif status_code not in (429, LOCAL_ERROR_STATUS_CODE):
+        circuit_breaker.record_success(server)
+
+
+def _call_api(
+    server: str,
+    path: str,
+    headers: Dict[str, str],
+    body: Dict[str, str],
+    result_builder: Callable[[dict, str], TOk],
+    error_builder: Callable[[Response | None, Exception | None], TError],
+    auth,
+    timeout: Optional[Timeout],
+    deadline: Optional[float],
+    rate_limiter: Optional[RateLimiter],
+) -> Tuple[Result[TOk, TError], int]:
     url = urljoin(server, path)
 
     final_headers = headers.copy()
     final_headers.update({'accept': 'application/json', 'accept-language': 'en'})
 
+    credential = auth.username if isinstance(auth, HTTPBasicAuth) else ''
+    timeout = timeout or get_default_timeout('compliance')
     response: Response | None = None
+    capped_timeout = timeout
+    # Retries wait at most as long as the rate limiter would, so that a long Retry-After can't park the caller
+    retry_deadline = deadline or time.monotonic() + DEFAULT_MAX_WAIT_SECONDS
     try:
-        response = requests.post(url, headers=final_headers, json=body, auth=auth)
+        for attempt in range(MAX_RETRIES + 1):
+            if rate_limiter:
+                rate_limiter.acquire(server, credential, deadline)
+
+            capped_timeout = cap_timeout(timeout, deadline)
+            response = get_session(server).post(
+                url, headers=final_headers, json=body, auth=auth, timeout=capped_timeout
+            )
+            if not rate_limiter or response.status_code not in RETRYABLE_STATUS_CODES:
+                break
+
+            delay = get_retry_delay(response.headers.get('Retry-After'), attempt)
+            rate_limiter.throttle(server, credential, delay)
+            if attempt == MAX_RETRIES or time.monotonic() + delay >= retry_deadline:
+                break
+
+            logger.info(f'ZATCA responded with {response.status_code}, retrying in {delay:.1f}s')
+            time.sleep(delay)
+
+        response = cast(Response, response)
         response.raise_for_status()
         return Ok(result_builder(response.json(), response.text)), response.status_code
     except HTTPError as e:
@@ -240,17 +414,103 @@ def api_call(
             logger.info(f'Response: {e.response.text}')
 
         return Err(error), response.status_code
+    except RateLimitExceeded as e:
+        logger.info(f'Not calling {url}: {e}')
+        return Err(error_builder(None, e)), 429
+    except (requests.ConnectionError, requests.Timeout) as e:
+        error = error_builder(None, e)
+        logger.error(f'A network error occurred: {error}')
+        return Err(error), get_network_error_status_code(e, timeout, capped_timeout)
     except Exception as e:
         error = error_builder(response, e)
         logger.error(f'An unexpected error occurred: {error}', exc_info=e)
-        status_code = 0
+        status_code = LOCAL_ERROR_STATUS_CODE
         if response is not None:
             logger.info(f'Response: {response.text}')
             status_code = response.status_code
         return Err(error), status_code
 
 
-def try_get_csid_error(response: Response | None, exception: Exception | None) -> str:
+def get_network_error_status_code(e: Exception, timeout: Timeout, capped_timeout: Timeout) -> int:
+    """
+    Returns the status code of a call that failed with network error [e]. A timeout is only ZATCA's fault if the call
+    was given its full [timeout], rather than the [capped_timeout] left before the deadline
+    """
+    is_timeout = isinstance(e, (requests.Timeout, httpx.TimeoutException))
+    if is_timeout and capped_timeout != timeout:
+        return LOCAL_ERROR_STATUS_CODE
+    return NETWORK_ERROR_STATUS_CODE
+
+
+def get_retry_delay(retry_after: Optional[str], attempt: int) -> float:
+    """Returns how long to wait before retrying a throttled call: Retry-After if given, or a jittered backoff"""
+    return max(parse_retry_after(retry_after) or 0, get_backoff(attempt))
+
+
+def get_default_timeout(endpoint: ApiEndpoint) -> Timeout:
+    return DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUTS[endpoint]
+
+
+def cap_timeout(timeout: Timeout, deadline: Optional[float]) -> Timeout:
+    """
+    Caps both parts of [timeout] by the time left until [deadline] (a [time.monotonic] value), so that a call started
+    close to the deadline can't outlive it. Returns [timeout] as is if there's no deadline
+    """
+    if deadline is None:
+        return timeout
+
+    remaining = max(deadline - time.monotonic(), 0.001)
+    connect_timeout, read_timeout = timeout
+    return min(connect_timeout, remaining), min(read_timeout, remaining)
+
+
+def get_session(server: str) -> requests.Session:
+    """
+    Returns the HTTP session for [server] in the current process. Sessions keep connections alive between API calls,
+    so consecutive calls don't pay for a new TCP connection and TLS handshake.
+
+    Sessions are never shared across processes: RQ forks a new process per job, and a forked child using its parent's
+    sockets would corrupt both connections. A child process just drops the sessions it inherited and creates its own
+    """
+    parts = urlsplit(server)
+    origin = f'{parts.scheme}://{parts.netloc}'
+    pid = os.getpid()
+    with _sessions_lock:
+        session = _sessions.get((pid, origin))
+        if session is None:
+            for key in [k for k in _sessions if k[0] != pid]:
+                del _sessions[key]
+
+            session = requests.Session()
+            # Retries are handled by the callers (e.g. the 'Resend' integration status), so we don't retry here
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, max_retries=0)
+            session.mount(f'{origin}/', adapter)
+            _sessions[(pid, origin)] = session
+        return session
+
+
+def get_connection_stats() -> dict[str, dict[str, int]]:
+    """
+    Returns connection reuse metrics for the current process by server: the number of requests made, and the number of
+    connections opened to make them. Requests beyond the number of connections were made over kept-alive connections
+    """
+    pid = os.getpid()
+    stats = {}
+    with _sessions_lock:
+        for (session_pid, origin), session in _sessions.items():
+            if session_pid != pid:
+                continue
+
+            adapter = cast(HTTPAdapter, session.get_adapter(f'{origin}/'))
+            pools = [adapter.poolmanager.pools[key] for key in adapter.poolmanager.pools.keys()]
+            stats[origin] = {
+                'requests': sum(pool.num_requests for pool in pools),
+                'connections': sum(pool.num_connections for pool in pools),
+            }
+    return stats
+
+
+def try_get_csid_error(response: Response | httpx.Response | None, exception: Exception | None) -> str:
     """
     Tries to extract an error from a ZATCA response. The sandbox API isn't consistent in how it reports errors,
     so this method tries a number of approaches based on the observed error responses.
@@ -272,12 +532,14 @@ def try_get_csid_error(response: Response | None, exception: Exception | None) -
             return data['message']
 
         return response.text
-    except JSONDecodeError:
+    except (JSONDecodeError, json.JSONDecodeError):
         # If the response is not JSON, we return the content itself as the error
         return response.text
 
 
-def try_get_report_or_clear_error(response: Response | None, exception: Exception | None) -> ReportOrClearInvoiceError:
+def try_get_report_or_clear_error(
+    response: Response | httpx.Response | None, exception: Exception | None
+) -> ReportOrClearInvoiceError:
     """Tries to extract an error from a ZATCA reporting/clearance response"""
     if response is None:
         if exception:
@@ -299,7 +561,7 @@ def try_get_report_or_clear_error(response: Response | None, exception: Exceptio
 
         if response.status_code == 500 and data.get('message'):
             return ReportOrClearInvoiceError(response.text, data['message'])
-    except JSONDecodeError:
+    except (JSONDecodeError, json.JSONDecodeError):
         # If the response is not JSON, we return the content itself as the error
         pass
 
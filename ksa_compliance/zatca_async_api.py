@@ -0,0 +1,267 @@
+import asyncio
+import functools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, Optional, Tuple, TypeVar
+from urllib.parse import urljoin
+
+import httpx
+from result import Err, Ok, Result
+
+from ksa_compliance import circuit_breaker, logger
+from ksa_compliance.circuit_breaker import CircuitOpenError
+from ksa_compliance.rate_limit import DEFAULT_MAX_WAIT_SECONDS, RateLimiter, RateLimitExceeded
+from ksa_compliance.zatca_api import (
+    CIRCUIT_OPEN_STATUS_CODE,
+    LOCAL_ERROR_STATUS_CODE,
+    MAX_RETRIES,
+    RETRYABLE_STATUS_CODES,
+    InvoiceRequest,
+    ReportOrClearInvoiceError,
+    ReportOrClearInvoiceResult,
+    Timeout,
+    ZatcaSendMode,
+    cap_timeout,
+    get_default_timeout,
+    get_network_error_status_code,
+    get_retry_delay,
+    record_outcome,
+    try_get_report_or_clear_error,
+)
+
+# The maximum number of connections (and so in-flight requests) per client. Requests beyond that wait for a connection
+DEFAULT_MAX_CONNECTIONS = 100
+
+TOk = TypeVar('TOk')
+TError = TypeVar('TError')
+TPayload = TypeVar('TPayload')
+TResult = TypeVar('TResult')
+
+# Marks the end of the payloads in [send_as_completed]
+_END = object()
+
+# Threads running the blocking Redis calls of the rate limiter and circuit breaker, by process ID. A call waiting for
+# the rate limiter holds a thread, so there's one per connection rather than the few of asyncio's default executor.
+# Threads are only started when needed. See [_run_blocking]
+_executors: dict[int, ThreadPoolExecutor] = {}
+
+
+def create_client(max_connections: int = DEFAULT_MAX_CONNECTIONS) -> httpx.AsyncClient:
+    """
+    Creates an HTTP client for the functions in this module. Use it as an async context manager, so that its
+    connections are closed once done. Connections are kept alive between calls, up to [max_connections] at a time
+    """
+    limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+    return httpx.AsyncClient(limits=limits)
+
+
+async def report_invoice(
+    client: httpx.AsyncClient,
+    server: str,
+    invoice_xml: str,
+    invoice_uuid: str,
+    invoice_hash: str,
+    security_token: str,
+    secret: str,
+    mode: ZatcaSendMode,
+    timeout: Optional[Timeout] = None,
+    deadline: Optional[float] = None,
+    rate_limiter: Optional[RateLimiter] = None,
+) -> Tuple[Result[ReportOrClearInvoiceResult, ReportOrClearInvoiceError], int]:
+    """Reports a simplified invoice to ZATCA. See [zatca_api.report_invoice]"""
+    request = InvoiceRequest.create(invoice_xml, invoice_uuid, invoice_hash, clearance=False, mode=mode)
+    return await api_call(
+        client,
+        server,
+        request.path,
+        request.headers,
+        request.body,
+        ReportOrClearInvoiceResult.from_json,
+        try_get_report_or_clear_error,
+        auth=(security_token, secret),
+        timeout=timeout or get_default_timeout(request.endpoint),
+        deadline=deadline,
+        rate_limiter=rate_limiter,
+    )
+
+
+async def clear_invoice(
+    client: httpx.AsyncClient,
+    server: str,
+    invoice_xml: str,
+    invoice_uuid: str,
+    invoice_hash: str,
+    security_token: str,
+    secret: str,
+    mode: ZatcaSendMode,
+    timeout: Optional[Timeout] = None,
+    deadline: Optional[float] = None,
+    rate_limiter: Optional[RateLimiter] = None,
+) -> Tuple[Result[ReportOrClearInvoiceResult, ReportOrClearInvoiceError], int]:
+    """Reports a standard invoice to ZATCA. See [zatca_api.clear_invoice]"""
+    request = InvoiceRequest.create(invoice_xml, invoice_uuid, invoice_hash, clearance=True, mode=mode)
+    return await api_call(
+        client,
+        server,
+        request.path,
+        request.headers,
+        request.body,
+        ReportOrClearInvoiceResult.from_json,
+        try_get_report_or_clear_error,
+        auth=(security_token, secret),
+        timeout=timeout or get_default_timeout(request.endpoint),
+        deadline=deadline,
+        rate_limiter=rate_limiter,
+    )
+
+
+async def api_call(
+    client: httpx.AsyncClient,
+    server: str,
+    path: str,
+    headers: Dict[str, str],
+    body: Dict[str, str],
+    result_builder: Callable[[dict, str], TOk],
+    error_builder: Callable[[httpx.Response | None, Exception | None], TError],
+    auth: Optional[Tuple[str, str]] = None,
+    timeout: Optional[Timeout] = None,
+    deadline: Optional[float] = None,
+    rate_limiter: Optional[RateLimiter] = None,
+) -> Tuple[Result[TOk, TError], int]:
+    """
+    The async counterpart of [zatca_api.api_call], with the same timeouts, rate limiting, retries and circuit breaker.
+    [auth] is a (username, password) tuple for basic authentication. The rate limiter and circuit breaker talk to Redis
+    on worker threads, so waiting for them doesn't block other calls.
+
+    Never throws an exception
+    """
+    if not server.endswith('/'):
+        server = server + '/'
+
+    if not await _run_blocking(circuit_breaker.allow_call, server):
+        logger.info(f'Not calling {server}{path}: ZATCA is unavailable')
+        return Err(error_builder(None, CircuitOpenError(server))), CIRCUIT_OPEN_STATUS_CODE
+
+    result, status_code = await _call_api(
+        client, server, path, headers, body, result_builder, error_builder, auth, timeout, deadline, rate_limiter
+    )
+    await _run_blocking(record_outcome, server, status_code)
+    return result, status_code
+
+
+async def _call_api(
+    client: httpx.AsyncClient,
+    server: str,
+    path: str,
+    headers: Dict[str, str],
+    body: Dict[str, str],
+    result_builder: Callable[[dict, str], TOk],
+    error_builder: Callable[[httpx.Response | None, Exception | None], TError],
+    auth: Optional[Tuple[str, str]],
+    timeout: Optional[Timeout],
+    deadline: Optional[float],
+    rate_limiter: Optional[RateLimiter],
+) -> Tuple[Result[TOk, TError], int]:
+    url = urljoin(server, path)
+    final_headers = headers.copy()
+    final_headers.update({'accept': 'application/json', 'accept-language': 'en'})
+
+    credential = auth[0] if auth else ''
+    timeout = timeout or get_default_timeout('compliance')
+    response: httpx.Response | None = None
+    capped_timeout = timeout
+    # Retries wait at most as long as the rate limiter would, so that a long Retry-After can't park the caller
+    retry_deadline = deadline or time.monotonic() + DEFAULT_MAX_WAIT_SECONDS
+    try:
+        for attempt in range(MAX_RETRIES + 1):
+            if rate_limiter:
+                await _run_blocking(rate_limiter.acquire, server, credential, deadline)
+
+            capped_timeout = cap_timeout(timeout, deadline)
+            connect_timeout, read_timeout = capped_timeout
+            response = await client.post(
+                url,
+                headers=final_headers,
+                json=body,
+                auth=auth,
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            )
+            if not rate_limiter or response.status_code not in RETRYABLE_STATUS_CODES:
+                break
+
+            delay = get_retry_delay(response.headers.get('Retry-After'), attempt)
+            await _run_blocking(rate_limiter.throttle, server, credential, delay)
+            if attempt == MAX_RETRIES or time.monotonic() + delay >= retry_deadline:
+                break
+
+            logger.info(f'ZATCA responded with {response.status_code}, retrying in {delay:.1f}s')
+            await asyncio.sleep(delay)
+
+        response.raise_for_status()
+        return Ok(result_builder(response.json(), response.text)), response.status_code
+    except httpx.HTTPStatusError as e:
+        error = error_builder(e.response, e)
+        logger.error(f'An HTTP error occurred: {error}')
+        if e.response.text:
+            logger.info(f'Response: {e.response.text}')
+
+        return Err(error), e.response.status_code
+    except RateLimitExceeded as e:
+        logger.info(f'Not calling {url}: {e}')
+        return Err(error_builder(None, e)), 429
+    except httpx.TransportError as e:
+        error = error_builder(None, e)
+        logger.error(f'A network error occurred: {error}')
+        return Err(error), get_network_error_status_code(e, timeout, capped_timeout)
+    except Exception as e:
+        error = error_builder(response, e)
+        logger.error(f'An unexpected error occurred: {error}', exc_info=e)
+        status_code = LOCAL_ERROR_STATUS_CODE
+        if response is not None:
+            logger.info(f'Response: {response.text}')
+            status_code = response.status_code
+        return Err(error), status_code
+
+
+def _run_blocking(func: Callable[..., TResult], *args: Any) -> Awaitable[TResult]:
+    """Runs [func] with [args] on a worker thread of the current process (see [_executors])"""
+    pid = os.getpid()
+    executor = _executors.get(pid)
+    if executor is None:
+        # A forked child can't use its parent's threads
+        _executors.clear()
+        executor = _executors[pid] = ThreadPoolExecutor(max_workers=DEFAULT_MAX_CONNECTIONS, thread_name_prefix='zatca')
+    return asyncio.get_running_loop().run_in_executor(executor, functools.partial(func, *args))
+
+
+async def send_as_completed(
+    payloads: Iterable[TPayload], send: Callable[[TPayload], Awaitable[TResult]], concurrency: int
+) -> AsyncIterator[Tuple[TPayload, TResult]]:
+    """
+    Calls [send] for each of [payloads], keeping up to [concurrency] calls in flight, and yields (payload, result)
+    pairs as calls complete. [payloads] is consumed lazily, so it can be a generator that prepares each payload when
+    there's room for it. If [send] raises, the exception propagates once its pair is reached
+    """
+    pending: dict[asyncio.Future, TPayload] = {}
+    iterator = iter(payloads)
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(pending) < concurrency:
+                payload = next(iterator, _END)
+                if payload is _END:
+                    exhausted = True
+                    break
+                pending[asyncio.ensure_future(send(payload))] = payload
+
+            if not pending:
+                return
+
+            done, _not_done = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+    finally:
+        # The caller stopped early (or a call failed), so nobody is waiting for the calls still in flight
+        for future in pending:
+            future.cancel()
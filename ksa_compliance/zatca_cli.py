@@ -1,11 +1,17 @@
+import atexit
 import json
 import os.path
+import selectors
 import stat
+import statistics
 import subprocess
 import tempfile
-from dataclasses import dataclass
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
 from json import JSONDecodeError
-from typing import cast, List, NoReturn, Optional
+from typing import cast, Iterator, List, NoReturn, Optional
 
 import semantic_version
 from result import is_err
@@ -24,6 +30,34 @@ DEFAULT_CLI_VERSION = '2.10.0'
 DEFAULT_JRE_URL = 'https://github.com/adoptium/temurin11-binaries/releases/download/jdk-11.0.23%2B9/OpenJDK11U-jre_x64_linux_hotspot_11.0.23_9.tar.gz'
 DEFAULT_CLI_URL = f'https://github.com/lavaloon-eg/zatca-cli/releases/download/{DEFAULT_CLI_VERSION}/zatca-cli-{DEFAULT_CLI_VERSION}.zip'
 
+# How long we wait for a persistent CLI process to answer a single command before we consider it stuck and kill it
+CLI_SERVER_TIMEOUT_SECONDS = 60
+
+# Persistent CLI processes are recycled after this many commands to put a bound on any leaks in the JVM process
+CLI_SERVER_MAX_COMMANDS = 5000
+
+# Class data sharing (AppCDS) archive generated next to the CLI during setup. When present, JVM startup skips loading
+# and verifying the CLI classes from the JARs
+CDS_ARCHIVE_NAME = 'zatca-cli.jsa'
+
+# JVM flags used with the CDS archive. Logging is disabled because a stale archive (e.g. after upgrading the JRE) is
+# silently ignored by the JVM, but it logs a warning to stdout, which would break parsing the CLI output
+CDS_JAVA_OPTS = ['-Xshare:auto', '-Xlog:disable']
+
+# Additional JVM flags for one-off CLI commands, which are short-lived: there's no point in optimizing compilation or
+# running a concurrent garbage collector. These are not used for the persistent CLI server
+SHORT_LIVED_JAVA_OPTS = ['-XX:TieredStopAtLevel=1', '-XX:+UseSerialGC']
+
+# Sample files shipped with the ZATCA SDK that comes with the CLI. They're used to exercise signing and validation
+# while recording the classes to include in the CDS archive
+SDK_SAMPLE_CERT = 'cert.pem'
+SDK_SAMPLE_PRIVATE_KEY = 'ec-secp256k1-priv-key.pem'
+SDK_SAMPLE_INVOICE = 'Simplified_Invoice.xml'
+SDK_SAMPLE_PIH = 'NWZlY2ViNjZmZmM4NmYzOGQ5NTI3ODZjNmQ2OTZjNzljMmRiYzIzOWRkNGU5MWI0NjcyOWQ3M2EyN2ZiNTdlOQ=='
+
+# Redis hash of CLI capabilities (see [CliCapabilities]), keyed by CLI path, CLI modification time and JAVA_HOME
+CLI_CAPABILITIES_CACHE_KEY = 'ksa_compliance:cli_capabilities'
+
 
 @dataclass
 class ZatcaResult:
@@ -68,7 +102,6 @@ class SigningResult:
     """Result for an invoice signing invocation to lava-zatca CLI"""
 
     signed_invoice_xml: str
-    signed_invoice_path: str
     invoice_hash: str
     qr_code: str
 
@@ -103,20 +136,60 @@ class ValidationResult:
         return ValidationResult(j['messages'], j['errorsAndWarnings'], details)
 
 
+@dataclass
+class CliCapabilities:
+    """What a given CLI installation supports, as probed using 'zatca-cli -v'"""
+
+    msg: str
+    """The version message, as displayed to the user"""
+
+    version: Optional[str]
+    """The CLI version. This is only reported by 2.1.0 and later"""
+
+    @property
+    def supports_validation_details(self) -> bool:
+        # Version 2.1.0 is the first version to both support validation and include a 'version' in the data payload
+        return self.version is not None
+
+    @property
+    def supports_pdfa3b(self) -> bool:
+        return self.version is not None and semantic_version.Version(self.version) >= semantic_version.Version('2.5.0')
+
+
+def get_cli_capabilities(zatca_cli_path: str, java_home: Optional[str], refresh: bool = False) -> CliCapabilities:
+    """
+    Returns the capabilities of the CLI at [zatca_cli_path]. The CLI is only probed once; results are cached until the
+    CLI binary or JAVA_HOME changes, or [refresh] is set. Probing failures throw and aren't cached
+    """
+    mtime = os.path.getmtime(zatca_cli_path) if os.path.isfile(zatca_cli_path) else None
+    key = f'{zatca_cli_path}:{mtime}:{java_home or ""}'
+    if not refresh:
+        cached = frappe.cache.hget(CLI_CAPABILITIES_CACHE_KEY, key)
+        if cached:
+            return CliCapabilities(**cached)
+
+    result = run_command(zatca_cli_path, ['-v'], java_home=java_home)
+    result.throw_if_failure()
+    capabilities = CliCapabilities(result.msg, result.data.get('version') if result.data else None)
+    frappe.cache.hset(CLI_CAPABILITIES_CACHE_KEY, key, asdict(capabilities))
+    return capabilities
+
+
+def clear_cli_capabilities() -> None:
+    frappe.cache.delete_value(CLI_CAPABILITIES_CACHE_KEY)
+
+
 @frappe.whitelist()
 def check_setup(zatca_cli_path: str, java_home: Optional[str]) -> NoReturn:
     """Shows a desk dialog with the version of the Lava ZATCA CLI if found, or an error otherwise"""
-    result = run_command(zatca_cli_path, ['-v'], java_home=java_home)
-    result.throw_if_failure()
-    frappe.msgprint(result.msg, ft('ZATCA CLI'))
+    # This is an explicit check by the user, so we always probe the CLI (refreshing the cached capabilities)
+    capabilities = get_cli_capabilities(zatca_cli_path, java_home, refresh=True)
+    frappe.msgprint(capabilities.msg, ft('ZATCA CLI'))
 
 
 @frappe.whitelist()
 def check_validation_details_support(zatca_cli_path: str, java_home: Optional[str]) -> dict:
-    result = run_command(zatca_cli_path, ['-v'], java_home=java_home)
-    result.throw_if_failure()
-    # Version 2.1.0 is the first version to both support validation and include a 'version' in the data payload
-    is_supported = result.data and 'version' in result.data
+    is_supported = get_cli_capabilities(zatca_cli_path, java_home).supports_validation_details
     return {
         'is_supported': is_supported,
         'error': ''
@@ -127,12 +200,8 @@ def check_validation_details_support(zatca_cli_path: str, java_home: Optional[st
 
 def check_pdfa3b_support_or_throw(zatca_cli_path: str, java_home: Optional[str]) -> None:
     """Checks whether PDF/A-3b support is available (version 2.5.0+). Throws a frappe error if it's not supported"""
-    result = run_command(zatca_cli_path, ['-v'], java_home=java_home)
-    result.throw_if_failure()
-    if result.data and 'version' in result.data:
-        version = semantic_version.Version(result.data['version'])
-        if version >= semantic_version.Version('2.5.0'):
-            return
+    if get_cli_capabilities(zatca_cli_path, java_home).supports_pdfa3b:
+        return
 
     fthrow(ft('Please update ZATCA CLI to $version or later to support PDF/A-3b generation', version='2.5.0'))
 
@@ -190,6 +259,14 @@ def setup(override_cli_download_url: str | None, override_jre_download_url: str
 
         # Make ZATCA CLI executable for the current user
         os.chmod(zatca_bin, os.stat(zatca_bin).st_mode | stat.S_IEXEC)
+        clear_cli_capabilities()
+
+        # Startup optimization is nice to have, so failing to generate the archive doesn't fail the setup
+        progress_callback(ft('Optimizing CLI startup'), 95)
+        try:
+            generate_cds_archive(zatca_bin, java_home)
+        except Exception as e:
+            logger.warning(f'Could not generate CDS archive for {zatca_bin}: {e}', exc_info=e)
 
         return {
             'cli_path': zatca_bin,
@@ -207,13 +284,14 @@ def generate_csr(
     """
     Generates a CSR. The given prefix is used to name the resulting CSR and private key files.
     """
-    config_path = write_temp_file(config, f'{file_prefix}-csr.properties')
     csr_path = get_csr_path(file_prefix)
     private_key_path = get_private_key_path(file_prefix)
-    args = ['csr', '-c', config_path, '-o', csr_path, '-k', private_key_path]
-    if simulation:
-        args.append('-s')
-    result = run_command(zatca_cli_path, args, java_home=java_home)
+    with scratch_directory() as directory:
+        config_path = write_scratch_file(directory, f'{file_prefix}-csr.properties', config)
+        args = ['csr', '-c', config_path, '-o', csr_path, '-k', private_key_path]
+        if simulation:
+            args.append('-s')
+        result = run_command(zatca_cli_path, args, java_home=java_home)
     logger.info(result.msg)
     result.throw_if_failure()
     with open(csr_path, 'rt') as file:
@@ -222,38 +300,53 @@ def generate_csr(
 
 
 def sign_invoice(
-    zatca_cli_path: str, java_home: str, invoice_xml: str, cert_path: str, private_key_path: str
+    zatca_cli_path: str,
+    java_home: str,
+    invoice_xml: str,
+    cert_path: str,
+    private_key_path: str,
+    persistent: bool = False,
 ) -> SigningResult:
+    """
+    Signs [invoice_xml] using the CLI. If [persistent] is set, the command is sent to a long-lived CLI process for the
+    current worker (see [CliServer]), falling back to starting the CLI for this invoice if that's not possible
+    """
     base_path = os.path.normpath(os.path.join(os.path.dirname(zatca_cli_path), '../'))
-    invoice_path = write_temp_file(invoice_xml, 'invoice.xml')
-    signed_invoice_path = get_temp_path('signed_invoice.xml')
-    result = run_command(
-        zatca_cli_path,
-        ['sign', '-b', base_path, '-o', signed_invoice_path, '-c', cert_path, '-k', private_key_path, invoice_path],
-        java_home=java_home,
-    )
-    logger.info(result.msg)
-    result.throw_if_failure()
-    with open(signed_invoice_path, 'rt') as file:
-        signed_invoice = file.read()
-    return SigningResult(signed_invoice, signed_invoice_path, result.data['hash'], result.data['qrCode'])
+    with scratch_directory() as directory:
+        invoice_path = write_scratch_file(directory, 'invoice.xml', invoice_xml)
+        signed_invoice_path = os.path.join(directory, 'signed_invoice.xml')
+        result = run_command(
+            zatca_cli_path,
+            ['sign', '-b', base_path, '-o', signed_invoice_path, '-c', cert_path, '-k', private_key_path, invoice_path],
+            java_home=java_home,
+            persistent=persistent,
+        )
+        logger.info(result.msg)
+        result.throw_if_failure()
+        with open(signed_invoice_path, 'rt') as file:
+            signed_invoice = file.read()
+    return SigningResult(signed_invoice, result.data['hash'], result.data['qrCode'])
 
 
 def validate_invoice(
-    zatca_cli_path: str, java_home: Optional[str], invoice_path: str, cert_path: str, previous_invoice_hash: str
+    zatca_cli_path: str, java_home: Optional[str], invoice_xml: str, cert_path: str, previous_invoice_hash: str
 ) -> ValidationResult:
     base_path = os.path.normpath(os.path.join(os.path.dirname(zatca_cli_path), '../'))
-    result = run_command(
-        zatca_cli_path,
-        ['validate', '-b', base_path, '-c', cert_path, '-p', previous_invoice_hash, invoice_path],
-        java_home=java_home,
-    )
+    with scratch_directory() as directory:
+        invoice_path = write_scratch_file(directory, 'invoice.xml', invoice_xml)
+        result = run_command(
+            zatca_cli_path,
+            ['validate', '-b', base_path, '-c', cert_path, '-p', previous_invoice_hash, invoice_path],
+            java_home=java_home,
+        )
     logger.info(result.msg)
     result.throw_if_failure()
     return ValidationResult.from_json(result.data)
 
 
-def run_command(zatca_cli_path: str, args: List[str], java_home: Optional[str]) -> ZatcaResult:
+def run_command(
+    zatca_cli_path: str, args: List[str], java_home: Optional[str], persistent: bool = False
+) -> ZatcaResult:
     """Runs a ZATCA command (using lava-zatca CLI) and parses its JSON output. Output is in the form:
     { 'msg': '...',
       'errors': ['...', '...']
@@ -265,59 +358,397 @@ def run_command(zatca_cli_path: str, args: List[str], java_home: Optional[str])
     Note that currently there are no error codes or the like, because there's no automatic action that can be performed
     in response to failures. The user has to apply the recommended fixes manually, so we just show the messages and
     errors as is.
+
+    If [persistent] is set, the command is sent to a long-lived CLI process (see [CliServer]) to avoid paying for JVM
+    startup on every command. If the CLI doesn't support that, or the process misbehaves, we transparently fall back to
+    running the command in a new process.
     """
     if not os.path.isfile(zatca_cli_path):
         fthrow(_('{0} does not exist or is not a file').format(zatca_cli_path))
 
+    if persistent:
+        result = CliServer.run(zatca_cli_path, args, java_home)
+        if result is not None:
+            return result
+
     full_args = [zatca_cli_path] + args
+    logger.info(f'Running: {full_args}')
+    proc = subprocess.run(full_args, capture_output=True, env=_build_env(java_home, zatca_cli_path))
+    return _parse_output(proc.stdout, proc.stderr, proc.returncode)
+
+
+def _build_env(
+    java_home: Optional[str],
+    zatca_cli_path: Optional[str] = None,
+    persistent: bool = False,
+    java_opts: Optional[List[str]] = None,
+) -> dict[str, str]:
+    """
+    Builds the environment for running the CLI. If [zatca_cli_path] has a CDS archive, the JVM is told to use it, along
+    with flags tuned for short-lived commands unless [persistent] is set. [java_opts] are always added
+    """
     env = os.environ.copy()
     if java_home:
         env['JAVA_HOME'] = java_home
-    logger.info(f'Running: {full_args}')
-    proc = subprocess.run(full_args, capture_output=True, env=env)
+
+    opts = list(java_opts or [])
+    if zatca_cli_path:
+        archive_path = get_cds_archive_path(zatca_cli_path)
+        if os.path.isfile(archive_path):
+            opts += [f'-XX:SharedArchiveFile={archive_path}'] + CDS_JAVA_OPTS
+            if not persistent:
+                opts += SHORT_LIVED_JAVA_OPTS
+
+    # The CLI start script passes JAVA_OPTS to the JVM
+    if opts:
+        env['JAVA_OPTS'] = ' '.join([env['JAVA_OPTS']] + opts if env.get('JAVA_OPTS') else opts)
+    return env
+
+
+def get_cds_archive_path(zatca_cli_path: str) -> str:
+    base_path = os.path.normpath(os.path.join(os.path.dirname(zatca_cli_path), '../'))
+    return os.path.join(base_path, CDS_ARCHIVE_NAME)
+
+
+def generate_cds_archive(zatca_cli_path: str, java_home: Optional[str]) -> str:
+    """
+    Generates a class data sharing (AppCDS) archive for the CLI, returning its path. We run a few training commands
+    (signing and validating the SDK sample invoice, if available) recording the classes they load, then dump those
+    classes into the archive. The archive replaces any existing one only once it's fully generated
+    """
+    archive_path = get_cds_archive_path(zatca_cli_path)
+    with scratch_directory() as directory:
+        classes = {}
+        for i, args in enumerate(_get_training_commands(zatca_cli_path, directory)):
+            class_list_path = os.path.join(directory, f'classes-{i}.lst')
+            _run_with_java_opts(zatca_cli_path, args, java_home, [f'-XX:DumpLoadedClassList={class_list_path}'])
+            if os.path.isfile(class_list_path):
+                with open(class_list_path, 'rt') as file:
+                    classes.update(dict.fromkeys(line.strip() for line in file if line.strip()))
+
+        if not classes:
+            fthrow(ft('Could not record the classes loaded by ZATCA CLI'))
+
+        class_list_path = write_scratch_file(directory, 'classes.lst', '\n'.join(classes) + '\n')
+        # Written next to the final archive, so that it can be atomically moved into place
+        temp_archive_path = f'{archive_path}.{os.getpid()}.tmp'
+        proc = _run_with_java_opts(
+            zatca_cli_path,
+            ['-v'],
+            java_home,
+            [
+                '-Xshare:dump',
+                f'-XX:SharedClassListFile={class_list_path}',
+                f'-XX:SharedArchiveFile={temp_archive_path}',
+            ],
+        )
+        if proc.returncode != 0 or not os.path.isfile(temp_archive_path):
+            if os.path.isfile(temp_archive_path):
+                os.remove(temp_archive_path)
+            fthrow(ft('Could not generate the CDS archive for ZATCA CLI: $error', error=proc.stderr or proc.stdout))
+
+        os.replace(temp_archive_path, archive_path)
+
+    logger.info(f'Generated CDS archive {archive_path} with {len(classes)} classes')
+    return archive_path
+
+
+def benchmark_startup(zatca_cli_path: str, java_home: Optional[str], runs: int = 3) -> dict[str, float]:
+    """
+    Returns the median time in seconds for running 'zatca-cli -v' without any JVM tuning ('default') and with the CDS
+    archive and tuned flags ('optimized'), if an archive exists
+    """
+
+    def measure(env: dict[str, str]) -> float:
+        durations = []
+        for _run in range(runs):
+            start = time.perf_counter()
+            subprocess.run([zatca_cli_path, '-v'], capture_output=True, env=env)
+            durations.append(time.perf_counter() - start)
+        return statistics.median(durations)
+
+    result = {'default': measure(_build_env(java_home))}
+    if os.path.isfile(get_cds_archive_path(zatca_cli_path)):
+        result['optimized'] = measure(_build_env(java_home, zatca_cli_path))
+    return result
+
+
+@frappe.whitelist()
+def optimize_startup(zatca_cli_path: str, java_home: Optional[str]) -> dict:
+    """Generates a CDS archive for the CLI and shows a desk dialog comparing startup time before and after"""
+    if not os.path.isfile(zatca_cli_path):
+        fthrow(_('{0} does not exist or is not a file').format(zatca_cli_path))
+
+    generate_cds_archive(zatca_cli_path, java_home)
+    timings = benchmark_startup(zatca_cli_path, java_home)
+    frappe.msgprint(
+        ft(
+            'CLI startup time: $default seconds without optimization, $optimized seconds with optimization',
+            default=f"{timings['default']:.2f}",
+            optimized=f"{timings.get('optimized', timings['default']):.2f}",
+        ),
+        ft('ZATCA CLI'),
+    )
+    return timings
+
+
+def _get_training_commands(zatca_cli_path: str, directory: str) -> List[List[str]]:
+    base_path = os.path.normpath(os.path.join(os.path.dirname(zatca_cli_path), '../'))
+    commands = [['-v']]
+
+    cert_path = _find_sdk_file(base_path, SDK_SAMPLE_CERT)
+    private_key_path = _find_sdk_file(base_path, SDK_SAMPLE_PRIVATE_KEY)
+    invoice_path = _find_sdk_file(base_path, SDK_SAMPLE_INVOICE)
+    if cert_path and private_key_path and invoice_path:
+        signed_invoice_path = os.path.join(directory, 'signed_invoice.xml')
+        commands.append(
+            ['sign', '-b', base_path, '-o', signed_invoice_path, '-c', cert_path, '-k', private_key_path, invoice_path]
+        )
+        commands.append(['validate', '-b', base_path, '-c', cert_path, '-p', SDK_SAMPLE_PIH, signed_invoice_path])
+    else:
+        logger.info(f'Could not find SDK sample files under {base_path}. Only the version command is used for training')
+    return commands
+
+
+def _find_sdk_file(base_path: str, name: str) -> Optional[str]:
+    for directory, _directories, files in os.walk(base_path):
+        if name in files:
+            return os.path.join(directory, name)
+    return None
+
+
+def _run_with_java_opts(
+    zatca_cli_path: str, args: List[str], java_home: Optional[str], java_opts: List[str]
+) -> subprocess.CompletedProcess:
+    full_args = [zatca_cli_path] + args
+    logger.info(f'Running: {full_args} with {java_opts}')
+    return subprocess.run(full_args, capture_output=True, text=True, env=_build_env(java_home, java_opts=java_opts))
+
+
+def _parse_output(stdout: bytes | str, stderr: bytes | str, returncode: int) -> ZatcaResult:
     try:
-        result = cast(dict, json.loads(proc.stdout))
+        result = cast(dict, json.loads(stdout))
     except JSONDecodeError:
-        result = {'msg': str(proc.stdout), 'errors': [str(proc.stderr)]}
+        result = {'msg': str(stdout), 'errors': [str(stderr)]}
     except Exception as e:
         result = {'msg': 'An unexpected error occurred', 'errors': [str(e)]}
 
-    if proc.returncode != 0:
+    if returncode != 0:
         return ZatcaResult(is_success=False, msg=result['msg'], errors=result.get('errors', []), data=None)
 
     return ZatcaResult(is_success=True, msg=result['msg'], errors=[], data=result.get('data'))
 
 
-def write_temp_file(content: str, name: str) -> str:
-    """Writes the given text [content] into a temporary file named [name]"""
-    path = get_temp_path(name)
-    with open(path, 'wt+') as file:
-        file.write(content)
-    return path
+class CliServer:
+    """
+    A long-lived CLI process that runs commands sent to it as JSON lines over stdin, and replies with a JSON line per
+    command on stdout. Each request is in the form:
+        { "args": ["sign", "-b", "...", ...] }
+
+    And each response has the same shape as the output of running the command directly, in addition to its exit code:
+        { "exitCode": 0, "msg": "...", "errors": [...], "data": {...} }
+
+    Starting the JVM and loading classes takes over a second, which dominates the time it takes to sign an invoice.
+    Keeping one warm process per worker (and CLI/Java combination) brings that down to the time of the actual signing.
+
+    Servers are never shared across processes. If a worker forks, the child starts its own server on first use.
+    """
 
+    _servers: dict[tuple[str, Optional[str]], 'CliServer'] = {}
+    _unsupported: set[tuple[str, Optional[str]]] = set()
+    _lock = threading.Lock()
+
+    def __init__(self, zatca_cli_path: str, java_home: Optional[str]):
+        self.zatca_cli_path = zatca_cli_path
+        self.java_home = java_home
+        self.pid = os.getpid()
+        self.commands = 0
+        self.lock = threading.Lock()
+        self.proc: Optional[subprocess.Popen] = None
+
+    @classmethod
+    def run(cls, zatca_cli_path: str, args: List[str], java_home: Optional[str]) -> Optional[ZatcaResult]:
+        """
+        Runs a command through the server for the given CLI, starting or restarting the server if needed. Returns
+        None if the command couldn't be run through a server, in which case the caller should run it directly
+        """
+        key = (zatca_cli_path, java_home or None)
+        if key in cls._unsupported:
+            return None
+
+        with cls._lock:
+            server = cls._servers.get(key)
+            if server is None or server.pid != os.getpid():
+                server = cls(zatca_cli_path, java_home)
+                cls._servers[key] = server
+
+        # A server that died since its last command (e.g. killed by the OOM killer) gets one restart attempt. If the
+        # restart doesn't work either, we give up on servers for this CLI until the worker restarts
+        for attempt in range(2):
+            try:
+                return server.send(args)
+            except _CliServerUnsupported:
+                logger.warning(f"ZATCA CLI at '{zatca_cli_path}' does not support persistent mode. Falling back")
+                cls._unsupported.add(key)
+                server.stop()
+                return None
+            except Exception as e:
+                logger.warning(f'ZATCA CLI server failed (attempt {attempt + 1}). Restarting', exc_info=e)
+                server.stop()
+
+        return None
+
+    @classmethod
+    def stop_all(cls) -> None:
+        with cls._lock:
+            for server in cls._servers.values():
+                if server.pid == os.getpid():
+                    server.stop()
+            cls._servers.clear()
 
-def write_binary_temp_file(content: bytes, name: str) -> str:
-    path = get_temp_path(name)
-    with open(path, 'wb+') as file:
+    @property
+    def is_alive(self) -> bool:
+        return self.proc is not None and self.proc.poll() is None
+
+    def send(self, args: List[str]) -> ZatcaResult:
+        with self.lock:
+            if self.commands >= CLI_SERVER_MAX_COMMANDS:
+                logger.info(f'Recycling ZATCA CLI server after {self.commands} commands')
+                self.stop()
+
+            if not self.is_alive:
+                self.start()
+
+            logger.info(f'Running (persistent): {args}')
+            response = self._request(args)
+            self.commands += 1
+            return _parse_output(json.dumps(response), '', int(response.get('exitCode', 1)))
+
+    def start(self) -> None:
+        args = [self.zatca_cli_path, 'serve']
+        logger.info(f'Starting ZATCA CLI server: {args}')
+        self.proc = subprocess.Popen(
+            args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            env=_build_env(self.java_home, self.zatca_cli_path, persistent=True),
+            text=True,
+            bufsize=1,
+        )
+        self.commands = 0
+
+        # Health check: the server must answer a version request before we hand it real work. CLI versions without
+        # 'serve' treat it as an unknown command: they exit, print their usage instead of JSON, or wait for input
+        try:
+            response = self._request(['-v'])
+        except (_CliServerDied, JSONDecodeError, TimeoutError):
+            raise _CliServerUnsupported()
+
+        if response.get('exitCode') != 0:
+            raise _CliServerUnsupported()
+
+    def stop(self) -> None:
+        if self.proc is None:
+            return
+
+        proc, self.proc = self.proc, None
+        try:
+            if proc.stdin:
+                proc.stdin.close()
+            proc.wait(timeout=5)
+        except Exception:
+            proc.kill()
+
+    def _request(self, args: List[str]) -> dict:
+        proc = cast(subprocess.Popen, self.proc)
+        try:
+            proc.stdin.write(json.dumps({'args': args}) + '\n')
+            proc.stdin.flush()
+        except (BrokenPipeError, OSError):
+            raise _CliServerDied()
+
+        with selectors.DefaultSelector() as selector:
+            selector.register(proc.stdout, selectors.EVENT_READ)
+            if not selector.select(timeout=CLI_SERVER_TIMEOUT_SECONDS):
+                proc.kill()
+                raise TimeoutError(f'ZATCA CLI server did not respond within {CLI_SERVER_TIMEOUT_SECONDS} seconds')
+
+        line = proc.stdout.readline()
+        if not line:
+            raise _CliServerDied()
+
+        return cast(dict, json.loads(line))
+
+
+class _CliServerDied(Exception):
+    pass
+
+
+class _CliServerUnsupported(Exception):
+    pass
+
+
+atexit.register(CliServer.stop_all)
+
+
+@contextmanager
+def scratch_directory() -> Iterator[str]:
+    """
+    Yields a private directory for exchanging files with the CLI. The directory and everything in it are removed on
+    exit, whether the command succeeds or not
+    """
+    with tempfile.TemporaryDirectory(prefix='zatca-', dir=_get_scratch_root()) as directory:
+        yield directory
+
+
+def write_scratch_file(directory: str, name: str, content: str | bytes) -> str:
+    """Writes [content] into a file named [name] under [directory], returning its path"""
+    path = os.path.join(directory, name)
+    with open(path, 'wb' if isinstance(content, bytes) else 'wt') as file:
         file.write(content)
     return path
 
 
-def get_temp_path(name: str) -> str:
-    return tempfile.mktemp(suffix='-' + name)
+def _get_scratch_root() -> str:
+    """
+    Returns the directory under which scratch directories are created: the 'zatca_scratch_dir' site config key, or the
+    system temporary directory. Pointing it to a tmpfs (e.g. /dev/shm) keeps the files in memory, but it has to be large
+    enough for the PDFs of bulk exports (Docker only gives /dev/shm 64 MB by default)
+    """
+    return frappe.conf.get('zatca_scratch_dir') or tempfile.gettempdir()
 
 
 def convert_to_pdf_a3_b(
-    zatca_cli_path: str, java_home: Optional[str], invoice_id: str, pdf_content: bytes, xml_content: str
-) -> str:
-    pdf = write_binary_temp_file(pdf_content, f'{invoice_id}.pdf')
-    invoice_xml = write_temp_file(xml_content, f'{invoice_id}.xml')
-
-    result = run_command(
-        zatca_cli_path,
-        ['convert-pdf', '-i', invoice_id, '-x', invoice_xml, pdf],
-        java_home=java_home,
-    )
-    logger.info(result.msg)
-    result.throw_if_failure()
-    return result.data['filePath']
+    zatca_cli_path: str,
+    java_home: Optional[str],
+    invoice_id: str,
+    pdf_content: bytes,
+    xml_content: str,
+    persistent: bool = False,
+) -> bytes:
+    """
+    Converts [pdf_content] to PDF/A-3b with [xml_content] embedded, returning the converted PDF. If [persistent] is
+    set, the conversion is sent to a long-lived CLI process (see [CliServer])
+    """
+    with scratch_directory() as directory:
+        pdf = write_scratch_file(directory, f'{invoice_id}.pdf', pdf_content)
+        invoice_xml = write_scratch_file(directory, f'{invoice_id}.xml', xml_content)
+
+        result = run_command(
+            zatca_cli_path,
+            ['convert-pdf', '-i', invoice_id, '-x', invoice_xml, pdf],
+            java_home=java_home,
+            persistent=persistent,
+        )
+        logger.info(result.msg)
+        result.throw_if_failure()
+
+        output_path = result.data['filePath']
+        try:
+            with open(output_path, 'rb') as file:
+                return file.read()
+        finally:
+            # The CLI may write its output outside our scratch directory, so we clean it up explicitly
+            if os.path.isfile(output_path):
+                os.remove(output_path)
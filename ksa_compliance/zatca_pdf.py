@@ -0,0 +1,132 @@
+import hashlib
+from typing import Optional, cast
+
+import frappe
+from erpnext.accounts.doctype.sales_invoice.sales_invoice import SalesInvoice
+from frappe.core.doctype.file.file import File
+from frappe.translate import print_language
+from frappe.utils import now_datetime
+from frappe.utils.pdf import get_file_data_from_writer
+from pypdf import PdfWriter
+
+from ksa_compliance import logger
+
+SIAF_DOCTYPE = 'Sales Invoice Additional Fields'
+
+# Cached PDFs are named '{PDF_CACHE_PREFIX}{key}.pdf' and attached to their sales invoice additional fields
+PDF_CACHE_PREFIX = 'zatca-pdf-'
+
+# The maximum total size of cached PDFs before the least recently used ones are evicted. Can be overridden using the
+# 'zatca_pdf_cache_max_size_mb' site config key. Setting it to 0 disables the cache
+DEFAULT_PDF_CACHE_MAX_SIZE_MB = 500
+
+
+def render_invoice_pdf(sales_invoice_doc: SalesInvoice, company: str, print_format: str, lang: str) -> bytes:
+    """Renders [sales_invoice_doc] to a (regular) PDF using [print_format] in [lang]"""
+    pdf_writer = PdfWriter()
+    pdf_writer.add_metadata(
+        {
+            '/Author': company,
+            '/Title': sales_invoice_doc.name,
+            '/Subject': sales_invoice_doc.name,
+        }
+    )
+    with print_language(lang):
+        frappe.get_print(
+            'Sales Invoice',
+            sales_invoice_doc.name,
+            print_format,
+            doc=sales_invoice_doc,
+            as_pdf=True,
+            output=pdf_writer,
+        )
+    return get_file_data_from_writer(pdf_writer)
+
+
+def get_pdf_cache_key(
+    siaf_id: str, invoice_hash: str, invoice_modified: str, print_format: str, lang: str
+) -> Optional[str]:
+    """
+    Returns the cache key for the PDF/A-3b of an invoice rendered with [print_format] in [lang], or None if caching is
+    disabled. The key changes whenever the invoice, its signed XML or the print format change
+    """
+    if not get_pdf_cache_max_size():
+        return None
+
+    print_format_modified = frappe.db.get_value('Print Format', print_format, 'modified')
+    parts = [siaf_id, invoice_hash or '', str(invoice_modified), print_format, str(print_format_modified), lang]
+    return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+def get_cached_pdf(siaf_id: str, key: str) -> Optional[bytes]:
+    """Returns the cached PDF for [key] if any, marking it as recently used"""
+    file_id = frappe.db.get_value(
+        'File',
+        {'attached_to_doctype': SIAF_DOCTYPE, 'attached_to_name': siaf_id, 'file_name': _get_file_name(key)},
+        'name',
+    )
+    if not file_id:
+        return None
+
+    file = cast(File, frappe.get_doc('File', file_id))
+    try:
+        content = file.get_content()
+    except OSError as e:
+        # The file was removed from disk behind our back, so we drop the entry and render the PDF again
+        logger.warning(f'Could not read cached PDF {file_id}: {e}')
+        frappe.delete_doc('File', file_id, ignore_permissions=True)
+        return None
+
+    # 'modified' drives LRU eviction
+    frappe.db.set_value('File', file_id, 'modified', now_datetime(), update_modified=False)
+    return content if isinstance(content, bytes) else content.encode('utf-8')
+
+
+def cache_pdf(siaf_id: str, key: str, content: bytes) -> None:
+    file = cast(
+        File,
+        frappe.get_doc(
+            {
+                'doctype': 'File',
+                'file_name': _get_file_name(key),
+                'attached_to_doctype': SIAF_DOCTYPE,
+                'attached_to_name': siaf_id,
+                'is_private': 1,
+                'content': content,
+            }
+        ),
+    )
+    file.insert(ignore_permissions=True)
+
+
+def get_pdf_cache_max_size() -> int:
+    """Returns the maximum size of the PDF cache in bytes"""
+    max_size_mb = frappe.conf.get('zatca_pdf_cache_max_size_mb', DEFAULT_PDF_CACHE_MAX_SIZE_MB)
+    return int(max_size_mb) * 1024 * 1024
+
+
+def evict_pdf_cache() -> None:
+    """Deletes the least recently used cached PDFs until the cache fits in its maximum size"""
+    max_size = get_pdf_cache_max_size()
+    files = frappe.get_all(
+        'File',
+        fields=['name', 'file_size'],
+        filters={'attached_to_doctype': SIAF_DOCTYPE, 'file_name': ['like', f'{PDF_CACHE_PREFIX}%.pdf']},
+        order_by='modified desc',
+    )
+
+    total_size = 0
+    evicted = 0
+    for file in files:
+        total_size += file.file_size or 0
+        if total_size > max_size:
+            frappe.delete_doc('File', file.name, ignore_permissions=True)
+            evicted += 1
+
+    if evicted:
+        logger.info(f'Evicted {evicted} cached PDFs')
+        frappe.db.commit()
+
+
+def _get_file_name(key: str) -> str:
+    return f'{PDF_CACHE_PREFIX}{key}.pdf'